@@ -11,12 +11,25 @@ static const WireValue wire_values[2] = {
   {2, 0, sizeof(uint32_t), (Value<void*>*) &ARM::rotations}
 };
 
-MasterManager<State, 3, 2> manager(0x6f22a0ba, state_infos, wire_values, 0);
+const uint8_t slave_addresses[1] = {0};
+
+// index into slave_addresses by bus address
+static const uint8_t slave_index[0 + 1] = {NO_SLAVE};
+
+uint8_t commSlaveIndex(uint8_t address) {
+  return address <= 0 ? slave_index[address] : NO_SLAVE;
+}
+
+#ifdef MANAGER_COMM_HOOKS
+MasterManager<State, 3, 2> manager(0x6f22a0ba, state_infos, wire_values, slave_addresses, NUM_SLAVES);
+#else
+MasterManager<State, 3, 2> manager(0xef22a0ba, state_infos, wire_values, 0x0);
+#endif
 
 namespace IDLE {
 
 
-void event(uint8_t ev) {
+void handleEvent(uint8_t ev) {
   switch (ev) {
   
   default:
@@ -24,12 +37,16 @@ void event(uint8_t ev) {
   }
 }
 
+void event(uint8_t ev) {
+  handleEvent(ev);
+}
+
 
 }
 namespace MOTIONMACHINE {
 Value<uint32_t> stepperPosition;
 
-void event(uint8_t ev) {
+void handleEvent(uint8_t ev) {
   switch (ev) {
   case 0:
     events::moveLiftUp();
@@ -51,6 +68,10 @@ void event(uint8_t ev) {
   }
 }
 
+void event(uint8_t ev) {
+  handleEvent(ev);
+}
+
 namespace tablet {
 
 namespace events {
@@ -61,7 +82,7 @@ void finishedAction() { manager.sendTabletEvent(0); }
 namespace ARM {
 Value<uint32_t> rotations;
 
-void event(uint8_t ev) {
+void handleEvent(uint8_t ev) {
   switch (ev) {
   case 0:
     events::moveFromTallToShort();
@@ -92,6 +113,10 @@ void event(uint8_t ev) {
   }
 }
 
+void event(uint8_t ev) {
+  handleEvent(ev);
+}
+
 namespace tablet {
 
 namespace events {
@@ -100,3 +125,449 @@ void finishedAction() { manager.sendTabletEvent(0); }
 }
 }
 
+#ifdef MANAGER_COMM_HOOKS
+static const uint8_t OPCODE_VALUE = 2;
+static const uint8_t OPCODE_DEBUG_SETTING = 3;
+static const uint8_t OPCODE_HEARTBEAT = 4;
+static const uint8_t OPCODE_ACK = 7;
+static const uint8_t OPCODE_QUEUE_STATS = 8;
+static const uint8_t OPCODE_PROFILE = 9;
+static const uint8_t QUEUE_STATS_RESET = 1;
+static const uint8_t PROFILE_RESET = 1;
+static const uint8_t DEBUG_ALL_VALUES = 0xff;
+static const uint8_t FRAME_SYNC = 0xa5;
+static const uint8_t FRAME_MAX_LENGTH = 32;
+
+// reporting level of every tablet value, starting at report_offsets[state]
+static const uint16_t report_offsets[3 + 1] = {0, 0, 0, 0};
+static uint8_t report_levels[1] = {1};
+static uint8_t state_levels[3] = {1, 1, 1};
+
+uint8_t commReportLevel(uint8_t state) {
+  return state_levels[state];
+}
+
+static void commDrainEvent() {
+}
+static void commEventQueueStats(uint8_t *stats, bool reset) {
+  memset(stats, 0, 5);
+}
+
+// Built without gen.py --instrument, so there are no profiling counters.
+static void commProfileCounters(uint8_t *out, uint16_t slot, bool reset) {
+  memset(out, 0, 14);
+  out[0] = out[1] = 0xff;
+}
+
+static const uint8_t OPCODE_EVENT = 1;
+static const uint8_t BUS_QUEUE = 8;
+static const uint8_t BUS_VALUES_PER_POLL = 1;
+static const uint8_t BUS_BURST_MS = 100;
+
+// slave indexes in the order they're polled, and each slave's budget in
+// bytes per second, 0 for unlimited
+static const uint8_t bus_poll_order[1] = {NO_SLAVE};
+static const uint16_t bus_budgets[1] = {0};
+
+struct BusValue {
+  uint8_t state;
+  uint8_t value;
+  uint8_t size;
+  uint8_t data[4];
+};
+
+// queued events and values of each slave, oldest first
+static uint8_t bus_events[1][BUS_QUEUE][2];
+static uint8_t bus_event_count[1];
+static BusValue bus_values[1][BUS_QUEUE];
+static uint8_t bus_value_count[1];
+
+// budget left in thousandths of a byte, can go negative when events or a
+// full queue force frames out
+static int32_t bus_tokens[1];
+static uint32_t bus_refill_ms = 0;
+static uint8_t bus_cursor = 0;
+
+// unlimited slaves aren't accounted at all, and the debt forced frames run
+// up is capped at a second of budget so the counter can't overflow
+static void commBusCharge(uint8_t slave, uint8_t len) {
+  if (!bus_budgets[slave]) {
+    return;
+  }
+  int32_t limit = -1000L * bus_budgets[slave];
+  bus_tokens[slave] -= 1000L * len;
+  if (bus_tokens[slave] < limit) {
+    bus_tokens[slave] = limit;
+  }
+}
+
+static void commBusSendEvent(uint8_t slave) {
+  uint8_t frame[3] = {OPCODE_EVENT, bus_events[slave][0][0], bus_events[slave][0][1]};
+  bus_event_count[slave]--;
+  memmove(bus_events[slave], bus_events[slave] + 1, bus_event_count[slave] * sizeof(bus_events[slave][0]));
+  commBusCharge(slave, sizeof(frame));
+  manager.sendSlaveFrame(slave_addresses[slave], frame, sizeof(frame));
+}
+
+static void commBusSendValue(uint8_t slave) {
+  BusValue *v = &bus_values[slave][0];
+  uint8_t frame[7] = {OPCODE_VALUE, v->state, v->value};
+  memcpy(frame + 3, v->data, v->size);
+  uint8_t len = 3 + v->size;
+  bus_value_count[slave]--;
+  memmove(bus_values[slave], bus_values[slave] + 1, bus_value_count[slave] * sizeof(BusValue));
+  commBusCharge(slave, len);
+  manager.sendSlaveFrame(slave_addresses[slave], frame, len);
+}
+
+void commBusEvent(uint8_t address, uint8_t state, uint8_t event) {
+  uint8_t slave = commSlaveIndex(address);
+  if (slave == NO_SLAVE) {
+    return;
+  }
+  if (bus_event_count[slave] == BUS_QUEUE) {
+    // events are never dropped, so make room by sending the oldest now
+    commBusSendEvent(slave);
+  }
+  bus_events[slave][bus_event_count[slave]][0] = state;
+  bus_events[slave][bus_event_count[slave]][1] = event;
+  bus_event_count[slave]++;
+}
+
+void commBusValue(uint8_t address, uint8_t state, uint8_t value, const uint8_t *data, uint8_t size) {
+  uint8_t slave = commSlaveIndex(address);
+  if (slave == NO_SLAVE) {
+    return;
+  }
+  for (uint8_t i = 0; i < bus_value_count[slave]; i++) {
+    BusValue *v = &bus_values[slave][i];
+    if (v->state == state && v->value == value) {
+      // not sent yet, so only the latest write matters
+      memcpy(v->data, data, size);
+      return;
+    }
+  }
+  if (bus_value_count[slave] == BUS_QUEUE) {
+    commBusSendValue(slave);
+  }
+  BusValue *v = &bus_values[slave][bus_value_count[slave]++];
+  v->state = state;
+  v->value = value;
+  v->size = size;
+  memcpy(v->data, data, size);
+}
+
+static void commBusPoll() {
+  uint32_t now = millis();
+  uint32_t elapsed = now - bus_refill_ms;
+  bus_refill_ms = now;
+  for (uint8_t slave = 0; slave < NUM_SLAVES; slave++) {
+    // a budget of b bytes/s earns b thousandths of a byte every ms
+    int32_t cap = (int32_t) bus_budgets[slave] * BUS_BURST_MS;
+    bus_tokens[slave] += (int32_t) bus_budgets[slave] * (int32_t) elapsed;
+    if (bus_tokens[slave] > cap) {
+      bus_tokens[slave] = cap;
+    }
+  }
+
+  // events outrank values, so every slave's events go first
+  for (uint8_t i = 0; i < sizeof(bus_poll_order); i++) {
+    uint8_t slave = bus_poll_order[i];
+    while (slave < NUM_SLAVES && bus_event_count[slave]) {
+      commBusSendEvent(slave);
+    }
+  }
+
+  // then a bounded number of values, carrying on round robin from where
+  // the last poll stopped
+  uint8_t sent = 0;
+  for (uint8_t n = 0; n < sizeof(bus_poll_order) && sent < BUS_VALUES_PER_POLL; n++) {
+    uint8_t slave = bus_poll_order[bus_cursor];
+    bus_cursor = (bus_cursor + 1) % sizeof(bus_poll_order);
+    if (slave >= NUM_SLAVES || !bus_value_count[slave]) {
+      continue;
+    }
+    if (bus_budgets[slave] && bus_tokens[slave] < 1000L * (3 + bus_values[slave][0].size)) {
+      continue;
+    }
+    commBusSendValue(slave);
+    sent++;
+  }
+}
+
+static const uint8_t REPORT_ON_CHANGE = 1;
+static const uint8_t REPORT_WRITTEN = 1;
+static const uint8_t REPORT_SENT = 2;
+
+// reporting policy of every reported value, indexed like report_offsets
+static const uint8_t report_sizes[1] = {0};
+static const uint8_t report_flags[1] = {0};
+static const uint16_t report_min_ms[1] = {0};
+static const uint16_t report_period_ms[1] = {0};
+
+// the last value written, the last value sent and when it was sent
+static uint8_t report_shadow[1][4];
+static uint8_t report_sent[1][4];
+static uint32_t report_sent_ms[1];
+static uint8_t report_status[1];
+
+// one bit per value of each state, set when it's written and cleared when
+// it's sent
+static uint8_t report_dirty[3][1];
+
+// values are only written by the current state, so this is the state
+// periodic values are resent for
+static uint8_t report_state = 0;
+
+static void commReportValue(uint8_t state, uint8_t value) {
+  uint16_t i = report_offsets[state] + value;
+  uint8_t frame[7] = {OPCODE_VALUE, state, value};
+  memcpy(frame + 3, report_shadow[i], report_sizes[i]);
+  memcpy(report_sent[i], report_shadow[i], report_sizes[i]);
+  report_status[i] |= REPORT_SENT;
+  report_sent_ms[i] = millis();
+  commSend(frame, 3 + report_sizes[i]);
+}
+
+// Always returns false, the value is sent from commLoop().
+bool commShouldReport(uint8_t state, uint8_t value, const uint8_t *data, uint8_t size) {
+  uint16_t i = report_offsets[state] + value;
+  if (!(report_levels[i] != 0)) {
+    return false;
+  }
+  memcpy(report_shadow[i], data, size);
+  report_status[i] |= REPORT_WRITTEN;
+  report_dirty[state][value >> 3] |= 1 << (value & 7);
+  report_state = state;
+  return false;
+}
+
+void commLoop() {
+  uint32_t now = millis();
+  commBusPoll();
+  commDrainEvent();
+  for (uint8_t state = 0; state < 3; state++) {
+    uint16_t first = report_offsets[state];
+    uint8_t count = report_offsets[state + 1] - first;
+    for (uint8_t value = 0; value < count; value++) {
+      uint16_t i = first + value;
+      uint8_t mask = 1 << (value & 7);
+      bool dirty = report_dirty[state][value >> 3] & mask;
+      if (!dirty && (state != report_state || !report_period_ms[i])) {
+        continue;
+      }
+      if (!(report_levels[i] != 0)) {
+        continue;
+      }
+
+      uint32_t since = now - report_sent_ms[i];
+      if (dirty && since >= report_min_ms[i]) {
+        report_dirty[state][value >> 3] &= ~mask;
+        bool changed = !(report_status[i] & REPORT_SENT) ||
+                       memcmp(report_shadow[i], report_sent[i], report_sizes[i]) != 0;
+        if (changed || !(report_flags[i] & REPORT_ON_CHANGE)) {
+          commReportValue(state, value);
+        }
+      } else if (state == report_state && report_period_ms[i] &&
+                 (report_status[i] & REPORT_WRITTEN) && since >= report_period_ms[i]) {
+        commReportValue(state, value);
+      }
+    }
+  }
+}
+
+// Set once the console sends a valid framed frame, after which replies
+// are framed too.
+static bool framed = false;
+
+// The frame being handled, when it arrived framed.
+static const uint8_t *frame_data = 0;
+static uint8_t frame_left = 0;
+
+// Bytes read for a frame that turned out to be bad, from the next sync
+// byte on. They're searched for a good frame before reading any more.
+static uint8_t resync_buf[FRAME_MAX_LENGTH + 2];
+static uint8_t resync_len = 0;
+static uint8_t resync_pos = 0;
+
+static uint8_t commReadByte() {
+  if (frame_data) {
+    if (!frame_left) {
+      return 0;
+    }
+    frame_left--;
+    return *frame_data++;
+  }
+  if (resync_pos < resync_len) {
+    return resync_buf[resync_pos++];
+  }
+  while (!Serial.available()) {}
+  return Serial.read();
+}
+
+// Keeps the |n| bytes of a bad frame in |buf| from the first sync byte on,
+// ahead of any kept bytes that haven't been read yet. Those were read
+// after |buf|, and together they always fit.
+static void commResync(const uint8_t *buf, uint8_t n) {
+  uint8_t from = 0;
+  while (from < n && buf[from] != FRAME_SYNC) {
+    from++;
+  }
+  uint8_t keep = n - from;
+  uint8_t left = resync_len - resync_pos;
+  memmove(resync_buf + keep, resync_buf + resync_pos, left);
+  memcpy(resync_buf, buf + from, keep);
+  resync_len = keep + left;
+  resync_pos = 0;
+}
+
+static uint8_t crc8Update(uint8_t crc, uint8_t b) {
+  crc ^= b;
+  for (uint8_t i = 0; i < 8; i++) {
+    crc = crc & 0x80 ? (crc << 1) ^ 0x07 : crc << 1;
+  }
+  return crc;
+}
+
+void commSend(const uint8_t *frame, uint8_t len) {
+  if (!framed) {
+    Serial.write(frame, len);
+    return;
+  }
+  uint8_t crc = crc8Update(0, len);
+  for (uint8_t i = 0; i < len; i++) {
+    crc = crc8Update(crc, frame[i]);
+  }
+  Serial.write(FRAME_SYNC);
+  Serial.write(len);
+  Serial.write(frame, len);
+  Serial.write(crc);
+}
+
+// Reads a frame wrapped as FRAME_SYNC, length, frame, CRC-8 of length and
+// frame, once the sync byte has been read. A length over FRAME_MAX_LENGTH
+// or a bad CRC means it wasn't really a frame, so the search for one
+// starts again from the next sync byte after this one.
+static void commFramedReceive() {
+  // length, frame and CRC
+  static uint8_t buf[FRAME_MAX_LENGTH + 2];
+  while (true) {
+    uint8_t n = 0;
+    uint8_t len = buf[n++] = commReadByte();
+    bool ok = 0 < len && len <= FRAME_MAX_LENGTH;
+    if (ok) {
+      uint8_t crc = crc8Update(0, len);
+      for (uint8_t i = 0; i < len; i++) {
+        buf[n] = commReadByte();
+        crc = crc8Update(crc, buf[n++]);
+      }
+      buf[n] = commReadByte();
+      ok = buf[n++] == crc && buf[1] != FRAME_SYNC;
+    }
+
+    if (ok) {
+      framed = true;
+      frame_data = buf + 2;
+      frame_left = len - 1;
+      if (!commExtension(buf[1])) {
+        manager.dispatchFrame(buf + 1, len);
+      }
+      frame_data = 0;
+      frame_left = 0;
+    } else {
+      commResync(buf, n);
+    }
+
+    // carry on with the next sync byte among the kept bytes, if any
+    while (resync_pos < resync_len && resync_buf[resync_pos] != FRAME_SYNC) {
+      resync_pos++;
+    }
+    if (resync_pos == resync_len) {
+      resync_len = resync_pos = 0;
+      return;
+    }
+    resync_pos++;
+  }
+}
+
+void commHeartbeatReply(uint8_t amib, uint8_t seq) {
+  uint8_t reply[3] = {OPCODE_HEARTBEAT, amib, seq};
+  commSend(reply, sizeof(reply));
+}
+
+bool commExtension(uint8_t opcode) {
+  switch (opcode) {
+  case OPCODE_DEBUG_SETTING: {
+    uint8_t state = commReadByte();
+    uint8_t value = commReadByte();
+    uint8_t level = commReadByte();
+    bool applied = false;
+    if (state < 3) {
+      uint16_t first = report_offsets[state], end = report_offsets[state + 1];
+      if (value == DEBUG_ALL_VALUES) {
+        state_levels[state] = level;
+        for (uint16_t i = first; i < end; i++) {
+          report_levels[i] = level;
+        }
+        manager.relayDebugSetting(state, level);
+        applied = true;
+      } else if (first + value < end) {
+        report_levels[first + value] = level;
+        applied = true;
+      }
+    }
+    // echo the setting so the console knows it took effect, which a
+    // setting for a state or value that doesn't exist didn't
+    if (applied) {
+      uint8_t reply[4] = {OPCODE_DEBUG_SETTING, state, value, level};
+      commSend(reply, sizeof(reply));
+    }
+    return true;
+  }
+  case OPCODE_HEARTBEAT: {
+    uint8_t amib = commReadByte();
+    uint8_t seq = commReadByte();
+    if (amib == 0) {
+      commHeartbeatReply(0, seq);
+    } else {
+      // the slave echoes it back to us through commHeartbeatReply()
+      manager.relayHeartbeat(amib, seq);
+    }
+    return true;
+  }
+  case OPCODE_ACK: {
+    // frames are handled in order, so echoing the sequence number tells the
+    // console that everything it sent before this has been processed
+    uint8_t reply[2] = {OPCODE_ACK, commReadByte()};
+    commSend(reply, sizeof(reply));
+    return true;
+  }
+  case OPCODE_QUEUE_STATS: {
+    uint8_t reply[6] = {OPCODE_QUEUE_STATS};
+    commEventQueueStats(reply + 1, commReadByte() & QUEUE_STATS_RESET);
+    commSend(reply, sizeof(reply));
+    return true;
+  }
+  case OPCODE_PROFILE: {
+    uint8_t flags = commReadByte();
+    uint16_t slot = commReadByte();
+    slot |= commReadByte() << 8;
+    uint8_t reply[15] = {OPCODE_PROFILE};
+    commProfileCounters(reply + 1, slot, flags & PROFILE_RESET);
+    commSend(reply, sizeof(reply));
+    return true;
+  }
+  case FRAME_SYNC:
+    commFramedReceive();
+    return true;
+  default:
+    return false;
+  }
+}
+
+#else
+void commBusEvent(uint8_t address, uint8_t state, uint8_t event) {
+  manager.sendSlaveEvent(address, event);
+}
+
+#endif
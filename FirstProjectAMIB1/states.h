@@ -81,3 +81,53 @@ enum State {
 };
 
 extern MasterManager<State, 3, 2> manager;
+
+// Everything below needs a Manager library that calls these hooks and
+// defines MANAGER_COMM_HOOKS. Built against one that doesn't, states.cpp
+// constructs the manager the original way and leaves the console
+// extensions (debug settings, heartbeats, acks, framing, reporting
+// policies, bus scheduling, event queue and profile queries) out. Its
+// build ID then has the top bit flipped, so the console knows not to use
+// them.
+
+// Called by the manager for opcodes it doesn't handle itself. Returns false
+// if the opcode isn't known here either.
+bool commExtension(uint8_t opcode);
+
+// Called by the manager when a slave echoes a relayed heartbeat.
+void commHeartbeatReply(uint8_t amib, uint8_t seq);
+
+// Sends a frame to the console, framed if the console asked for framing.
+void commSend(const uint8_t *frame, uint8_t len);
+
+// Reporting verbosity set from the console, 0 means muted. The manager
+// passes a value's bytes to commShouldReport() before sending it to the
+// tablet, which applies the verbosity and the value's reporting policy.
+// States can check their own level before sending anything else.
+uint8_t commReportLevel(uint8_t state);
+bool commShouldReport(uint8_t state, uint8_t value, const uint8_t *data, uint8_t size);
+
+// Called by the manager from loop(). Sends values their reporting policy
+// held back and resends periodic ones.
+void commLoop();
+
+// Slaves from hardware.json. Remote values and events name their slave by
+// bus address, and the manager finds the slave's entry in slave_addresses
+// with commSlaveIndex(), which returns NO_SLAVE for unknown addresses.
+static const uint8_t NUM_SLAVES = 0;
+static const uint8_t NO_SLAVE = 0xff;
+extern const uint8_t slave_addresses[];
+uint8_t commSlaveIndex(uint8_t address);
+
+// Traffic to slaves is scheduled rather than sent as it's made. Remote
+// events queue with commBusEvent(), and the manager passes remote value
+// writes to commBusValue(). commLoop() then sends every queued event
+// before a bounded number of value refreshes, visiting slaves in the
+// polling order from hardware.json within each slave's byte budget.
+void commBusEvent(uint8_t address, uint8_t state, uint8_t event);
+void commBusValue(uint8_t address, uint8_t state, uint8_t value, const uint8_t *data, uint8_t size);
+
+// With "eventQueue" set in hardware.json, each state's event() queues the
+// event here and commLoop() runs one queued event per loop, so the link is
+// still read while a long handler runs.
+void commQueueEvent(uint8_t state, uint8_t ev);
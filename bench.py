@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+# Throughput benchmarks for the serial protocol. Generates a console for a
+# synthetic schema with one value of every type, runs it against sim.py on
+# a pty and measures frames per second, bytes per second and console CPU
+# time per frame for each send path and the receive path.
+#
+# Usage: python bench.py [-o results.json] [--compare baseline.json]
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import struct
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import gen
+import sim
+
+TYPES = ['bool', 'uint8_t', 'int8_t', 'uint16_t', 'int16_t', 'uint32_t', 'int32_t']
+
+BENCH_COMM = """class IDLE:
+    pass
+
+class BENCH:
+    def master():
+        def events():
+            ping
+        def values():
+%(master_values)s
+    def tablet():
+        def values():
+%(tablet_values)s
+"""
+
+SAMPLE_VALUES = {
+    'bool': 'true',
+    'uint8_t': '200',
+    'int8_t': '-100',
+    'uint16_t': '60000',
+    'int16_t': '-30000',
+    'uint32_t': '4000000000',
+    'int32_t': '-2000000000',
+}
+
+def size_of(ty):
+    return struct.calcsize(sim.STRUCT_TYPES[ty])
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class Bench(object):
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.comm = os.path.join(workdir, 'Bench.comm')
+        open(self.comm, 'wb').write(BENCH_COMM % {
+            'master_values': '\n'.join('            v_%s = %s' % (ty, ty) for ty in TYPES),
+            'tablet_values': '\n'.join('            t_%s = %s' % (ty, ty) for ty in TYPES),
+        })
+        _, states = gen.parse(self.comm)
+        self.build_id = gen.compute_build_id(states)
+        gen.generate_tablet(states, self.build_id)
+        console = os.path.join(workdir, 'bench_console.py')
+        open(console, 'wb').write(gen.generate_debug(states, self.build_id))
+        self.console = imp.load_source('bench_console', console)
+        self.sim = None
+
+    def start_sim(self, baud, rate=None):
+        self.stop_sim()
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim.py'),
+               self.comm, '--build-id', '%x' % self.build_id]
+        if baud:
+            cmd += ['--baud', str(baud)]
+        if rate:
+            cmd += ['--rate', rate]
+        self.sim = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        while True:
+            line = self.sim.stdout.readline()
+            if not line:
+                raise RuntimeError("simulator failed to start")
+            if line.startswith('Simulated AMIB on '):
+                path = line.split()[-1]
+                break
+
+        if self.console.port is not None:
+            self.console.disconnect()
+        self.console.connect(path)
+        self.console.set_state('BENCH')
+
+    def stop_sim(self):
+        if self.sim is not None:
+            self.sim.kill()
+            self.sim.wait()
+            self.sim = None
+
+    # Waits until the simulator has handled everything sent so far. Frames
+    # are handled in order, so a heartbeat echo means the burst is done.
+    def sync(self):
+        if not self.console.heartbeats.ping(1, 1.0, 0, timeout=60):
+            raise RuntimeError("simulator stopped responding")
+
+    def send(self, op, ty, baud, burst):
+        self.start_sim(baud)
+        if op == 'set_value':
+            call = lambda: self.console.set_value('v_' + ty, SAMPLE_VALUES[ty])
+            frame_size = 3 + size_of(ty)
+        elif op == 'set_event':
+            call = lambda: self.console.set_event('ping')
+            frame_size = 3
+        else:
+            call = lambda: self.console.set_state('BENCH')
+            frame_size = 2
+
+        self.sync()
+        start, start_cpu = time.time(), cpu_time()
+        for _ in xrange(burst):
+            call()
+        self.sync()
+        return self.result('send', op, ty, baud, burst, burst, burst * frame_size, start, start_cpu)
+
+    def recv(self, ty, baud, duration):
+        self.start_sim(baud, 'BENCH.t_%s=0' % ty)
+        time.sleep(0.1)
+        handler = self.console.handler
+        start, start_cpu, start_frames = time.time(), cpu_time(), handler.frames
+        time.sleep(duration)
+        frames = handler.frames - start_frames
+        return self.result('recv', 'RecvHandler', ty, baud, None, frames, frames * (3 + size_of(ty)), start, start_cpu)
+
+    def result(self, path, op, ty, baud, burst, frames, nbytes, start, start_cpu):
+        elapsed = time.time() - start
+        cpu = cpu_time() - start_cpu
+        return {
+            'path': path,
+            'op': op,
+            'type': ty,
+            'baud': baud,
+            'burst': burst,
+            'frames': frames,
+            'bytes': nbytes,
+            'seconds': elapsed,
+            'fps': frames / elapsed,
+            'bps': nbytes / elapsed,
+            'cpu_us_per_frame': 1e6 * cpu / frames if frames else None,
+        }
+
+def key(r):
+    return (r['path'], r['op'], r['type'], r['baud'], r['burst'])
+
+def describe(r):
+    return '%-4s %-12s %-9s %7s %5s' % (r['path'], r['op'], r['type'] or '-', r['baud'] or 'max', r['burst'] or '-')
+
+def print_result(r, out):
+    cpu = '%10.1f' % r['cpu_us_per_frame'] if r['cpu_us_per_frame'] is not None else '%10s' % '-'
+    print >>out, '%s %10.1f %10.1f %s' % (describe(r), r['fps'], r['bps'], cpu)
+
+def compare(results, baseline, threshold, out):
+    # Prints the change in frames per second against an earlier run and
+    # returns the number of configurations that got slower than |threshold|.
+    old = dict((key(r), r) for r in baseline)
+    regressions = 0
+    for r in results:
+        before = old.get(key(r))
+        if before is None or not before['fps']:
+            continue
+        change = (r['fps'] - before['fps']) / before['fps']
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print >>out, '%s %+7.1f%%%s' % (describe(r), change * 100, flag)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the console protocol against a simulated AMIB")
+    parser.add_argument('--baud', type=int, action='append', help="baud rates to simulate, 0 for unthrottled (default 9600, 115200 and 0)")
+    parser.add_argument('--type', action='append', choices=TYPES, help="value types to test (default all)")
+    parser.add_argument('--burst', type=int, action='append', help="number of commands per send burst (default 16 and 256)")
+    parser.add_argument('--duration', type=float, default=1.0, help="seconds to measure the receive path for")
+    parser.add_argument('-o', '--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="compare against results from an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown counted as a regression (default 0.1)")
+    args = parser.parse_args()
+
+    bauds = args.baud or [9600, 115200, 0]
+    types = args.type or TYPES
+    bursts = args.burst or [16, 256]
+
+    out = sys.stdout
+    # the console prints every value it receives
+    sys.stdout = open(os.devnull, 'w')
+
+    workdir = tempfile.mkdtemp()
+    bench = Bench(workdir)
+    results = []
+    print >>out, '%-4s %-12s %-9s %7s %5s %10s %10s %10s' % ('path', 'op', 'type', 'baud', 'burst', 'frames/s', 'bytes/s', 'cpu us/f')
+    try:
+        for baud in bauds:
+            for burst in bursts:
+                for ty in types:
+                    results.append(bench.send('set_value', ty, baud, burst))
+                    print_result(results[-1], out)
+                for op in ('set_event', 'set_state'):
+                    results.append(bench.send(op, None, baud, burst))
+                    print_result(results[-1], out)
+            for ty in types:
+                results.append(bench.recv(ty, baud, args.duration))
+                print_result(results[-1], out)
+    finally:
+        if bench.console.port is not None:
+            bench.console.disconnect()
+        bench.stop_sim()
+        shutil.rmtree(workdir)
+
+    if args.output:
+        json.dump({'time': time.time(), 'results': results}, open(args.output, 'wb'), indent=2)
+
+    if args.compare:
+        print >>out
+        if compare(results, json.load(open(args.compare, 'rb'))['results'], args.threshold, out):
+            sys.exit(1)
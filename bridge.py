@@ -0,0 +1,377 @@
+#!/usr/bin/env python2
+# Shares one master AMIB between any number of local clients. The bridge
+# owns the serial port, does the build ID and state handshakes once, splits
+# the traffic in both directions into whole frames and sends every frame
+# from the board to every client. Clients get their handshakes answered
+# from the bridge, and heartbeat and ack replies go back only to the client
+# that asked for them.
+#
+# Clients speak the unframed console protocol over TCP or a Unix socket, so
+# the console attaches with: python debug.py socket://localhost:5331
+#
+# Usage: python bridge.py [/dev/ttyACM0] [--comm consolenn.comm] [--tcp HOST:PORT] [--unix PATH] [-f]
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import argparse
+import threading
+
+import serial
+import serial.tools.list_ports
+
+import gen
+import sim
+
+DEFAULT_TCP = 'localhost:5331'
+
+# Frame lengths by opcode in each direction. Value frames aren't listed
+# since their length depends on the value.
+TO_BOARD_LENGTHS = {
+    0: 2,
+    1: 3,
+    gen.OPCODE_DEBUG_SETTING: 4,
+    gen.OPCODE_HEARTBEAT: 3,
+    5: 1,
+    6: 1,
+    gen.OPCODE_ACK: 2,
+    gen.OPCODE_QUEUE_STATS: 2,
+    gen.OPCODE_PROFILE: 4,
+}
+FROM_BOARD_LENGTHS = {
+    1: 3,
+    gen.OPCODE_DEBUG_SETTING: 4,
+    gen.OPCODE_HEARTBEAT: 3,
+    5: 5,
+    6: 2,
+    gen.OPCODE_ACK: 2,
+    gen.OPCODE_QUEUE_STATS: 6,
+    gen.OPCODE_PROFILE: 15,
+}
+
+def value_sizes(states, device):
+    # Maps (state id, value id) to the size of each of |device|'s values.
+    sizes = {}
+    for state_id, devices in enumerate(states.values()):
+        values = devices[device].values if device in devices else {}
+        for value_id, ty in enumerate(values.values()):
+            sizes[state_id, value_id] = struct.calcsize(sim.STRUCT_TYPES[ty])
+    return sizes
+
+class FrameSplitter(object):
+    # Splits an unframed byte stream into whole frames. Bytes that can't
+    # start a frame are skipped.
+    def __init__(self, lengths, sizes):
+        self.lengths   = lengths
+        self.sizes     = sizes
+        self.pending   = ''
+        self.bad_bytes = 0
+
+    # Returns the length of the frame at the start of |data|, 0 if that
+    # isn't known yet or None if it isn't a frame.
+    def length(self, data):
+        op = ord(data[0])
+        if op != gen.OPCODE_VALUE:
+            return self.lengths.get(op)
+        if len(data) < 3:
+            return 0
+        size = self.sizes.get((ord(data[1]), ord(data[2])))
+        if size is None:
+            return None
+        return 3 + size
+
+    def feed(self, s):
+        data = self.pending + s
+        frames = []
+        pos = 0
+        while pos < len(data):
+            length = self.length(data[pos:pos + 3])
+            if length is None:
+                self.bad_bytes += 1
+                pos += 1
+                continue
+            if length == 0 or pos + length > len(data):
+                break
+            frames.append(data[pos:pos + length])
+            pos += length
+        self.pending = data[pos:]
+        return frames
+
+class FramedSplitter(object):
+    # Unwraps frames sent as FRAME_SYNC, length, frame, CRC-8, skipping to
+    # the next sync byte after a bad one.
+    def __init__(self):
+        self.pending   = ''
+        self.bad_bytes = 0
+
+    def feed(self, s):
+        data = self.pending + s
+        frames = []
+        pos = 0
+        while True:
+            start = data.find(chr(gen.FRAME_SYNC), pos)
+            if start < 0:
+                pos = len(data)
+                break
+            if start + 2 > len(data):
+                pos = start
+                break
+            length = ord(data[start + 1])
+            end = start + 2 + length + 1
+            if length > gen.FRAME_MAX_LENGTH:
+                end = start + 2
+            elif end > len(data):
+                pos = start
+                break
+            if 0 < length <= gen.FRAME_MAX_LENGTH and ord(data[end - 1]) == sim.crc8(data[start + 1:end - 1]):
+                frames.append(data[start + 2:end - 1])
+                pos = end
+            else:
+                self.bad_bytes += 1
+                pos = start + 1
+        self.pending = data[pos:]
+        return frames
+
+class Client(object):
+    def __init__(self, bridge, sock, name):
+        self.bridge   = bridge
+        self.sock     = sock
+        self.name     = name
+        self.lock     = threading.Lock()
+        self.splitter = FrameSplitter(TO_BOARD_LENGTHS, bridge.to_board_sizes)
+
+    def send(self, frame):
+        self.lock.acquire()
+        try:
+            self.sock.sendall(frame)
+        except socket.error:
+            # the reader notices the client is gone and cleans up
+            pass
+        finally:
+            self.lock.release()
+
+    def serve(self):
+        try:
+            while True:
+                s = self.sock.recv(4096)
+                if not s:
+                    break
+                for frame in self.splitter.feed(s):
+                    self.bridge.from_client(self, frame)
+        except socket.error:
+            pass
+        finally:
+            self.bridge.remove(self)
+            self.sock.close()
+
+class Bridge(object):
+    def __init__(self, port, states, framed=False, verbose=False):
+        self.port           = port
+        self.framed         = framed
+        self.verbose        = verbose
+        self.to_board_sizes = value_sizes(states, 'master')
+        self.splitter       = FramedSplitter() if framed else FrameSplitter(FROM_BOARD_LENGTHS, value_sizes(states, 'tablet'))
+        self.write_lock     = threading.Lock()
+        self.clients        = []
+        self.clients_lock   = threading.Lock()
+        self.build_id       = None
+        # what a master built without MANAGER_COMM_HOOKS reports, which
+        # can't take framed frames
+        self.basic_build_id = gen.compute_build_id(states) ^ gen.BUILD_ID_BASIC
+        self.state          = None
+
+        # heartbeats and acks are renumbered on the way to the board so that
+        # replies can be sent back to the client that asked, by (opcode,
+        # bridge's sequence number)
+        self.seqs    = {gen.OPCODE_HEARTBEAT: 0, gen.OPCODE_ACK: 0}
+        self.replies = {}
+
+    def log(self, msg):
+        if self.verbose:
+            print >>sys.stderr, msg
+
+    def handshake(self):
+        self.port.write('\x05')
+        if self.port.read(1) != '\x05':
+            raise IOError("board didn't answer the build ID handshake")
+        self.build_id, = struct.unpack('<I', self.port.read(4))
+
+        self.port.write('\x06')
+        if self.port.read(1) != '\x06':
+            raise IOError("board didn't answer the state handshake")
+        self.state = ord(self.port.read(1))
+
+        if self.framed and self.build_id == self.basic_build_id:
+            raise IOError("board was built without MANAGER_COMM_HOOKS, so it can't be framed")
+        if self.framed:
+            # the board only frames its replies once it has seen a framed frame
+            self.write(chr(gen.OPCODE_HEARTBEAT) + '\x00\x00')
+
+    def write(self, frame):
+        self.write_lock.acquire()
+        try:
+            self.port.write(sim.frame(frame) if self.framed else frame)
+        finally:
+            self.write_lock.release()
+
+    def add(self, client):
+        self.clients_lock.acquire()
+        self.clients.append(client)
+        self.clients_lock.release()
+        self.log("%s connected" % client.name)
+
+    def remove(self, client):
+        self.clients_lock.acquire()
+        self.clients.remove(client)
+        for (key, (owner, _)) in self.replies.items():
+            if owner is client:
+                del self.replies[key]
+        self.clients_lock.release()
+        self.log("%s disconnected" % client.name)
+
+    def from_client(self, client, frame):
+        op = ord(frame[0])
+        if op == 5:
+            client.send('\x05' + struct.pack('<I', self.build_id))
+            return
+        if op == 6:
+            client.send('\x06' + chr(self.state))
+            return
+        if op == 0:
+            self.state = ord(frame[1])
+        elif op in self.seqs:
+            self.clients_lock.acquire()
+            seq = self.seqs[op] = (self.seqs[op] + 1) & 0xff
+            self.replies[op, seq] = (client, frame[-1])
+            self.clients_lock.release()
+            frame = frame[:-1] + chr(seq)
+        self.write(frame)
+
+    def from_board(self, frame):
+        op = ord(frame[0])
+        self.clients_lock.acquire()
+        try:
+            if op in self.seqs:
+                owner = self.replies.pop((op, ord(frame[-1])), None)
+                if owner is not None:
+                    client, seq = owner
+                    client.send(frame[:-1] + seq)
+                return
+            for client in self.clients:
+                client.send(frame)
+        finally:
+            self.clients_lock.release()
+
+    def read_board(self):
+        while True:
+            try:
+                s = self.port.read(self.port.in_waiting or 1)
+            except serial.SerialException:
+                s = ''
+            if not s:
+                break
+            for frame in self.splitter.feed(s):
+                self.from_board(frame)
+        print >>sys.stderr, "Lost the board, exiting..."
+        os._exit(1)
+
+    def listen(self, server, describe):
+        while True:
+            sock, addr = server.accept()
+            client = Client(self, sock, describe(addr))
+            self.add(client)
+            t = threading.Thread(target=client.serve)
+            t.daemon = True
+            t.start()
+
+    def start(self, servers):
+        # |servers| is a list of (listening socket, function naming a peer)
+        threads = [threading.Thread(target=self.read_board)]
+        threads += [threading.Thread(target=self.listen, args=server) for server in servers]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+def tcp_server(address):
+    host, port = address.rsplit(':', 1)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, int(port)))
+    server.listen(5)
+    return server, lambda addr: 'tcp %s:%d' % addr
+
+def unix_server(path):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(5)
+    return server, lambda addr: 'unix client'
+
+def find_port(hardware):
+    if 'master' in hardware:
+        master = hardware['AMIBs'][hardware['master']]
+    else:
+        master = min((int(name[4:]), serial) for (name, serial) in hardware['AMIBs'].items())[1]
+    for port in serial.tools.list_ports.comports():
+        if port.serial_number == master['serialNumber']:
+            return port.device
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Share one master AMIB between several local clients")
+    parser.add_argument('port', nargs='?', help="serial port of the master AMIB, found from hardware.json by default")
+    parser.add_argument('--comm', help="the .comm file, found from hardware.json by default")
+    parser.add_argument('--tcp', action='append', default=[], metavar='HOST:PORT', help="listen for clients on this TCP address (default %s)" % DEFAULT_TCP)
+    parser.add_argument('--unix', action='append', default=[], metavar='PATH', help="listen for clients on this Unix socket")
+    parser.add_argument('-f', '--framed', action='store_true', help="frame traffic to the board with a sync byte, length and CRC")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print clients connecting and disconnecting")
+    args = parser.parse_args()
+
+    hardware = None
+    if args.port is None or args.comm is None:
+        try:
+            hardware = json.load(open("hardware.json", 'rb'))
+            comm_file = args.comm or hardware['name'] + ".comm"
+            com_port = args.port or find_port(hardware)
+        except (IOError, ValueError, IndexError, KeyError):
+            print >>sys.stderr, "Must either have valid hardware.json or give a port and .comm file"
+            sys.exit(1)
+        if com_port is None:
+            print >>sys.stderr, "Master AMIB not connected"
+            sys.exit(2)
+    else:
+        comm_file, com_port = args.comm, args.port
+
+    _, states = gen.parse(comm_file)
+
+    port = serial.serial_for_url(com_port, 9600)
+    # opening the port resets the board
+    time.sleep(1)
+    bridge = Bridge(port, states, args.framed, args.verbose)
+    try:
+        bridge.handshake()
+    except IOError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    if bridge.build_id not in (gen.compute_build_id(states), bridge.basic_build_id):
+        print >>sys.stderr, "Warning: board was built from a different version of %s" % comm_file
+
+    tcp = args.tcp or ([] if args.unix else [DEFAULT_TCP])
+    servers = [tcp_server(address) for address in tcp]
+    servers += [unix_server(path) for path in args.unix]
+    bridge.start(servers)
+    print "Build ID: %08x" % bridge.build_id
+    for address in tcp:
+        print "Listening on socket://%s" % address
+    for path in args.unix:
+        print "Listening on %s" % path
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for path in args.unix:
+            os.unlink(path)
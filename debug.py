@@ -3,26 +3,70 @@ import re
 import sys
 import json
 import time
+import bisect
 import struct
-try:
-    import readline
-except ImportError:
-    import pyreadline as readline
+import argparse
 import threading
 from collections import OrderedDict, namedtuple
 import os
 
 import serial
 import serial.tools.list_ports
+try:
+    import numpy
+except ImportError:
+    # only needed for the stats command
+    numpy = None
 
 State = namedtuple('State', ('name', 'id', 'devices'))
-DeviceState = namedtuple('DeviceState', ('values', 'events'))
+DeviceState = namedtuple('DeviceState', ('values', 'events', 'policies'))
+ReportPolicy = namedtuple('ReportPolicy', ('on_change', 'max_rate', 'period_ms'))
+
+STATES = [State(name='IDLE', id=0, devices={'master': DeviceState(values={}, events=[], policies={}), 'tablet': DeviceState(values={}, events=[], policies={})}), State(name='MOTIONMACHINE', id=1, devices={'master': DeviceState(values=OrderedDict([('stepperPosition', 'uint32_t')]), events=['moveLiftUp', 'moveToBottom', 'setLiftToZero', 'runSteps', 'stopSteps'], policies={}), 'tablet': DeviceState(values=OrderedDict(), events=['finishedAction'], policies={})}), State(name='ARM', id=2, devices={'master': DeviceState(values=OrderedDict([('rotations', 'uint32_t')]), events=['moveFromTallToShort', 'moveFromShortToTall', 'disableElectromagnet', 'enableElectromagnet', 'lowerArm', 'raiseArm', 'resetArmPosition', 'moveArm'], policies={}), 'tablet': DeviceState(values=OrderedDict(), events=['finishedAction'], policies={})})]
+
+# Names sorted with their ids, by state id where they belong to a state, so
+# that looking up or completing a name doesn't scan them all.
+SORTED_STATES = [('ARM', 2), ('IDLE', 0), ('MOTIONMACHINE', 1)]
+SORTED_MASTER_VALUES = [[], [('stepperPosition', 0)], [('rotations', 0)]]
+SORTED_MASTER_EVENTS = [[], [('moveLiftUp', 0), ('moveToBottom', 1), ('runSteps', 3), ('setLiftToZero', 2), ('stopSteps', 4)], [('disableElectromagnet', 2), ('enableElectromagnet', 3), ('lowerArm', 4), ('moveArm', 7), ('moveFromShortToTall', 1), ('moveFromTallToShort', 0), ('raiseArm', 5), ('resetArmPosition', 6)]]
+SORTED_TABLET_VALUES = [[], [], []]
+
+# Finds names and the ranges of names starting with a prefix by bisecting
+# a sorted list of (name, item).
+class NameIndex(object):
+    def __init__(self, pairs):
+        self.names = [name for (name, _) in pairs]
+        self.items = dict(pairs)
+
+    def __contains__(self, name):
+        return name in self.items
+
+    def get(self, name, default=None):
+        return self.items.get(name, default)
 
-STATES = [State(name='IDLE', id=0, devices={'master': DeviceState(values={}, events=[]), 'tablet': DeviceState(values={}, events=[])}), State(name='MOTIONMACHINE', id=1, devices={'master': DeviceState(values=OrderedDict([('stepperPosition', 'uint32_t')]), events=['moveLiftUp', 'moveToBottom', 'setLiftToZero', 'runSteps', 'stopSteps']), 'tablet': DeviceState(values=OrderedDict(), events=['finishedAction'])}), State(name='ARM', id=2, devices={'master': DeviceState(values=OrderedDict([('rotations', 'uint32_t')]), events=['moveFromTallToShort', 'moveFromShortToTall', 'disableElectromagnet', 'enableElectromagnet', 'lowerArm', 'raiseArm', 'resetArmPosition', 'moveArm']), 'tablet': DeviceState(values=OrderedDict(), events=['finishedAction'])})]
+    def range(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix + '\xff', lo)
+        return lo, hi
 
-if len(sys.argv) > 2:
-    print >>sys.stderr, "Usage: python gen.py [serialport]"
-    sys.exit(1)
+    def matches(self, prefix):
+        lo, hi = self.range(prefix)
+        return self.names[lo:hi]
+
+    # The longest prefix shared by every name starting with |prefix|, or
+    # None if there are none. The names are sorted, so that's the prefix
+    # the first and last of them share.
+    def common_prefix(self, prefix):
+        lo, hi = self.range(prefix)
+        if lo == hi:
+            return None
+        return os.path.commonprefix([self.names[lo], self.names[hi - 1]])
+
+STATE_INDEX = NameIndex([(name, STATES[i]) for (name, i) in SORTED_STATES])
+MASTER_VALUE_INDEX = [NameIndex([(name, (i, state.devices['master'].values[name])) for (name, i) in names])
+                      for (state, names) in zip(STATES, SORTED_MASTER_VALUES)]
+MASTER_EVENT_INDEX = [NameIndex(names) for names in SORTED_MASTER_EVENTS]
+TABLET_VALUE_INDEX = [NameIndex(names) for names in SORTED_TABLET_VALUES]
 
 def comm_error():
     print >>sys.stderr, "Communications error, exiting..."
@@ -59,12 +103,329 @@ def parse_val(ty, s):
     else:
         raise ValueError("unknown type %r" % ty)
 
-if len(sys.argv) == 2:
-    com_port = sys.argv[1]
-else:
+# time.monotonic() only exists on Python 3, so read the OS clock through
+# ctypes: CLOCK_MONOTONIC on Linux and the performance counter on Windows.
+# Anywhere else os.times() has the elapsed real time, which doesn't follow
+# the wall clock either but only ticks at 100Hz. The zero point is
+# arbitrary, so only differences between timestamps mean anything.
+def make_monotonic():
+    import ctypes
+    import ctypes.util
+    if sys.platform.startswith('linux'):
+        CLOCK_MONOTONIC = 1
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        timespec = ctypes.c_long * 2
+        def monotonic():
+            ts = timespec()
+            if libc.clock_gettime(CLOCK_MONOTONIC, ts) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts[0] + ts[1] * 1e-9
+        return monotonic
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        frequency = ctypes.c_int64()
+        kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+        def monotonic():
+            counter = ctypes.c_int64()
+            kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value / float(frequency.value)
+        return monotonic
+    return lambda: os.times()[4]
+monotonic = make_monotonic()
+
+TELEMETRY_MAGIC  = 'AMIBTLM1'
+TELEMETRY_HEADER = '<8sII'
+TELEMETRY_RECORD = '<dBBBx4s'
+
+# Appends every received value to a fixed-record binary log (see
+# telemetry.py for the reader). Records are packed in memory and written
+# out in batches, and the file is grown in large preallocated chunks so
+# long soak runs don't pay for a resize on every write.
+class TelemetryRecorder(object):
+    def __init__(self, path, build_id, batch_size=256, prealloc=65536):
+        self.path       = path
+        self.build_id   = build_id
+        self.batch_size = batch_size
+        self.prealloc   = prealloc
+        self.lock       = threading.Lock()
+        self.pending    = []
+        self.count      = 0
+        self.capacity   = 0
+        self.f          = open(path, 'w+b')
+        self.header_size = struct.calcsize(TELEMETRY_HEADER)
+        self.record_size = struct.calcsize(TELEMETRY_RECORD)
+        self._write_header()
+        self._grow(self.prealloc)
+
+    def _write_header(self):
+        self.f.seek(0)
+        self.f.write(struct.pack(TELEMETRY_HEADER, TELEMETRY_MAGIC, self.build_id, self.count))
+
+    def _grow(self, records):
+        self.capacity += records
+        self.f.truncate(self.header_size + self.capacity * self.record_size)
+
+    def record(self, state_id, value_id, raw):
+        rec = struct.pack(TELEMETRY_RECORD, monotonic(), state_id, value_id, len(raw), raw)
+        self.lock.acquire()
+        try:
+            # values can still arrive while "record" is stopping
+            if self.f.closed:
+                return
+            self.pending.append(rec)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        while self.count + len(self.pending) > self.capacity:
+            self._grow(self.prealloc)
+        self.f.seek(self.header_size + self.count * self.record_size)
+        self.f.write(''.join(self.pending))
+        self.count += len(self.pending)
+        self.pending = []
+        self._write_header()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f.closed:
+                return
+            self._flush()
+            self.f.truncate(self.header_size + self.count * self.record_size)
+            self.f.close()
+        finally:
+            self.lock.release()
+
+recorder = None
+
+SESSION_MAGIC  = 'AMIBSES1'
+SESSION_HEADER = '<8sIB'
+SESSION_RECORD = '<dBB'
+SESSION_OUT    = 0
+SESSION_IN     = 1
+
+# Records every command sent and every frame received, for replay.py.
+# Frames that arrive after close(), such as while the "session" command is
+# stopping a recording, are dropped.
+class SessionRecorder(object):
+    def __init__(self, path, build_id, state_id):
+        self.path   = path
+        self.lock   = threading.Lock()
+        self.count  = 0
+        self.closed = False
+        self.f      = open(path, 'wb')
+        self.f.write(struct.pack(SESSION_HEADER, SESSION_MAGIC, build_id, state_id))
+        self.start  = monotonic()
+
+    def record(self, direction, frame):
+        rec = struct.pack(SESSION_RECORD, monotonic() - self.start, direction, len(frame)) + frame
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self.f.write(rec)
+                self.count += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self.f.close()
+        finally:
+            self.lock.release()
+
+session = None
+
+TRACE_PID      = 1
+TRACE_STATE    = 1
+TRACE_COMMANDS = 2
+TRACE_BOARD    = 3
+
+# Writes a timeline of the session in the Chrome trace event format, for
+# chrome://tracing or ui.perfetto.dev. Each state is a span, commands and
+# tablet events are instants and received values are counters. Callers only
+# append to a list; a background thread formats and writes the events in
+# batches so tracing doesn't hold up the receive thread.
+class TraceWriter(object):
+    def __init__(self, path, build_id, interval=0.2, max_pending=100000):
+        self.path        = path
+        self.interval    = interval
+        self.max_pending = max_pending
+        self.lock        = threading.Lock()
+        self.pending     = []
+        self.count       = 0
+        self.dropped     = 0
+        self.span        = None
+        self.first       = True
+        self.f           = open(path, 'wb')
+        self.f.write('[\n')
+        self.start       = monotonic()
+        self.stopping    = threading.Event()
+
+        self._metadata('process_name', 0, 'master AMIB %08x' % build_id)
+        for (tid, name) in ((TRACE_STATE, 'state'), (TRACE_COMMANDS, 'commands'), (TRACE_BOARD, 'board')):
+            self._metadata('thread_name', tid, name)
+            self._metadata('thread_sort_index', tid, tid)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _metadata(self, name, tid, value):
+        key = 'sort_index' if name.endswith('sort_index') else 'name'
+        self._write_events([{'name': name, 'ph': 'M', 'pid': TRACE_PID, 'tid': tid, 'args': {key: value}}])
+
+    def _append(self, event):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+        else:
+            self.pending.append(event)
+
+    # Ends the span of the previous state and starts one for |name|.
+    def state(self, name, cause):
+        now = monotonic()
+        self.lock.acquire()
+        try:
+            if self.span is not None:
+                self._append((now, 'E', TRACE_STATE, self.span, None))
+            self._append((now, 'B', TRACE_STATE, name, {'cause': cause}))
+            self.span = name
+        finally:
+            self.lock.release()
+
+    def instant(self, tid, name, args=None):
+        event = (monotonic(), 'i', tid, name, args)
+        self.lock.acquire()
+        self._append(event)
+        self.lock.release()
+
+    def counter(self, name, value):
+        event = (monotonic(), 'C', 0, name, value)
+        self.lock.acquire()
+        self._append(event)
+        self.lock.release()
+
+    def _format(self, event):
+        t, ph, tid, name, args = event
+        out = {'name': name, 'ph': ph, 'ts': round((t - self.start) * 1e6, 1), 'pid': TRACE_PID, 'tid': tid}
+        if ph == 'C':
+            # counters are named after STATE.value and chart one series
+            out['args'] = {'value': int(args) if isinstance(args, bool) else args}
+        elif args is not None:
+            out['args'] = args
+        if ph == 'i':
+            out['s'] = 't'
+        return out
+
+    def _write_events(self, events):
+        if not events:
+            return
+        lines = [json.dumps(event, separators=(',', ':')) for event in events]
+        self.f.write(('' if self.first else ',\n') + ',\n'.join(lines))
+        self.first = False
+        self.count += len(events)
+
+    def _flush(self):
+        self.lock.acquire()
+        events, self.pending = self.pending, []
+        self.lock.release()
+        self._write_events([self._format(event) for event in events])
+        self.f.flush()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.stopping.wait(self.interval)
+            self._flush()
+
+    def close(self):
+        self.lock.acquire()
+        if self.span is not None:
+            self._append((monotonic(), 'E', TRACE_STATE, self.span, None))
+            self.span = None
+        self.lock.release()
+        self.stopping.set()
+        self.thread.join()
+        self._flush()
+        self.f.write('\n]\n')
+        self.f.close()
+
+tracer = None
+
+# Fixed-size history of one received value, used by the stats command.
+# Pushing is the only per-sample work; all statistics are computed over the
+# whole buffer at once with NumPy.
+class ValueRing(object):
+    def __init__(self, capacity=4096):
+        self.lock     = threading.Lock()
+        self.times    = numpy.zeros(capacity)
+        self.values   = numpy.zeros(capacity)
+        self.capacity = capacity
+        self.next     = 0
+        self.total    = 0
+
+    def push(self, t, v):
+        self.lock.acquire()
+        self.times[self.next] = t
+        self.values[self.next] = v
+        self.next = (self.next + 1) % self.capacity
+        self.total += 1
+        self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            if self.total < self.capacity:
+                return self.times[:self.total].copy(), self.values[:self.total].copy()
+            return numpy.roll(self.times, -self.next), numpy.roll(self.values, -self.next)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        times, values = self.snapshot()
+        if len(values) == 0:
+            return None
+        gaps = numpy.diff(times)
+        span = times[-1] - times[0]
+        return {
+            'count':  self.total,
+            'min':    values.min(),
+            'max':    values.max(),
+            'mean':   values.mean(),
+            'stddev': values.std(),
+            'rate':   (len(times) - 1) / span if span > 0 else 0.0,
+            'jitter': gaps.std() if len(gaps) else 0.0,
+        }
+
+# (state id, value id) -> ValueRing, filled in by RecvHandler
+value_rings = {}
+
+STATS_HEADER = "%-20s %8s %12s %12s %12s %12s %9s %11s" % ('value', 'count', 'min', 'max', 'mean', 'stddev', 'rate(Hz)', 'jitter(ms)')
+
+def print_stats(names):
+    print STATS_HEADER
+    for (state_id, value_id), ring in sorted(value_rings.items()):
+        name = TABLET_VALUES[state_id][value_id][0]
+        if names and name not in names:
+            continue
+        st = ring.stats()
+        print "%-20s %8d %12g %12g %12g %12g %9.2f %11.3f" % (
+            name, st['count'], st['min'], st['max'], st['mean'],
+            st['stddev'], st['rate'], st['jitter'] * 1000)
+
+# Finds the serial port of the master AMIB listed in hardware.json.
+def find_port():
     try:
         hardware = json.load(open("hardware.json", 'rb'))
-        master = min((int(name[4:]), serial) for (name, serial) in hardware['AMIBs'].items())[1]
+        if 'master' in hardware:
+            master = hardware['AMIBs'][hardware['master']]
+        else:
+            master = min((int(name[4:]), serial) for (name, serial) in hardware['AMIBs'].items())[1]
         master_serial = master['serialNumber'].encode('utf-8')
     except (IOError, ValueError, IndexError, KeyError):
         print >>sys.stderr, "Non-existent or invalid hardware.json file"
@@ -72,31 +433,78 @@ else:
 
     for port in serial.tools.list_ports.comports():
         if port.serial_number == master_serial:
-            com_port = port.device
-            break
+            return port.device
     else:
         print >>sys.stderr, "Master AMIB not connected"
         sys.exit(2)
 
-port = serial.Serial(com_port, 9600)
+my_build_id = 0x6f22a0ba
 
-time.sleep(1)
+# A master built without MANAGER_COMM_HOOKS reports my_build_id with this
+# bit flipped. It only handles states, values and events, so connect()
+# clears comm_hooks and the commands that need more refuse to run.
+BUILD_ID_BASIC = 0x80000000
+comm_hooks     = True
+# the build ID the master reported, recorded with sessions
+board_build_id = None
 
-port.write("\x05")
-if port.read(1) != '\x05':
-    comm_error()
+port      = None
+cur_state = None
+handler   = None
 
-its_build_id, = struct.unpack("<I", port.read(4))
-my_build_id = 0x6f22a0ba
-if its_build_id != my_build_id:
-    print >>sys.stderr, "Mismatching build IDs: expected %#08x but got %#08x, exiting" % (my_build_id, its_build_id)
-    sys.exit(3)
+# Opens the port, checks the build ID, fetches the current state and starts
+# the receive thread.
+def connect(com_port):
+    global port, cur_state, handler, comm_hooks, board_build_id, framed
+
+    # a URL like socket://localhost:5331 attaches through bridge.py
+    port = serial.serial_for_url(com_port, 9600)
+
+    time.sleep(1)
+
+    port.write("\x05")
+    if port.read(1) != '\x05':
+        comm_error()
+
+    its_build_id, = struct.unpack("<I", port.read(4))
+    if its_build_id not in (my_build_id, my_build_id ^ BUILD_ID_BASIC):
+        print >>sys.stderr, "Mismatching build IDs: expected %#08x but got %#08x, exiting" % (my_build_id, its_build_id)
+        sys.exit(3)
+    board_build_id = its_build_id
+    comm_hooks = its_build_id == my_build_id
+    if framed and not comm_hooks:
+        print >>sys.stderr, "The master was built without MANAGER_COMM_HOOKS, so frames are sent unframed"
+        framed = False
+
+    port.write("\x06")
+    if port.read(1) != '\x06':
+        comm_error()
+
+    cur_state = STATES[ord(port.read(1))]
+    if tracer is not None:
+        tracer.state(cur_state.name, 'sync')
 
-port.write("\x06")
-if port.read(1) != '\x06':
-    comm_error()
+    if framed:
+        # the board only frames its replies once it has seen a framed
+        # frame, and a heartbeat does nothing else
+        write_frame(chr(OPCODE_HEARTBEAT) + '\x00\x00')
 
-cur_state = STATES[ord(port.read(1))]
+    handler = RecvHandler(port, framed)
+    handler.thread = threading.Thread(target=handler.handle)
+    handler.thread.daemon = True
+    handler.thread.start()
+    display.start()
+
+# Stops the display and receive threads and closes the port.
+def disconnect():
+    display.stop()
+    # without this the receive thread can still be blocked in read() while
+    # the interpreter shuts down, which prints a confusing traceback
+    handler.closing = True
+    if hasattr(port, 'cancel_read'):
+        port.cancel_read()
+        handler.thread.join(1)
+    port.close()
 
 CMDS = [
     'event',
@@ -104,6 +512,16 @@ CMDS = [
     'state',
     'value',
     'test',
+    'record',
+    'session',
+    'trace',
+    'stats',
+    'ack',
+    'ping',
+    'queue',
+    'profile',
+    'verbosity',
+    'display',
     'quit'
 ]
 
@@ -112,6 +530,16 @@ HELP_TEXT = (
     "value [name] [value]: list values or change value\n"
     "event [name]: list events or send event\n"
     "test [name] [args]: run automated test\n"
+    "record [file]: start recording received values to file, or stop recording\n"
+    "session [file]: start recording a session for replay.py, or stop recording\n"
+    "trace [file]: start writing a Chrome/Perfetto timeline to file, or stop tracing\n"
+    "stats [names]: show statistics for received values\n"
+    "ack [on [window]|off]: show or change acknowledged sending\n"
+    "ping [count] [rate] [amib]: measure heartbeat round trips to the master or a slave\n"
+    "queue [reset]: show the master's deferred event queue, reset clears the high water mark\n"
+    "profile [reset]: show time spent in each state and event handler (gen.py --instrument), reset clears it\n"
+    "verbosity [state] [value] [level]: show or change firmware reporting, 0 mutes\n"
+    "display [fps]: show display counters or change the refresh rate, 0 hides values\n"
     "quit: quit"
 )
 
@@ -123,18 +551,26 @@ verbose_tests = True
 # method.
 class AutomatedTest(object):
     def __init__(self, name):
-        self.name = name
+        self.name     = name
+        self.duration = None
+        self.error    = None
 
     # Call this to run the test. Wraps test_function() with some error
-    # and exception handling.
+    # and exception handling, and records how long it took and why it
+    # failed.
     def run_test(self, args):
+        start = time.time()
         try:
             self.test_function(args)
+            self.error = None
             print self.name + ' finished'
             return True
         except Exception as e:
+            self.error = str(e)
             print '%s failed: %s' % (self.name, e)
             return False
+        finally:
+            self.duration = time.time() - start
 
     # Test runner function. Override this from subclasses. |args| is a list
     # of any additional args the user passed in. If the test fails, this
@@ -146,6 +582,9 @@ class AutomatedTest(object):
 #   1. Create a file named debug_tests.py.
 #   2. Create test classes in debug_tests.py that inherit from AutomatedTest.
 #   3. Add all test classes to a global list named TESTS.
+# Tests can use wait_for_value() and wait_for_event() (defined below) to
+# wait for the hardware to respond instead of sleeping. Names are either
+# "STATE.name" or a name in the current state.
 # Generally importing modules is much preferred to executing text like this,
 # but in this case we have some circular dependencies so importing won't work.
 # The best solution would be to break this file into parts so we can
@@ -165,64 +604,304 @@ class AllTests(AutomatedTest):
 	    if test is self:
 	        continue
 	    if not test.run_test(args):
-	        return False
+	        raise Exception('%s failed' % test.name)
 
 if TESTS:
     TESTS.append(AllTests('all'))
 
+TEST_INDEX = NameIndex(sorted((t.name, t) for t in TESTS or []))
+CMD_INDEX = NameIndex(sorted((c, c) for c in CMDS))
+
 def common_prefix(possible, prefix):
-    so_far = None
-    for opt in possible:
-        if opt.startswith(prefix):
-            if so_far == None:
-                so_far = opt
-            else:
-                # guaranteed not to get StopIteration because all possibilities must be different
-                i = next(i for (i, (c1, c2)) in enumerate(zip(so_far, opt)) if c1 != c2)
-                so_far = so_far[:i]
-    return so_far
+    return NameIndex(sorted((opt, opt) for opt in possible)).common_prefix(prefix)
+
+# The index of names the last word of |words| completes from, or None.
+def completion_index(cmd, args):
+    if len(args) == 0:
+        return CMD_INDEX
+    elif cmd == 'state' and len(args) == 1:
+        return STATE_INDEX
+    elif cmd == 'value' and len(args) == 1:
+        return MASTER_VALUE_INDEX[cur_state.id]
+    elif cmd == 'event' and len(args) == 1:
+        return MASTER_EVENT_INDEX[cur_state.id]
+    elif cmd == 'test' and len(args) == 1:
+        return TEST_INDEX
+    elif cmd == 'verbosity' and len(args) == 1:
+        return STATE_INDEX
+    elif cmd == 'verbosity' and len(args) == 2 and args[0] in STATE_INDEX:
+        return TABLET_VALUE_INDEX[STATE_INDEX.get(args[0]).id]
+    return None
+
+# readline calls complete() with state 0, 1, 2... until it returns None.
+# The range of matches is found once, on state 0, and then walked.
+completion_range = (None, 0, 0)
 
 def complete(text, state):
+    global completion_range
     words = readline.get_line_buffer().split(' ')
     cmd, args = words[0], words[1:]
 
-    if len(args) == 0:
-        if state != 0:
-            return None
-        if cmd == '':
+    if state == 0:
+        if cmd == '' and not args:
             print '\n' + HELP_TEXT
             readline.redisplay()
+            return None
+        index = completion_index(cmd, args)
+        if index is None:
+            completion_range = (None, 0, 0)
         else:
-            for possible in CMDS:
-                if possible.startswith(cmd):
-                    return possible
-            else:
-                return None
-    else:
-        if cmd == 'state':
-            possibilities = [st.name for st in STATES]
-        elif cmd == 'value':
-            if len(args) == 1:
-                possibilities = cur_state.devices['master'].values
-            else:
-                return None
-        elif cmd == 'event':
-            possibilities = cur_state.devices['master'].events
-        elif cmd == 'test':
-            possibilities = [t.name for t in TESTS]
+            completion_range = (index,) + index.range(words[-1])
+
+    index, lo, hi = completion_range
+    if index is None or lo + state >= hi:
+        return None
+    return index.names[lo + state]
+
+# Only the interactive prompt uses readline; scripts and tests don't load it.
+readline = None
+
+def setup_readline():
+    global readline
+    try:
+        import readline
+    except ImportError:
+        import pyreadline as readline
+    readline.set_completer(complete)
+    readline.parse_and_bind('tab: complete')
+
+stdout_lock = threading.Lock()
+
+# For output outside a command, which would otherwise land in the middle of
+# a line the display thread is writing.
+def locked_print(text):
+    stdout_lock.acquire()
+    try:
+        print text
+    finally:
+        stdout_lock.release()
+
+# False when running a script, so received values don't redraw a prompt.
+interactive = True
+
+# Received values aren't printed by the receive thread, which would then
+# block on the terminal. Instead they go into a table of latest values that
+# a separate thread prints at a fixed rate, so a value that changes faster
+# than that is only shown once per refresh. The table holds at most
+# |max_values| names and |max_messages| pending messages (incoming events);
+# |overflowed| counts updates turned away because it was full, and
+# |coalesced| counts values replaced before they were ever shown.
+class Display(object):
+    def __init__(self, fps=10.0, max_values=256, max_messages=256):
+        self.lock         = threading.Lock()
+        self.fps          = fps
+        self.max_values   = max_values
+        self.max_messages = max_messages
+        self.latest       = OrderedDict()
+        self.messages     = []
+        self.coalesced    = 0
+        self.overflowed   = 0
+        self.thread       = None
+        self.stopping     = threading.Event()
+        # set by --quiet, nothing received is shown
+        self.muted        = False
+
+    def update(self, name, value):
+        if self.muted:
+            return
+        self.lock.acquire()
+        if name in self.latest:
+            self.coalesced += 1
+            self.latest[name] = value
+        elif len(self.latest) < self.max_values:
+            self.latest[name] = value
         else:
-            return None
+            self.overflowed += 1
+        self.lock.release()
 
-        remaining = [thing for thing in possibilities if thing.startswith(args[0])]
-        if state < len(remaining):
-            return remaining[state]
+    def message(self, text):
+        if self.muted:
+            return
+        self.lock.acquire()
+        if len(self.messages) < self.max_messages:
+            self.messages.append(text)
         else:
-            return None
+            self.overflowed += 1
+        self.lock.release()
+
+    def render(self):
+        self.lock.acquire()
+        latest, self.latest = self.latest, OrderedDict()
+        messages, self.messages = self.messages, []
+        self.lock.release()
+        if not latest and not messages:
+            return
 
-readline.set_completer(complete)
-readline.parse_and_bind('tab: complete')
+        lines = messages + ["%s = %s" % item for item in latest.items()]
+        stdout_lock.acquire()
+        sys.stdout.write("\r" + "\n".join(lines) + "\n")
+        if interactive:
+            sys.stdout.write(cur_state.name + "> " + readline.get_line_buffer())
+        sys.stdout.flush()
+        stdout_lock.release()
 
-stdout_lock = threading.Lock()
+    def run(self):
+        while not self.stopping.is_set():
+            if self.fps > 0:
+                self.render()
+                self.stopping.wait(1.0 / self.fps)
+            else:
+                self.stopping.wait(0.1)
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Stops the refresh thread and shows anything it hadn't got to yet.
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.render()
+
+display = Display()
+
+class WaitTimeout(Exception):
+    pass
+
+# Everything RecvHandler decodes is published here, so tests and scripts
+# can block until a value or event arrives instead of sleeping. Values and
+# events are known as "STATE.name", since states can share names. Every
+# value and event published gets the next sequence number, so waits can
+# ignore anything published before the call, or before |since| from mark().
+class Registry(object):
+    def __init__(self):
+        self.cond        = threading.Condition()
+        # latest (value, sequence number) of each value
+        self.values      = {}
+        # (count, sequence number of the latest) of each event
+        self.events      = {}
+        self.seq         = 0
+        self.subscribers = {}
+        # [name, predicate, matched, value] of each wait_for_value()
+        self.waiters     = []
+
+    # Calls |callback(name, value)| from the receive thread whenever
+    # |name| is received. Events are published with a value of None.
+    def subscribe(self, name, callback):
+        self.cond.acquire()
+        self.subscribers.setdefault(name, []).append(callback)
+        self.cond.release()
+
+    def unsubscribe(self, name, callback):
+        self.cond.acquire()
+        self.subscribers[name].remove(callback)
+        self.cond.release()
+
+    # Sequence number of the latest value or event, for |since|.
+    def mark(self):
+        return self.seq
+
+    def publish_value(self, name, value):
+        self.cond.acquire()
+        self.seq += 1
+        self.values[name] = (value, self.seq)
+        # checked here rather than by the waiter, so a match isn't missed
+        # when another value replaces it before the waiter wakes up
+        for waiter in self.waiters:
+            if waiter[0] == name and not waiter[2]:
+                try:
+                    matched = waiter[1](value)
+                except Exception:
+                    # the waiter times out instead
+                    matched = False
+                if matched:
+                    waiter[2:] = [True, value]
+        callbacks = list(self.subscribers.get(name, ()))
+        self.cond.notify_all()
+        self.cond.release()
+        for callback in callbacks:
+            callback(name, value)
+
+    def publish_event(self, name):
+        self.cond.acquire()
+        self.seq += 1
+        self.events[name] = (self.event_count(name) + 1, self.seq)
+        callbacks = list(self.subscribers.get(name, ()))
+        self.cond.notify_all()
+        self.cond.release()
+        for callback in callbacks:
+            callback(name, None)
+
+    def event_count(self, name):
+        return self.events.get(name, (0, 0))[0]
+
+    def last_value(self, name):
+        return self.values.get(name, (None, 0))[0]
+
+    # Waits until a value of |name| satisfies |predicate|, which can be a
+    # function or a value to compare against, and returns that value. Any
+    # value received during the wait counts. With |since|, so does the
+    # latest one received before the call if it came after |since|.
+    def wait_for_value(self, name, predicate, timeout, since=None):
+        if not callable(predicate):
+            expected = predicate
+            predicate = lambda v: v == expected
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            if since is None:
+                since = self.seq
+            value, seq = self.values.get(name, (None, 0))
+            if seq > since and predicate(value):
+                return value
+            waiter = [name, predicate, False, None]
+            self.waiters.append(waiter)
+            try:
+                while not waiter[2]:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise WaitTimeout('timed out waiting for %s, last value was %r' % (name, self.last_value(name)))
+                    self.cond.wait(remaining)
+                return waiter[3]
+            finally:
+                self.waiters.remove(waiter)
+        finally:
+            self.cond.release()
+
+    # Waits for event |name| to arrive after the call, or after |since|.
+    def wait_for_event(self, name, timeout, since=None):
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            if since is None:
+                since = self.seq
+            while self.events.get(name, (0, 0))[1] <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WaitTimeout('timed out waiting for event %s' % name)
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+registry = Registry()
+
+# Registry name of value or event |name|, which can be "STATE.name" or
+# just a name in the current state.
+def qualify(name):
+    return name if '.' in name else cur_state.name + '.' + name
+
+# Shortcuts for tests, which raise WaitTimeout and so fail the test when
+# the value or event doesn't arrive in time.
+def wait_for_value(name, predicate, timeout=1.0, since=None):
+    return registry.wait_for_value(qualify(name), predicate, timeout, since)
+
+def wait_for_event(name, timeout=1.0, since=None):
+    registry.wait_for_event(qualify(name), timeout, since)
 
 COMM_INITIAL                   = 0
 COMM_WAITING_FOR_CHANGE_STATE  = 1
@@ -233,90 +912,564 @@ COMM_WAITING_FOR_VALUE_ID      = 5
 COMM_WAITING_FOR_VALUE_VALUE   = 6
 COMM_WAITING_FOR_DEBUG_SETTING = 7
 COMM_WAITING_FOR_HEARTBEAT_ID  = 8
+COMM_WAITING_FOR_ACK_SEQ       = 9
+COMM_WAITING_FOR_QUEUE_STATS   = 10
+COMM_WAITING_FOR_PROFILE       = 11
+
+OPCODE_DEBUG_SETTING = 3
+OPCODE_HEARTBEAT     = 4
+OPCODE_ACK           = 7
+OPCODE_QUEUE_STATS   = 8
+OPCODE_PROFILE       = 9
+QUEUE_STATS_RESET    = 1
+PROFILE_RESET        = 1
+PROFILE_NO_SLOT      = 0xffff
+PROFILE_ENTRIES      = ('setup', 'enter', 'loop', 'exit', 'event')
+DEBUG_ALL_VALUES     = 0xff
+FRAME_SYNC           = chr(0xa5)
+FRAME_MAX_LENGTH     = 32
+
+def _crc8_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x7) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table.append(crc)
+    return table
+CRC8_TABLE = _crc8_table()
+
+def crc8(s):
+    crc = 0
+    for c in s:
+        crc = CRC8_TABLE[crc ^ ord(c)]
+    return crc
+
+# Set by --framed, wraps every frame with a sync byte, length and CRC.
+framed = False
+
+def write_frame(frame):
+    if framed:
+        frame = FRAME_SYNC + chr(len(frame)) + frame + chr(crc8(chr(len(frame)) + frame))
+    port.write(frame)
+
+# Reporting levels the master has confirmed, by (state id, value id).
+debug_settings = {}
+
+def set_verbosity(state_name, value_name, level):
+    state = STATE_INDEX.get(state_name)
+    if state is None:
+        raise ValueError('No state named %r' % state_name)
+    if value_name is None:
+        value_id = DEBUG_ALL_VALUES
+    else:
+        value_id = TABLET_VALUE_INDEX[state.id].get(value_name)
+        if value_id is None:
+            raise ValueError('No such value %r' % value_name)
+    frame = chr(OPCODE_DEBUG_SETTING) + chr(state.id) + chr(value_id) + chr(level)
+    if session is not None:
+        session.record(SESSION_OUT, frame)
+    write_frame(frame)
+
+# Sliding window of sequence-numbered commands waiting to be acknowledged.
+# Each command is followed by an ack request, which the master echoes once
+# it has processed everything before it. At most |size| commands are in
+# flight at once, so the AMIB's receive buffer can't be overrun. When the
+# oldest command times out, the value writes in flight are resent in order.
+# Commands carry no sequence number, so the master can't tell a resend from
+# a new command; events and state changes would run twice if only their ack
+# was lost, so they're reported and given up on instead of resent.
+class AckWindow(object):
+    # value writes set the value outright, so sending one twice is harmless
+    RESENDABLE = ('\x02',)
+
+    def __init__(self, size=8, timeout=0.5, retries=3):
+        if size < 1:
+            raise ValueError('window must be at least 1')
+        self.size     = size
+        self.timeout  = timeout
+        self.retries  = retries
+        self.cond     = threading.Condition()
+        self.inflight = OrderedDict()
+        self.next_seq = 0
+        self.resent   = 0
+        self.failed   = 0
+
+    def send(self, frame):
+        self.cond.acquire()
+        try:
+            while len(self.inflight) >= self.size:
+                self._wait()
+            seq = self.next_seq
+            self.next_seq = (self.next_seq + 1) % 256
+            self.inflight[seq] = [frame, time.time(), 0]
+            write_frame(frame)
+            write_frame(chr(OPCODE_ACK) + chr(seq))
+        finally:
+            self.cond.release()
+
+    def ack(self, seq):
+        self.cond.acquire()
+        try:
+            # acks are cumulative, anything sent before |seq| is done too
+            if seq in self.inflight:
+                while self.inflight.popitem(last=False)[0] != seq:
+                    pass
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    # Waits for an ack, resending or giving up on timed out commands. Must
+    # be called with the condition held.
+    def _wait(self):
+        oldest = next(iter(self.inflight.values()))
+        remaining = oldest[1] + self.timeout - time.time()
+        if remaining > 0:
+            self.cond.wait(remaining)
+            return
+
+        if oldest[0][0] not in self.RESENDABLE:
+            seq, _ = self.inflight.popitem(last=False)
+            self.failed += 1
+            print >>sys.stderr, "command %d wasn't acknowledged and may not have run, not resending it" % seq
+            return
+        if oldest[2] >= self.retries:
+            seq, _ = self.inflight.popitem(last=False)
+            self.failed += 1
+            print >>sys.stderr, "command %d was never acknowledged, giving up on it" % seq
+            return
+
+        now = time.time()
+        for seq, entry in self.inflight.items():
+            if entry[0][0] not in self.RESENDABLE:
+                continue
+            entry[1] = now
+            entry[2] += 1
+            self.resent += 1
+            write_frame(entry[0])
+            write_frame(chr(OPCODE_ACK) + chr(seq))
+
+    # Waits until every command has been acknowledged or given up on.
+    def drain(self):
+        self.cond.acquire()
+        try:
+            while self.inflight:
+                self._wait()
+        finally:
+            self.cond.release()
+
+# Set by the ack command or --ack, None means fire and forget.
+acks = None
+
+# Round trip times of heartbeats sent by the ping command. Heartbeats go to
+# the master, or through it to a slave AMIB, and are echoed straight back.
+class Heartbeats(object):
+    def __init__(self):
+        self.cond    = threading.Condition()
+        self.pending = {}
+        self.rtts    = []
+
+    # Sequence numbers are a byte, so at most 256 pings are in flight. One
+    # that's reused waits for the earlier ping's reply, or for it to time
+    # out and count as lost, rather than take its place.
+    def send(self, amib, seq, timeout=1.0):
+        self.cond.acquire()
+        deadline = time.time() + timeout
+        while (amib, seq) in self.pending and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        self.pending[amib, seq] = time.time()
+        self.cond.release()
+        write_frame(chr(OPCODE_HEARTBEAT) + chr(amib) + chr(seq))
+
+    def reply(self, amib, seq):
+        now = time.time()
+        self.cond.acquire()
+        sent = self.pending.pop((amib, seq), None)
+        if sent is not None:
+            self.rtts.append(now - sent)
+            self.cond.notify_all()
+        self.cond.release()
+
+    def ping(self, count, rate, amib, timeout=1.0):
+        self.rtts = []
+        self.pending = {}
+        start = time.time()
+        for i in range(count):
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.send(amib, i % 256, timeout)
+
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        while self.pending and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        self.cond.release()
+        return sorted(self.rtts)
+
+heartbeats = Heartbeats()
+
+# The master's deferred event queue, as (queued, high water mark, size,
+# overflows). A size of 0 means events aren't deferred.
+class QueueStats(object):
+    def __init__(self):
+        self.cond  = threading.Condition()
+        self.stats = None
+
+    def query(self, reset=False, timeout=1.0):
+        self.cond.acquire()
+        self.stats = None
+        self.cond.release()
+        frame = chr(OPCODE_QUEUE_STATS) + chr(QUEUE_STATS_RESET if reset else 0)
+        if session is not None:
+            session.record(SESSION_OUT, frame)
+        write_frame(frame)
+
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        while self.stats is None and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        stats = self.stats
+        self.cond.release()
+        return stats
+
+    def reply(self, buf):
+        self.cond.acquire()
+        self.stats = (buf[1], buf[2], buf[3], buf[4] | buf[5] << 8)
+        self.cond.notify_all()
+        self.cond.release()
+
+queue_stats = QueueStats()
+
+# Name of each of the master's profiling slots, in order.
+PROFILE_SLOTS = [name for state in STATES
+                 for name in ['%s.%s' % (state.name, entry) for entry in PROFILE_ENTRIES] +
+                             ['%s.events.%s' % (state.name, ev) for ev in state.devices['master'].events]]
+
+# Profiling counters from a master built with gen.py --instrument, as
+# (count, total, max) in microseconds by slot. Slots are read one frame at
+# a time with at most |window| requests in flight, so the master's receive
+# buffer can't overflow while it's busy sending replies.
+class Profiler(object):
+    def __init__(self, window=4):
+        self.cond     = threading.Condition()
+        self.window   = window
+        self.counters = {}
+        self.pending  = set()
+        self.missing  = False
+
+    # Returns the counters read, or None if the master has none.
+    def query(self, reset=False, timeout=1.0):
+        self.cond.acquire()
+        self.counters = {}
+        self.pending = set()
+        self.missing = False
+        try:
+            for slot in range(len(PROFILE_SLOTS)):
+                deadline = time.time() + timeout
+                while len(self.pending) >= self.window and not self.missing and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                if len(self.pending) >= self.window or self.missing:
+                    break
+                self.pending.add(slot)
+                frame = chr(OPCODE_PROFILE) + chr(PROFILE_RESET if reset else 0) + struct.pack('<H', slot)
+                if session is not None:
+                    session.record(SESSION_OUT, frame)
+                write_frame(frame)
+
+            deadline = time.time() + timeout
+            while self.pending and not self.missing and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return None if self.missing else self.counters
+        finally:
+            self.cond.release()
+
+    def reply(self, buf):
+        slot = buf[1] | buf[2] << 8
+        self.cond.acquire()
+        if slot == PROFILE_NO_SLOT:
+            self.missing = True
+        else:
+            self.counters[slot] = struct.unpack('<III', ''.join(chr(n) for n in buf[3:15]))
+            self.pending.discard(slot)
+        self.cond.notify_all()
+        self.cond.release()
+
+profiler = Profiler()
+
+def print_profile(counters):
+    print '%-40s %10s %12s %10s %10s' % ('', 'count', 'total(ms)', 'mean(us)', 'max(us)')
+    rows = sorted(((total, slot, count, max_us) for (slot, (count, total, max_us)) in counters.items() if count),
+                  reverse=True)
+    for (total, slot, count, max_us) in rows:
+        print '%-40s %10d %12.1f %10.1f %10d' % (PROFILE_SLOTS[slot], count, total / 1000.0, float(total) / count, max_us)
+    if len(counters) < len(PROFILE_SLOTS):
+        print 'No reply for %d of %d slots' % (len(PROFILE_SLOTS) - len(counters), len(PROFILE_SLOTS))
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+def print_ping(count, rtts, buckets=10, width=40):
+    print '%d sent, %d received, %.1f%% loss' % (count, len(rtts), 100.0 * (count - len(rtts)) / count)
+    if not rtts:
+        return
+    print 'rtt min %.2f ms, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms' % tuple(
+        x * 1000 for x in (rtts[0], percentile(rtts, 50), percentile(rtts, 90), percentile(rtts, 99), rtts[-1]))
+
+    lo, hi = rtts[0], rtts[-1]
+    step = (hi - lo) / buckets or 1e-6
+    counts = [0] * buckets
+    for rtt in rtts:
+        counts[min(buckets - 1, int((rtt - lo) / step))] += 1
+    for i, n in enumerate(counts):
+        print '%8.2f ms %6d %s' % ((lo + i * step) * 1000, n, '#' * (n * width // max(counts)))
+
+# (name, type, struct format, size) of every tablet value by state id and
+# value id, so decoding a frame doesn't have to search for them.
+TABLET_VALUES = [[(name, ty, ty_to_struct(ty), struct.calcsize(ty_to_struct(ty)))
+                  for (name, ty) in state.devices['tablet'].values.items()]
+                 for state in STATES]
 
+# Type of each tablet value by "STATE.name".
+TABLET_VALUE_TYPES = {}
+for state, state_values in zip(STATES, TABLET_VALUES):
+    for (name, ty, _, _) in state_values:
+        TABLET_VALUE_TYPES[state.name + '.' + name] = ty
+
+def tablet_value(state_id, value_id):
+    if state_id < len(TABLET_VALUES) and value_id < len(TABLET_VALUES[state_id]):
+        return TABLET_VALUES[state_id][value_id]
+    return None
+
+# Decodes frames from the master. Frames are either raw, where the length
+# is implied by the opcode and value type, or, with framed=True, wrapped as
+# FRAME_SYNC, length, frame, CRC-8 of length and frame. In framed mode a
+# corrupt frame only costs the bytes up to the next sync byte.
 class RecvHandler(object):
-    def __init__(self, port):
+    def __init__(self, port, framed=False):
         self.state         = COMM_INITIAL
         self.port          = port
+        self.framed        = framed
         self.buf           = []
+        self.pending       = ''
         self.pending_value = None
+        self.frames        = 0
+        self.bad_frames    = 0
+        self.closing       = False
 
-    def handle(self):
+    def read(self):
         try:
-            s = self.port.read(1)
+            return self.port.read(self.port.in_waiting or 1)
         except serial.SerialException:
-            return
+            return ''
+        except Exception:
+            # bridge sockets can't cancel a read, so closing one from under
+            # this thread fails in whatever way the socket happens to
+            if self.closing:
+                return ''
+            raise
 
+    def handle(self):
+        s = self.read()
         while s != '':
-            b = ord(s)
-            self.buf.append(b)
-            if self.state == COMM_INITIAL:
-                if b == 2:
-                    self.state = COMM_WAITING_FOR_VALUE_STATE
-                else:
-                    # ??
-                    self.state = COMM_INITIAL
-                    self.buf = []
-            elif self.state == COMM_WAITING_FOR_VALUE_STATE:
-                self.state = COMM_WAITING_FOR_VALUE_ID
-            elif self.state == COMM_WAITING_FOR_VALUE_ID:
-                state = STATES[self.buf[1]]
-                self.pending_value = next((name, ty) for (i, (name, ty)) in enumerate(state.devices['tablet'].values.items()) if i == self.buf[2])
+            if self.framed:
+                self.feed_framed(s)
+            else:
+                for c in s:
+                    self.feed(ord(c))
+            s = self.read()
+
+    def reset(self):
+        self.state = COMM_INITIAL
+        self.buf = []
+
+    def complete(self):
+        self.dispatch(self.buf)
+        self.reset()
+
+    def feed(self, b):
+        self.buf.append(b)
+        if self.state == COMM_INITIAL:
+            if b == 2:
+                self.state = COMM_WAITING_FOR_VALUE_STATE
+            elif b == 1:
+                self.state = COMM_WAITING_FOR_EVENT_STATE
+            elif b == OPCODE_ACK:
+                self.state = COMM_WAITING_FOR_ACK_SEQ
+            elif b == OPCODE_HEARTBEAT:
+                self.state = COMM_WAITING_FOR_HEARTBEAT_ID
+            elif b == OPCODE_DEBUG_SETTING:
+                self.state = COMM_WAITING_FOR_DEBUG_SETTING
+            elif b == OPCODE_QUEUE_STATS:
+                self.state = COMM_WAITING_FOR_QUEUE_STATS
+            elif b == OPCODE_PROFILE:
+                self.state = COMM_WAITING_FOR_PROFILE
+            else:
+                # ??
+                self.reset()
+        elif self.state == COMM_WAITING_FOR_DEBUG_SETTING:
+            if len(self.buf) == 4:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_EVENT_STATE:
+            self.state = COMM_WAITING_FOR_EVENT_EVENT
+        elif self.state == COMM_WAITING_FOR_EVENT_EVENT:
+            self.complete()
+        elif self.state == COMM_WAITING_FOR_HEARTBEAT_ID:
+            if len(self.buf) == 3:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_ACK_SEQ:
+            self.complete()
+        elif self.state == COMM_WAITING_FOR_QUEUE_STATS:
+            if len(self.buf) == 6:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_PROFILE:
+            if len(self.buf) == 15:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_VALUE_STATE:
+            self.state = COMM_WAITING_FOR_VALUE_ID
+        elif self.state == COMM_WAITING_FOR_VALUE_ID:
+            self.pending_value = tablet_value(self.buf[1], b)
+            if self.pending_value is None:
+                self.bad_frames += 1
+                self.reset()
+            else:
                 self.state = COMM_WAITING_FOR_VALUE_VALUE
-            elif self.state == COMM_WAITING_FOR_VALUE_VALUE:
-                name, ty = self.pending_value
-                sty = ty_to_struct(ty)
-                if struct.calcsize(sty) == len(self.buf) - 3:
-                    stdout_lock.acquire()
-                    print "\r%s = %s" % (name, struct.unpack(sty, ''.join(chr(n) for n in self.buf[3:]))[0])
-                    print cur_state.name + "> " + readline.get_line_buffer(),
-                    sys.stdout.flush()
-                    stdout_lock.release()
-                    self.state = COMM_INITIAL
-                    self.buf = []
+        elif self.state == COMM_WAITING_FOR_VALUE_VALUE:
+            if self.pending_value[3] == len(self.buf) - 3:
+                self.complete()
+        else:
+            raise ValueError("???")
+
+    def feed_framed(self, s):
+        data = self.pending + s
+        pos = 0
+        while True:
+            start = data.find(FRAME_SYNC, pos)
+            if start < 0:
+                pos = len(data)
+                break
+            if start + 2 > len(data):
+                pos = start
+                break
+            length = ord(data[start + 1])
+            end = start + 2 + length + 1
+            if length > FRAME_MAX_LENGTH:
+                # can't be a real frame, don't wait for the rest of it
+                end = start + 2
+            elif end > len(data):
+                pos = start
+                break
+            if 0 < length <= FRAME_MAX_LENGTH and ord(data[end - 1]) == crc8(data[start + 1:end - 1]):
+                self.dispatch([ord(c) for c in data[start + 2:end - 1]])
+                pos = end
             else:
-                raise ValueError("???")
+                # not a frame after all, try the next sync byte
+                self.bad_frames += 1
+                pos = start + 1
+        self.pending = data[pos:]
 
-            try:
-                s = self.port.read(1)
-            except serial.SerialException:
+    # Handles one complete frame, as a list of byte values.
+    def dispatch(self, buf):
+        if session is not None:
+            session.record(SESSION_IN, ''.join(chr(n) for n in buf))
+        op = buf[0]
+        if op == 2 and len(buf) >= 3:
+            value = tablet_value(buf[1], buf[2])
+            if value is None or value[3] != len(buf) - 3:
+                self.bad_frames += 1
                 return
-
-handler = RecvHandler(port)
-t = threading.Thread(target=handler.handle)
-t.daemon = True
-t.start()
+            name, ty, sty, size = value
+            raw = ''.join(chr(n) for n in buf[3:])
+            value, = struct.unpack(sty, raw)
+            self.frames += 1
+            if recorder is not None:
+                recorder.record(buf[1], buf[2], raw)
+            if numpy is not None:
+                key = (buf[1], buf[2])
+                ring = value_rings.get(key)
+                if ring is None:
+                    ring = value_rings[key] = ValueRing()
+                ring.push(monotonic(), value)
+            if tracer is not None:
+                tracer.counter(STATES[buf[1]].name + '.' + name, value)
+            registry.publish_value(STATES[buf[1]].name + '.' + name, value)
+            display.update(name, value)
+        elif op == 1 and len(buf) == 3:
+            if buf[1] >= len(STATES) or buf[2] >= len(STATES[buf[1]].devices['tablet'].events):
+                self.bad_frames += 1
+                return
+            name = STATES[buf[1]].devices['tablet'].events[buf[2]]
+            if tracer is not None:
+                tracer.instant(TRACE_BOARD, 'event ' + name, {'state': STATES[buf[1]].name})
+            registry.publish_event(STATES[buf[1]].name + '.' + name)
+            display.message("event %s" % name)
+        elif op == OPCODE_DEBUG_SETTING and len(buf) == 4:
+            if buf[1] >= len(STATES) or (buf[2] != DEBUG_ALL_VALUES and buf[2] >= len(TABLET_VALUES[buf[1]])):
+                self.bad_frames += 1
+                return
+            debug_settings[buf[1], buf[2]] = buf[3]
+        elif op == OPCODE_HEARTBEAT and len(buf) == 3:
+            heartbeats.reply(buf[1], buf[2])
+        elif op == OPCODE_ACK and len(buf) == 2:
+            if acks is not None:
+                acks.ack(buf[1])
+        elif op == OPCODE_QUEUE_STATS and len(buf) == 6:
+            queue_stats.reply(buf)
+        elif op == OPCODE_PROFILE and len(buf) == 15:
+            profiler.reply(buf)
+        else:
+            self.bad_frames += 1
 
 # Functions to send values over serial. Used below and by tests.
+def send(frame):
+    if session is not None:
+        session.record(SESSION_OUT, frame)
+    if acks is not None:
+        acks.send(frame)
+    else:
+        write_frame(frame)
+
 def set_state(name):
     global cur_state
-    cur_state = next(state for state in STATES if state.name == name)
-    port.write('\x00' + chr(cur_state.id))
+    state = STATE_INDEX.get(name)
+    if state is None:
+        raise ValueError('No state named %r' % name)
+    cur_state = state
+    send('\x00' + chr(cur_state.id))
+    if tracer is not None:
+        tracer.state(cur_state.name, 'set_state')
 
 def set_value(value_name, value):
-    for id, (name, ty) in enumerate(cur_state.devices['master'].values.items()):
-        if name == value_name:
-            break
-    else:
+    found = MASTER_VALUE_INDEX[cur_state.id].get(value_name)
+    if found is None:
         raise ValueError('No such value % r' % value_name)
 
+    id, ty = found
     value = parse_val(ty, value)
-    port.write('\x02' + chr(cur_state.id) + chr(id) + value)
+    send('\x02' + chr(cur_state.id) + chr(id) + value)
+    if tracer is not None:
+        tracer.instant(TRACE_COMMANDS, 'value ' + value_name, {'state': cur_state.name, 'value': struct.unpack(ty_to_struct(ty), value)[0]})
 
 def set_event(name):
-    id = cur_state.devices['master'].events.index(name)
-    port.write('\x01' + chr(cur_state.id) + chr(id))
+    id = MASTER_EVENT_INDEX[cur_state.id].get(name)
+    if id is None:
+        raise ValueError('No such event %r' % name)
+    send('\x01' + chr(cur_state.id) + chr(id))
+    if tracer is not None:
+        tracer.instant(TRACE_COMMANDS, 'event ' + name, {'state': cur_state.name})
 
-print 'try "help" for help'
-while True:
-    s = raw_input(cur_state.name + "> ")
-    words = s.split(' ')
-    cmd, args = words[0], words[1:]
+# Commands that only work with a master built with MANAGER_COMM_HOOKS, along
+# with "ack on".
+HOOK_COMMANDS = ('ping', 'queue', 'profile', 'verbosity')
 
-    stdout_lock.acquire()
-    if cmd == '':
-        stdout_lock.release()
-        continue
+# Runs one console command. Returns False if the console should exit.
+def run_command(cmd, args):
+    global recorder, acks, session, tracer
+
+    if not comm_hooks and (cmd in HOOK_COMMANDS or (cmd == 'ack' and args[:1] == ['on'])):
+        print "%s needs a master built with MANAGER_COMM_HOOKS" % cmd
+    elif cmd == '':
+        pass
     elif cmd == 'help':
         print HELP_TEXT
     elif cmd == 'state':
@@ -325,8 +1478,8 @@ while True:
         else:
             try:
 	        set_state(args[0])
-            except StopIteration:
-                print "no state named %r" % args[0]
+            except ValueError as e:
+                print e
     elif cmd == 'value':
         if len(args) == 0:
             for name, ty in cur_state.devices['master'].values.items():
@@ -336,8 +1489,6 @@ while True:
 	        set_value(args[0], args[1])
             except ValueError as e:
                 print e
-                stdout_lock.release()
-                continue
         else:
             print "Usage: value [name] [value]"
     elif cmd == 'event':
@@ -346,22 +1497,15 @@ while True:
         elif len(args) == 1:
 	    try:
 	        set_event(args[0])
-            except ValueError:
-                print "No such value % r" % args[0]
+            except ValueError as e:
+                print e
         else:
             print "Usage: event [name]"
     elif cmd == 'test':
         if not TESTS:
 	    print 'No tests have been defined for this console.'
 	else:
-            test = None
-	    # Find the requested test by name. Could potentially put these in
-	    # dict instead to make lookup easier, but this is simple enough.
-	    if args:
-	        for t in TESTS:
-	            if t.name == args[0]:
-	                test = t
-		        break
+            test = TEST_INDEX.get(args[0]) if args else None
             if test:
                 test.run_test(args[1:])
 	    else:
@@ -369,11 +1513,314 @@ while True:
 		    print 'No test named "%s".' % args[0],
 	        print 'Options are:'
 	        print '\n'.join(['  ' + t.name for t in TESTS])
+    elif cmd == 'record':
+        if len(args) == 0:
+            if recorder is None:
+                print 'Not recording.'
+            else:
+                old, recorder = recorder, None
+                old.close()
+                print 'Recorded %d values to %s' % (old.count, old.path)
+        elif len(args) == 1:
+            if recorder is not None:
+                print 'Already recording to %s' % recorder.path
+            else:
+                try:
+                    recorder = TelemetryRecorder(args[0], my_build_id)
+                except IOError as e:
+                    print e
+        else:
+            print "Usage: record [file]"
+    elif cmd == 'session':
+        if len(args) == 0:
+            if session is None:
+                print 'Not recording a session.'
+            else:
+                old, session = session, None
+                old.close()
+                print 'Recorded %d frames to %s' % (old.count, old.path)
+        elif len(args) == 1:
+            if session is not None:
+                print 'Already recording a session to %s' % session.path
+            else:
+                try:
+                    session = SessionRecorder(args[0], board_build_id, cur_state.id)
+                except IOError as e:
+                    print e
+        else:
+            print "Usage: session [file]"
+    elif cmd == 'trace':
+        if len(args) == 0:
+            if tracer is None:
+                print 'Not tracing.'
+            else:
+                old, tracer = tracer, None
+                old.close()
+                print 'Wrote %d trace events to %s' % (old.count, old.path)
+                if old.dropped:
+                    print '%d events dropped' % old.dropped
+        elif len(args) == 1:
+            if tracer is not None:
+                print 'Already tracing to %s' % tracer.path
+            else:
+                try:
+                    tracer = TraceWriter(args[0], my_build_id)
+                    tracer.state(cur_state.name, 'trace')
+                except IOError as e:
+                    print e
+        else:
+            print "Usage: trace [file]"
+    elif cmd == 'stats':
+        if numpy is None:
+            print 'stats requires numpy'
+        else:
+            print_stats(filter(None, args))
+    elif cmd == 'ack':
+        if len(args) == 0:
+            if acks is None:
+                print 'Acknowledgements are off.'
+            else:
+                print 'window %d, %d in flight, %d resent, %d failed' % (acks.size, len(acks.inflight), acks.resent, acks.failed)
+        elif args[0] == 'on' and len(args) <= 2:
+            try:
+                window = AckWindow(int(args[1]) if len(args) == 2 else 8)
+            except ValueError:
+                print "Usage: ack [on [window]|off], window at least 1"
+                return True
+            if acks is not None:
+                acks.drain()
+            acks = window
+        elif args[0] == 'off' and len(args) == 1:
+            if acks is not None:
+                acks.drain()
+            acks = None
+        else:
+            print "Usage: ack [on [window]|off]"
+    elif cmd == 'ping':
+        try:
+            count = int(args[0]) if len(args) > 0 else 10
+            rate = float(args[1]) if len(args) > 1 else 10.0
+            amib = int(args[2]) if len(args) > 2 else 0
+            if count <= 0 or rate <= 0 or not 0 <= amib <= 0xff:
+                raise ValueError()
+        except ValueError:
+            print "Usage: ping [count] [rate] [amib], count and rate above 0"
+        else:
+            print_ping(count, heartbeats.ping(count, rate, amib))
+    elif cmd == 'queue':
+        if args not in ([], ['reset']):
+            print "Usage: queue [reset]"
+        else:
+            stats = queue_stats.query(args == ['reset'])
+            if stats is None:
+                print "No reply from the master"
+            elif stats[2] == 0:
+                print "Events aren't deferred, set eventQueue in hardware.json to queue them"
+            else:
+                print "%d of %d queued, high water mark %d, %d dropped" % (stats[0], stats[2], stats[1], stats[3])
+    elif cmd == 'profile':
+        if args not in ([], ['reset']):
+            print "Usage: profile [reset]"
+        else:
+            counters = profiler.query(args == ['reset'])
+            if counters is None:
+                print "The master wasn't built with gen.py --instrument"
+            elif not counters:
+                print "No reply from the master"
+            else:
+                print_profile(counters)
+    elif cmd == 'verbosity':
+        if len(args) == 0:
+            for (state_id, value_id), level in sorted(debug_settings.items()):
+                state = STATES[state_id]
+                if value_id == DEBUG_ALL_VALUES:
+                    print "%s: %d" % (state.name, level)
+                else:
+                    print "%s.%s: %d" % (state.name, list(state.devices['tablet'].values)[value_id], level)
+        elif len(args) in (2, 3):
+            try:
+                set_verbosity(args[0], args[1] if len(args) == 3 else None, int(args[-1]))
+            except ValueError as e:
+                print e
+        else:
+            print "Usage: verbosity [state] [value] [level]"
+    elif cmd == 'display':
+        if len(args) == 0:
+            print "%g fps, %d coalesced, %d overflowed" % (display.fps, display.coalesced, display.overflowed)
+        elif len(args) == 1:
+            try:
+                display.fps = float(args[0])
+            except ValueError:
+                print "Usage: display [fps]"
+        else:
+            print "Usage: display [fps]"
     elif cmd in ('q', 'quit'):
-        stdout_lock.release()
-        break
+        return False
     else:
         print "no such command %r" % cmd
-    stdout_lock.release()
+    return True
+
+# Waits until the value called |name| is received as |expected|, after
+# |since| from registry.mark().
+def expect_value(name, expected, timeout, since=None):
+    name = qualify(name)
+    ty = TABLET_VALUE_TYPES.get(name)
+    if ty is None:
+        raise ValueError('No such value %r' % name)
+
+    expected, = struct.unpack(ty_to_struct(ty), parse_val(ty, expected))
+    try:
+        registry.wait_for_value(name, expected, timeout, since)
+        return True
+    except WaitTimeout:
+        return False
+
+# Runs console commands from a file one after another, without a prompt.
+# Besides the normal commands, scripts can use:
+#   wait [seconds]: sleep
+#   expect [name] [value] [timeout]: wait until a value is received, fail
+#                                    the script if it doesn't arrive
+# An expect matches the latest value received since the command before it
+# was sent, or any value received while it waits.
+# Lines starting with # are ignored. Returns True if every expect passed.
+def run_script(f):
+    latencies = []
+    ok = True
+    mark = registry.mark()
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        cmd, args = words[0], words[1:]
+
+        start = time.time()
+        if cmd == 'wait':
+            try:
+                time.sleep(float(args[0]))
+            except (IndexError, ValueError) as e:
+                locked_print('line %d: bad wait: %s' % (lineno, e))
+                ok = False
+                break
+        elif cmd == 'expect':
+            try:
+                timeout = float(args[2]) if len(args) > 2 else 1.0
+                passed = expect_value(args[0], args[1], timeout, mark)
+            except (IndexError, ValueError) as e:
+                locked_print('line %d: bad expect: %s' % (lineno, e))
+                passed = False
+            if not passed:
+                locked_print('line %d: expect %s failed, last value was %r' % (lineno, ' '.join(args), registry.last_value(qualify(args[0])) if args else None))
+                ok = False
+                break
+        else:
+            mark = registry.mark()
+            stdout_lock.acquire()
+            try:
+                if not run_command(cmd, args):
+                    break
+            finally:
+                stdout_lock.release()
+        latencies.append((time.time() - start, lineno, line))
+
+    total = sum(l for (l, _, _) in latencies)
+    stdout_lock.acquire()
+    try:
+        for latency, lineno, line in latencies:
+            print '%4d %10.3f ms  %s' % (lineno, latency * 1000, line)
+        if latencies:
+            print '%d commands in %.3f s (%.1f commands/s)' % (len(latencies), total, len(latencies) / total if total else 0)
+    finally:
+        stdout_lock.release()
+    return ok
+
+def window_size(s):
+    try:
+        size = int(s)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise argparse.ArgumentTypeError("window must be a whole number, at least 1")
+    return size
+
+def main():
+    global interactive, acks, framed, session, tracer
+
+    parser = argparse.ArgumentParser(description="Debug console")
+    parser.add_argument('port', nargs='?', help="serial port of the master AMIB or a bridge.py URL such as socket://localhost:5331, found from hardware.json by default")
+    parser.add_argument('-s', '--script', help="run commands from a script file (- for stdin) instead of prompting")
+    parser.add_argument('-a', '--ack', type=window_size, metavar='WINDOW', help="wait for acknowledgements, with at most WINDOW commands in flight")
+    parser.add_argument('-f', '--framed', action='store_true', help="wrap frames with a sync byte, length and CRC")
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't show values and events as they arrive")
+    parser.add_argument('-t', '--test', nargs='+', metavar=('NAME', 'ARGS'), help="run one automated test and exit with its result")
+    parser.add_argument('--list-tests', action='store_true', help="print the names of the automated tests and exit")
+    parser.add_argument('--session', metavar='FILE', help="record the session to FILE for replay.py")
+    parser.add_argument('--trace', metavar='FILE', help="write a Chrome/Perfetto timeline of the session to FILE")
+    args = parser.parse_args()
+
+    if args.list_tests:
+        for test in TESTS or []:
+            print test.name
+        return
+
+    framed = args.framed
+    display.muted = args.quiet
+    if args.trace:
+        # started before connecting so the initial state is traced
+        tracer = TraceWriter(args.trace, my_build_id)
+    # decided before connecting, so the display never draws a prompt for a
+    # script or test
+    interactive = args.test is None and args.script is None and sys.stdin.isatty()
+    if interactive:
+        setup_readline()
+    connect(args.port or find_port())
+    if args.ack is not None:
+        if comm_hooks:
+            acks = AckWindow(args.ack)
+        else:
+            print >>sys.stderr, "The master was built without MANAGER_COMM_HOOKS, so commands aren't acknowledged"
+    if args.session:
+        session = SessionRecorder(args.session, board_build_id, cur_state.id)
+
+    ok = True
+    if args.test is not None:
+        test = TEST_INDEX.get(args.test[0])
+        if test is None:
+            print >>sys.stderr, 'No test named "%s".' % args.test[0]
+            ok = False
+        else:
+            ok = test.run_test(args.test[1:])
+    elif not interactive:
+        if args.script in (None, '-'):
+            ok = run_script(sys.stdin)
+        else:
+            ok = run_script(open(args.script))
+    else:
+        print 'try "help" for help'
+        while True:
+            s = raw_input(cur_state.name + "> ")
+            words = s.split(' ')
+            cmd, args = words[0], words[1:]
+
+            stdout_lock.acquire()
+            try:
+                if not run_command(cmd, args):
+                    break
+            finally:
+                stdout_lock.release()
+
+    if acks is not None:
+        acks.drain()
+    # stops the receive thread, so nothing is recorded to a closed file
+    disconnect()
+    if recorder is not None:
+        recorder.close()
+    if session is not None:
+        session.close()
+    if tracer is not None:
+        tracer.close()
+    if not ok:
+        sys.exit(1)
 
-port.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python2
+# Compiles and uploads the sketch of every AMIB in hardware.json, skipping
+# the work that's already been done. Each sketch's sources, generated and
+# hand-written, are hashed along with the compile command. Compiled
+# artifacts are cached by that hash, so only sketches that changed are
+# compiled. A board is only uploaded to if it was last flashed with
+# something else. Sketches compile and upload in parallel.
+#
+# The compile and upload commands default to arduino-cli and can be any
+# command, set with --compile/--upload or in hardware.json:
+#
+#   "flash": {"fqbn": "arduino:sam:arduino_due_x",
+#             "compile": "arduino-cli compile --fqbn {fqbn} --output-dir {output} {sketch}",
+#             "upload": "arduino-cli upload --fqbn {fqbn} --port {port} --input-dir {input} {sketch}"}
+#
+# Commands are split like a shell would and each argument is then filled
+# in with {board}, {sketch}, {fqbn}, {output} (an empty directory the
+# compiler writes its artifacts to), {input} (the cached artifacts) and
+# {port}. Boards are found by serial number, or an AMIB in hardware.json
+# can give its "port" directly.
+#
+# Usage: python flash.py [AMIB1 AMIB2 ...] [-j 4] [--no-upload] [--force] [-n]
+import os
+import sys
+import json
+import time
+import Queue
+import shlex
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+
+DEFAULT_COMPILE = "arduino-cli compile --fqbn {fqbn} --output-dir {output} {sketch}"
+DEFAULT_UPLOAD = "arduino-cli upload --fqbn {fqbn} --port {port} --input-dir {input} {sketch}"
+DEFAULT_CACHE = '.flashcache'
+
+SOURCE_EXTENSIONS = ('.ino', '.cpp', '.c', '.h', '.hpp', '.S')
+
+def sketch_files(sketch):
+    # The sources in |sketch|, in a stable order.
+    files = []
+    for root, dirs, names in os.walk(sketch):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for name in sorted(names):
+            if os.path.splitext(name)[1] in SOURCE_EXTENSIONS:
+                files.append(os.path.join(root, name))
+    return files
+
+def sketch_hash(sketch, compile_cmd, fqbn, extra=()):
+    # Hashes everything that goes into |sketch|'s artifacts: its sources,
+    # its name (the .ino has to match it), how it's compiled and any
+    # |extra| files or directories, such as libraries.
+    h = hashlib.sha256()
+    h.update('%s\0%s\0%s\0' % (os.path.basename(os.path.abspath(sketch)), compile_cmd, fqbn))
+    for (base, path) in [(sketch, sketch)] + [(os.path.dirname(p), p) for p in extra]:
+        files = sketch_files(path) if os.path.isdir(path) else [path]
+        for name in files:
+            data = open(name, 'rb').read()
+            h.update('%s\0%d\0' % (os.path.relpath(name, base).replace(os.sep, '/'), len(data)))
+            h.update(data)
+    return h.hexdigest()
+
+def command(template, **fields):
+    return [arg.format(**fields) for arg in shlex.split(template)]
+
+class Board(object):
+    def __init__(self, name, sketch, serial_number, port=None):
+        self.name          = name
+        self.sketch        = sketch
+        self.serial_number = serial_number
+        self.port          = port
+        self.hash          = None
+        self.compiled      = None
+        self.uploaded      = None
+        self.error         = None
+        self.duration      = None
+
+class Cache(object):
+    # Compiled artifacts in |path|/artifacts/<hash>, and the hash last
+    # uploaded to each board by serial number in |path|/flashed.json.
+    def __init__(self, path):
+        self.path      = path
+        self.artifacts = os.path.join(path, 'artifacts')
+        self.lock      = threading.Lock()
+        if not os.path.isdir(self.artifacts):
+            os.makedirs(self.artifacts)
+        try:
+            self.flashed = json.load(open(os.path.join(path, 'flashed.json'), 'rb'))
+        except (IOError, ValueError):
+            self.flashed = {}
+
+    def artifact(self, digest):
+        path = os.path.join(self.artifacts, digest)
+        return path if os.path.isdir(path) else None
+
+    def scratch(self):
+        return tempfile.mkdtemp(dir=self.path, prefix='build-')
+
+    def store(self, digest, output):
+        # Moves a finished build into place. A concurrent build of the same
+        # hash may have got there first, which is just as good.
+        try:
+            os.rename(output, os.path.join(self.artifacts, digest))
+        except OSError:
+            shutil.rmtree(output)
+        return self.artifact(digest)
+
+    def is_flashed(self, board):
+        return self.flashed.get(board.serial_number) == board.hash
+
+    def mark_flashed(self, board):
+        self.lock.acquire()
+        try:
+            self.flashed[board.serial_number] = board.hash
+            tmp = os.path.join(self.path, 'flashed.json.tmp')
+            json.dump(self.flashed, open(tmp, 'wb'), indent=2)
+            if os.path.exists(os.path.join(self.path, 'flashed.json')):
+                os.remove(os.path.join(self.path, 'flashed.json'))
+            os.rename(tmp, os.path.join(self.path, 'flashed.json'))
+        finally:
+            self.lock.release()
+
+class Flasher(object):
+    def __init__(self, cache, compile_cmd, upload_cmd, fqbn, extra=(), upload=True, force=False, dry_run=False, verbose=False):
+        self.cache       = cache
+        self.compile_cmd = compile_cmd
+        self.upload_cmd  = upload_cmd
+        self.fqbn        = fqbn
+        self.extra       = list(extra)
+        self.upload      = upload
+        self.force       = force
+        self.dry_run     = dry_run
+        self.verbose     = verbose
+        # compiles of the same hash wait for each other instead of racing
+        self.building    = {}
+        self.lock        = threading.Lock()
+
+    def run(self, cmd):
+        if self.verbose:
+            print >>sys.stderr, ' '.join(cmd)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError("%s failed with status %d:\n%s" % (cmd[0], proc.returncode, output.rstrip()))
+
+    def compile(self, board):
+        self.lock.acquire()
+        build_lock = self.building.setdefault(board.hash, threading.Lock())
+        self.lock.release()
+
+        build_lock.acquire()
+        try:
+            artifact = self.cache.artifact(board.hash)
+            if artifact is not None:
+                board.compiled = 'cached'
+                return artifact
+            if self.dry_run:
+                board.compiled = 'would compile'
+                return None
+            output = self.cache.scratch()
+            try:
+                self.run(command(self.compile_cmd, board=board.name, sketch=board.sketch, fqbn=self.fqbn, output=output))
+            except Exception:
+                shutil.rmtree(output, ignore_errors=True)
+                raise
+            board.compiled = 'compiled'
+            return self.cache.store(board.hash, output)
+        finally:
+            build_lock.release()
+
+    def flash(self, board):
+        start = time.time()
+        try:
+            board.hash = sketch_hash(board.sketch, self.compile_cmd, self.fqbn, self.extra)
+            artifact = self.compile(board)
+            if not self.upload:
+                board.uploaded = 'skipped'
+            elif self.cache.is_flashed(board) and not self.force:
+                board.uploaded = 'up to date'
+            elif self.dry_run:
+                board.uploaded = 'would upload'
+            elif board.port is None:
+                raise RuntimeError("not connected")
+            else:
+                self.run(command(self.upload_cmd, board=board.name, sketch=board.sketch, fqbn=self.fqbn,
+                                 input=artifact, port=board.port))
+                self.cache.mark_flashed(board)
+                board.uploaded = 'uploaded'
+        except Exception as e:
+            board.error = str(e)
+        board.duration = time.time() - start
+
+    def flash_all(self, boards, jobs, report=None):
+        # Each board is compiled and then uploaded by one of |jobs| workers.
+        todo = Queue.Queue()
+        for board in boards:
+            todo.put(board)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    board = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                self.flash(board)
+                if report is not None:
+                    lock.acquire()
+                    report(board)
+                    lock.release()
+
+        workers = [threading.Thread(target=worker) for _ in range(jobs)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            # join() with a timeout so Ctrl-C still works
+            while w.is_alive():
+                w.join(1)
+
+def find_ports():
+    import serial.tools.list_ports
+    return dict((port.serial_number, port.device) for port in serial.tools.list_ports.comports() if port.serial_number)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile and upload the AMIB sketches that changed")
+    parser.add_argument('boards', nargs='*', help="AMIBs to flash, such as AMIB1 (default all in hardware.json)")
+    parser.add_argument('--hardware', default='hardware.json', help="the hardware.json to read (default hardware.json)")
+    parser.add_argument('--compile', help="compile command (default %r)" % DEFAULT_COMPILE)
+    parser.add_argument('--upload', help="upload command (default %r)" % DEFAULT_UPLOAD)
+    parser.add_argument('--fqbn', help="board name for arduino-cli, such as arduino:sam:arduino_due_x")
+    parser.add_argument('--include', action='append', default=[], metavar='PATH', help="also hash this file or directory into every sketch, such as a library")
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help="cache directory (default %s)" % DEFAULT_CACHE)
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="boards to compile and upload at once (default 4)")
+    parser.add_argument('--no-upload', action='store_true', help="only compile")
+    parser.add_argument('--force', action='store_true', help="upload even to boards that are up to date")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="show what would be compiled and uploaded")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print every command run")
+    args = parser.parse_args()
+
+    try:
+        hardware = json.load(open(args.hardware, 'rb'))
+        name = hardware['name']
+        amibs = hardware['AMIBs']
+    except (IOError, ValueError, KeyError):
+        print >>sys.stderr, "Must have a valid %s" % args.hardware
+        sys.exit(1)
+
+    settings = hardware.get('flash', {})
+    compile_cmd = args.compile or settings.get('compile', DEFAULT_COMPILE)
+    upload_cmd = args.upload or settings.get('upload', DEFAULT_UPLOAD)
+    fqbn = args.fqbn or settings.get('fqbn', '')
+    if not fqbn and '{fqbn}' in compile_cmd + upload_cmd:
+        print >>sys.stderr, "Give --fqbn or set \"fqbn\" under \"flash\" in %s" % args.hardware
+        sys.exit(1)
+
+    root = os.path.dirname(os.path.abspath(args.hardware))
+    boards = []
+    for amib in args.boards or sorted(amibs, key=lambda n: int(n[4:])):
+        if amib not in amibs:
+            print >>sys.stderr, "No %s in %s" % (amib, args.hardware)
+            sys.exit(1)
+        sketch = os.path.join(root, name + amib)
+        if not os.path.isdir(sketch):
+            print >>sys.stderr, "No sketch for %s, expected %s" % (amib, sketch)
+            sys.exit(1)
+        boards.append(Board(amib, sketch, amibs[amib]['serialNumber'], amibs[amib].get('port')))
+
+    upload = not args.no_upload
+    if upload and not all(board.port for board in boards):
+        ports = find_ports()
+        for board in boards:
+            board.port = board.port or ports.get(board.serial_number)
+    flasher = Flasher(Cache(os.path.join(root, args.cache)), compile_cmd, upload_cmd, fqbn, args.include,
+                      upload, args.force, args.dry_run, args.verbose)
+
+    def report(board):
+        if board.error:
+            print '%-8s failed after %.1fs: %s' % (board.name, board.duration, board.error)
+        else:
+            print '%-8s %-13s %-12s %6.1fs  %s' % (board.name, board.compiled, board.uploaded, board.duration, board.hash[:12])
+        sys.stdout.flush()
+
+    flasher.flash_all(boards, max(1, args.jobs), report)
+    failed = sum(1 for board in boards if board.error)
+    if failed:
+        print '%d of %d boards failed' % (failed, len(boards))
+    sys.exit(1 if failed else 0)
@@ -2,11 +2,44 @@ import re
 import ast
 from collections import defaultdict, namedtuple, OrderedDict
 
-DeviceState = namedtuple('DeviceState', ('values', 'events'))
+DeviceState = namedtuple('DeviceState', ('values', 'events', 'policies'))
+
+# How a value is reported, declared as e.g. `position = uint32_t(max_rate=10)`.
+# on_change skips writes that don't change the value, max_rate (Hz) holds
+# back writes that come too quickly until the next one is allowed, and
+# period_ms resends the value that often even if it isn't written.
+ReportPolicy = namedtuple('ReportPolicy', ('on_change', 'max_rate', 'period_ms'))
+DEFAULT_POLICY = ReportPolicy(False, 0, 0)
+
+def parse_policy(call):
+    if call.args or getattr(call, 'starargs', None) or getattr(call, 'kwargs', None):
+        raise ValueError("reporting policy must only have keyword arguments")
+
+    policy = DEFAULT_POLICY._asdict()
+    for keyword in call.keywords:
+        if keyword.arg not in policy:
+            raise ValueError("unknown reporting policy %s" % keyword.arg)
+        try:
+            arg = ast.literal_eval(keyword.value)
+        except ValueError:
+            raise ValueError("reporting policy %s must be a constant" % keyword.arg)
+
+        if keyword.arg == 'on_change':
+            if not isinstance(arg, bool):
+                raise ValueError("on_change must be True or False")
+        elif keyword.arg == 'max_rate':
+            if isinstance(arg, bool) or not isinstance(arg, (int, long, float)) or not 1000.0 / 0xffff <= arg <= 1000:
+                raise ValueError("max_rate must be between 0.016 and 1000 Hz")
+        elif keyword.arg == 'period_ms':
+            if isinstance(arg, bool) or not isinstance(arg, (int, long)) or not 0 < arg <= 0xffff:
+                raise ValueError("period_ms must be between 1 and 65535")
+        policy[keyword.arg] = arg
+    return ReportPolicy(**policy)
 
 def parse_one(body):
     values = OrderedDict()
     events = []
+    policies = {}
 
     for thing in body:
         if isinstance(thing, ast.Pass):
@@ -24,16 +57,24 @@ def parse_one(body):
                 target = stmt.targets[0]
                 if not isinstance(target, ast.Name):
                     raise ValueError("value must have name")
-                if not isinstance(stmt.value, ast.Name):
+                value = stmt.value
+                if isinstance(value, ast.Call):
+                    policy = parse_policy(value)
+                    value = value.func
+                else:
+                    policy = None
+                if not isinstance(value, ast.Name):
                     raise ValueError("value type must be a name")
 
                 name = target.id
-                ty = stmt.value.id
+                ty = value.id
 
                 if name in values:
                     raise ValueError("value name %s already used" % name)
 
                 values[name] = ty
+                if policy is not None:
+                    policies[name] = policy
 
         if thing.name == 'events':
             for stmt in thing.body:
@@ -52,7 +93,7 @@ def parse_one(body):
 
                 events.append(name)
 
-    return DeviceState(values, events)
+    return DeviceState(values, events, policies)
 
 def parse(fname):
     mod = ast.parse(open(fname, 'rb').read(), filename=fname)
@@ -62,7 +103,7 @@ def parse(fname):
         if not isinstance(state, ast.ClassDef):
             raise ValueError("all top-level elements must be states")
 
-        devices = defaultdict(lambda: DeviceState({}, []))
+        devices = defaultdict(lambda: DeviceState({}, [], {}))
 
         for stmt in state.body:
             if isinstance(stmt, ast.Pass):
@@ -84,6 +125,70 @@ def parse(fname):
 
     return device_names, states
 
+def compute_build_id(states):
+    # reporting policies don't change what goes over the wire, so they're
+    # left out and changing one doesn't need the console regenerated
+    # this line is an abomination
+    hashable_states = tuple((name, frozenset((devname, (frozenset(values.items()), tuple(events))) for (devname, (values, events, _)) in devices.items())) for (name, devices) in states.items())
+    return hash(hashable_states) & (2**32 - 1)
+
+def load_topology(hardware, device_names):
+    # Works out which board in hardware.json is the master and the bus
+    # address of every slave device in the .comm file. Slave amibN is board
+    # AMIBN, at address N unless the board gives an "address", and the
+    # master is "master" or else the lowest numbered board that isn't a
+    # slave. |hardware| may be None, leaving every default.
+    boards = hardware.get('AMIBs', {}) if hardware else {}
+    slaves = OrderedDict()
+    for name in sorted((n for n in device_names if re.match(r"amib\d+$", n)), key=lambda n: int(n[4:])):
+        address = boards.get(name.upper(), {}).get('address', int(name[4:]))
+        if not isinstance(address, int) or not 0 < address < 0xff:
+            raise ValueError("%s has address %r, it must be between 1 and 254" % (name, address))
+        for (other, other_address) in slaves.items():
+            if other_address == address:
+                raise ValueError("%s and %s both have address %d" % (other, name, address))
+        slaves[name] = address
+
+    master_name = hardware.get('master') if hardware else None
+    if master_name is None:
+        candidates = sorted((int(board[4:]), board) for board in boards
+                            if re.match(r"AMIB\d+$", board) and board.lower() not in slaves)
+        master_name = candidates[0][1] if candidates else 'AMIB1'
+    if master_name.lower() in slaves:
+        raise ValueError("%s can't be both the master and a slave" % master_name)
+    return master_name, slaves
+
+# How the master shares the bus between slaves, from the "bus" section of
+# hardware.json and each board's "bandwidth". poll_order is slave device
+# names, and a slave can be listed more than once to poll it more often.
+# budgets are bytes per second, with 0 for unlimited. values_per_poll
+# bounds how many value refreshes go out between chances to send events.
+BusSchedule = namedtuple('BusSchedule', ('poll_order', 'budgets', 'values_per_poll', 'burst_ms', 'queue'))
+
+def load_bus_schedule(hardware, slaves):
+    boards = hardware.get('AMIBs', {}) if hardware else {}
+    bus = hardware.get('bus', {}) if hardware else {}
+    poll_order = [board.lower() for board in bus.get('pollOrder', [name.upper() for name in slaves])]
+    for name in poll_order:
+        if name not in slaves:
+            raise ValueError("%s is in pollOrder but isn't a slave" % name.upper())
+    for name in slaves:
+        if name not in poll_order:
+            raise ValueError("slave %s is missing from pollOrder" % name.upper())
+
+    budgets = OrderedDict((name, boards.get(name.upper(), {}).get('bandwidth', 0)) for name in slaves)
+    for (name, budget) in budgets.items():
+        if not isinstance(budget, int) or not 0 <= budget <= 0xffff:
+            raise ValueError("%s has bandwidth %r, it must be between 0 and 65535 bytes/s" % (name.upper(), budget))
+
+    schedule = BusSchedule(poll_order, budgets, bus.get('valuesPerPoll', max(len(slaves), 1)),
+                           bus.get('burstMs', 100), bus.get('queue', 8))
+    for field in ('values_per_poll', 'burst_ms', 'queue'):
+        n = getattr(schedule, field)
+        if not isinstance(n, int) or not 0 < n <= 0xff:
+            raise ValueError("bus %s is %r, it must be between 1 and 255" % (field, n))
+    return schedule
+
 MASTER_HEADER_TEMPLATE = """#pragma once
 
 #include <Manager.h>
@@ -95,6 +200,56 @@ enum State {{
 }};
 
 extern MasterManager<State, {num_states}, {num_values}> manager;
+
+// Everything below needs a Manager library that calls these hooks and
+// defines MANAGER_COMM_HOOKS. Built against one that doesn't, states.cpp
+// constructs the manager the original way and leaves the console
+// extensions (debug settings, heartbeats, acks, framing, reporting
+// policies, bus scheduling, event queue and profile queries) out. Its
+// build ID then has the top bit flipped, so the console knows not to use
+// them.
+
+// Called by the manager for opcodes it doesn't handle itself. Returns false
+// if the opcode isn't known here either.
+bool commExtension(uint8_t opcode);
+
+// Called by the manager when a slave echoes a relayed heartbeat.
+void commHeartbeatReply(uint8_t amib, uint8_t seq);
+
+// Sends a frame to the console, framed if the console asked for framing.
+void commSend(const uint8_t *frame, uint8_t len);
+
+// Reporting verbosity set from the console, 0 means muted. The manager
+// passes a value's bytes to commShouldReport() before sending it to the
+// tablet, which applies the verbosity and the value's reporting policy.
+// States can check their own level before sending anything else.
+uint8_t commReportLevel(uint8_t state);
+bool commShouldReport(uint8_t state, uint8_t value, const uint8_t *data, uint8_t size);
+
+// Called by the manager from loop(). Sends values their reporting policy
+// held back and resends periodic ones.
+void commLoop();
+
+// Slaves from hardware.json. Remote values and events name their slave by
+// bus address, and the manager finds the slave's entry in slave_addresses
+// with commSlaveIndex(), which returns NO_SLAVE for unknown addresses.
+static const uint8_t NUM_SLAVES = {num_slaves};
+static const uint8_t NO_SLAVE = 0xff;
+extern const uint8_t slave_addresses[];
+uint8_t commSlaveIndex(uint8_t address);
+
+// Traffic to slaves is scheduled rather than sent as it's made. Remote
+// events queue with commBusEvent(), and the manager passes remote value
+// writes to commBusValue(). commLoop() then sends every queued event
+// before a bounded number of value refreshes, visiting slaves in the
+// polling order from hardware.json within each slave's byte budget.
+void commBusEvent(uint8_t address, uint8_t state, uint8_t event);
+void commBusValue(uint8_t address, uint8_t state, uint8_t value, const uint8_t *data, uint8_t size);
+
+// With "eventQueue" set in hardware.json, each state's event() queues the
+// event here and commLoop() runs one queued event per loop, so the link is
+// still read while a long handler runs.
+void commQueueEvent(uint8_t state, uint8_t ev);
 """
 
 MASTER_NAMESPACE_TEMPLATE = """namespace {name} {{
@@ -130,7 +285,7 @@ MASTER_VALUE_TEMPLATE = "extern Value<{type}> {name};\n"
 MASTER_EVENT_TEMPLATE = "void {name}();"
 
 MASTER_SOURCE_TEMPLATE = """#include "states.h"
-
+{profile}
 static const StateInfo state_infos[{num_states}] = {{
   {state_infos}
 }};
@@ -139,14 +294,41 @@ static const WireValue wire_values[{num_values}] = {{
   {wire_values}
 }};
 
-MasterManager<State, {num_states}, {num_values}> manager({build_id:#08x}, state_infos, wire_values, {slaves});
+const uint8_t slave_addresses[{slaves_size}] = {{{slave_addresses}}};
+
+// index into slave_addresses by bus address
+static const uint8_t slave_index[{max_address} + 1] = {{{slave_index}}};
+
+uint8_t commSlaveIndex(uint8_t address) {{
+  return address <= {max_address} ? slave_index[address] : NO_SLAVE;
+}}
+
+#ifdef MANAGER_COMM_HOOKS
+MasterManager<State, {num_states}, {num_values}> manager({build_id:#08x}, state_infos, wire_values, slave_addresses, NUM_SLAVES);
+#else
+{legacy_manager}
+#endif
 
 {states_code}
+#ifdef MANAGER_COMM_HOOKS
+{extensions}
+#else
+{legacy_extensions}
+#endif
+"""
+# Without MANAGER_COMM_HOOKS the manager takes a mask of slaves, bit 0 for
+# address 2 (AMIB2), and sends remote events itself. The build ID it reports
+# has BUILD_ID_BASIC flipped, so the console leaves the extensions alone.
+MASTER_LEGACY_MANAGER = "MasterManager<State, {num_states}, {num_values}> manager({build_id:#08x}, state_infos, wire_values, {slave_mask:#x});"
+MASTER_LEGACY_MANAGER_ERROR = '#error "slave addresses outside 2 to 9 need a Manager library with MANAGER_COMM_HOOKS"'
+MASTER_LEGACY_EXTENSIONS = """void commBusEvent(uint8_t address, uint8_t state, uint8_t event) {{
+  manager.sendSlaveEvent(address, event);
+}}
 """
 MASTER_SOURCE_STATE = """namespace {name} {{
 {hardware_values}
 
-void event(uint8_t ev) {{
+void handleEvent(uint8_t ev) {{
   switch (ev) {{
   {cases}
   default:
@@ -154,12 +336,734 @@ void event(uint8_t ev) {{
   }}
 }}
 
+void event(uint8_t ev) {{
+  {event_body}
+}}
+
 {remotes}
 }}
 """
+# Opcodes on the console link beyond the ones the manager handles itself.
+OPCODE_DEBUG_SETTING = 3
+OPCODE_HEARTBEAT = 4
+OPCODE_ACK = 7
+OPCODE_QUEUE_STATS = 8
+OPCODE_PROFILE = 9
+
+# A master built without MANAGER_COMM_HOOKS handles none of those, and says
+# so by reporting its build ID with this bit flipped.
+BUILD_ID_BASIC = 1 << 31
+
+# Flag in a queue stats request that clears the high water mark and
+# overflow count once they're sent.
+QUEUE_STATS_RESET = 1
+
+# Profiling counters, see generate_master(instrument=True). Each state has
+# a slot for each of PROFILE_ENTRIES and then one for each master event.
+PROFILE_ENTRIES = ('setup', 'enter', 'loop', 'exit', 'event')
+PROFILE_RESET = 1
+# slot number in a reply for slots that don't exist
+PROFILE_NO_SLOT = 0xffff
+
+# Value id in a debug setting that means the whole state.
+DEBUG_ALL_VALUES = 0xff
+
+# Optional framing: FRAME_SYNC, length, frame, CRC-8 of length and frame.
+FRAME_SYNC = 0xa5
+CRC8_POLY = 0x07
+# No frame is longer than this, so a bad length byte is caught at once
+# rather than after waiting for that many bytes.
+FRAME_MAX_LENGTH = 32
+
+# Deferred events, shared by master and sub. commEventQueueStats() fills in
+# the count, high water mark, size and overflow count (two bytes) of the
+# queue, and clears the high water mark and overflows if |reset|.
+EVENT_QUEUE_SOURCE = """static const uint8_t EVENT_QUEUE_SIZE = {event_queue};
+
+static void (*const event_handlers[{num_states}])(uint8_t) = {{
+  {event_handlers}
+}};
+
+// queued (state, event) pairs, oldest at event_head
+static uint8_t event_queue[EVENT_QUEUE_SIZE][2];
+static uint8_t event_head = 0;
+static uint8_t event_count = 0;
+static uint8_t event_high_water = 0;
+static uint16_t event_overflows = 0;
+
+void commQueueEvent(uint8_t state, uint8_t ev) {{
+  if (event_count == EVENT_QUEUE_SIZE) {{
+    if (event_overflows != 0xffff) {{
+      event_overflows++;
+    }}
+    return;
+  }}
+  uint8_t tail = (event_head + event_count) % EVENT_QUEUE_SIZE;
+  event_queue[tail][0] = state;
+  event_queue[tail][1] = ev;
+  event_count++;
+  if (event_count > event_high_water) {{
+    event_high_water = event_count;
+  }}
+}}
+
+// Runs the oldest queued event. Only one runs per loop so that the manager
+// gets to read the link between long handlers.
+static void commDrainEvent() {{
+  if (!event_count) {{
+    return;
+  }}
+  uint8_t state = event_queue[event_head][0];
+  uint8_t ev = event_queue[event_head][1];
+  event_head = (event_head + 1) % EVENT_QUEUE_SIZE;
+  event_count--;
+  event_handlers[state](ev);
+}}
+"""
+
+# Only the master answers OPCODE_QUEUE_STATS.
+EVENT_QUEUE_STATS_SOURCE = """static void commEventQueueStats(uint8_t *stats, bool reset) {{
+  stats[0] = event_count;
+  stats[1] = event_high_water;
+  stats[2] = EVENT_QUEUE_SIZE;
+  stats[3] = event_overflows & 0xff;
+  stats[4] = event_overflows >> 8;
+  if (reset) {{
+    event_high_water = event_count;
+    event_overflows = 0;
+  }}
+}}
+"""
+
+# Events run as they arrive, so there's never anything queued.
+EVENT_QUEUE_DISABLED_SOURCE = """static void commDrainEvent() {{
+}}
+"""
+EVENT_QUEUE_STATS_DISABLED_SOURCE = """static void commEventQueueStats(uint8_t *stats, bool reset) {{
+  memset(stats, 0, 5);
+}}
+"""
+
+def event_queue_source(states, event_queue, stats=False):
+    if not event_queue:
+        return EVENT_QUEUE_DISABLED_SOURCE.format() + (EVENT_QUEUE_STATS_DISABLED_SOURCE.format() if stats else '')
+    source = EVENT_QUEUE_SOURCE.format(
+        event_queue=event_queue,
+        num_states=len(states),
+        event_handlers=',\n  '.join('{}::handleEvent'.format(state) for state in states),
+    )
+    return source + ('\n' + EVENT_QUEUE_STATS_SOURCE.format() if stats else '')
+
+# Nothing drains the queue without MANAGER_COMM_HOOKS, so events run at once.
+EVENT_QUEUE_BODY = """#ifdef MANAGER_COMM_HOOKS
+  commQueueEvent({state_id}, ev);
+#else
+  handleEvent(ev);
+#endif"""
+
+def event_body(state_id, event_queue):
+    if event_queue:
+        return EVENT_QUEUE_BODY.format(state_id=state_id)
+    return 'handleEvent(ev);'
+
+BUS_SCHEDULER_SOURCE = """static const uint8_t OPCODE_EVENT = 1;
+static const uint8_t BUS_QUEUE = {queue};
+static const uint8_t BUS_VALUES_PER_POLL = {values_per_poll};
+static const uint8_t BUS_BURST_MS = {burst_ms};
+
+// slave indexes in the order they're polled, and each slave's budget in
+// bytes per second, 0 for unlimited
+static const uint8_t bus_poll_order[{poll_size}] = {{{poll_order}}};
+static const uint16_t bus_budgets[{slaves_size}] = {{{budgets}}};
+
+struct BusValue {{
+  uint8_t state;
+  uint8_t value;
+  uint8_t size;
+  uint8_t data[4];
+}};
+
+// queued events and values of each slave, oldest first
+static uint8_t bus_events[{slaves_size}][BUS_QUEUE][2];
+static uint8_t bus_event_count[{slaves_size}];
+static BusValue bus_values[{slaves_size}][BUS_QUEUE];
+static uint8_t bus_value_count[{slaves_size}];
+
+// budget left in thousandths of a byte, can go negative when events or a
+// full queue force frames out
+static int32_t bus_tokens[{slaves_size}];
+static uint32_t bus_refill_ms = 0;
+static uint8_t bus_cursor = 0;
+
+// unlimited slaves aren't accounted at all, and the debt forced frames run
+// up is capped at a second of budget so the counter can't overflow
+static void commBusCharge(uint8_t slave, uint8_t len) {{
+  if (!bus_budgets[slave]) {{
+    return;
+  }}
+  int32_t limit = -1000L * bus_budgets[slave];
+  bus_tokens[slave] -= 1000L * len;
+  if (bus_tokens[slave] < limit) {{
+    bus_tokens[slave] = limit;
+  }}
+}}
+
+static void commBusSendEvent(uint8_t slave) {{
+  uint8_t frame[3] = {{OPCODE_EVENT, bus_events[slave][0][0], bus_events[slave][0][1]}};
+  bus_event_count[slave]--;
+  memmove(bus_events[slave], bus_events[slave] + 1, bus_event_count[slave] * sizeof(bus_events[slave][0]));
+  commBusCharge(slave, sizeof(frame));
+  manager.sendSlaveFrame(slave_addresses[slave], frame, sizeof(frame));
+}}
+
+static void commBusSendValue(uint8_t slave) {{
+  BusValue *v = &bus_values[slave][0];
+  uint8_t frame[7] = {{OPCODE_VALUE, v->state, v->value}};
+  memcpy(frame + 3, v->data, v->size);
+  uint8_t len = 3 + v->size;
+  bus_value_count[slave]--;
+  memmove(bus_values[slave], bus_values[slave] + 1, bus_value_count[slave] * sizeof(BusValue));
+  commBusCharge(slave, len);
+  manager.sendSlaveFrame(slave_addresses[slave], frame, len);
+}}
+
+void commBusEvent(uint8_t address, uint8_t state, uint8_t event) {{
+  uint8_t slave = commSlaveIndex(address);
+  if (slave == NO_SLAVE) {{
+    return;
+  }}
+  if (bus_event_count[slave] == BUS_QUEUE) {{
+    // events are never dropped, so make room by sending the oldest now
+    commBusSendEvent(slave);
+  }}
+  bus_events[slave][bus_event_count[slave]][0] = state;
+  bus_events[slave][bus_event_count[slave]][1] = event;
+  bus_event_count[slave]++;
+}}
+
+void commBusValue(uint8_t address, uint8_t state, uint8_t value, const uint8_t *data, uint8_t size) {{
+  uint8_t slave = commSlaveIndex(address);
+  if (slave == NO_SLAVE) {{
+    return;
+  }}
+  for (uint8_t i = 0; i < bus_value_count[slave]; i++) {{
+    BusValue *v = &bus_values[slave][i];
+    if (v->state == state && v->value == value) {{
+      // not sent yet, so only the latest write matters
+      memcpy(v->data, data, size);
+      return;
+    }}
+  }}
+  if (bus_value_count[slave] == BUS_QUEUE) {{
+    commBusSendValue(slave);
+  }}
+  BusValue *v = &bus_values[slave][bus_value_count[slave]++];
+  v->state = state;
+  v->value = value;
+  v->size = size;
+  memcpy(v->data, data, size);
+}}
+
+static void commBusPoll() {{
+  uint32_t now = millis();
+  uint32_t elapsed = now - bus_refill_ms;
+  bus_refill_ms = now;
+  for (uint8_t slave = 0; slave < NUM_SLAVES; slave++) {{
+    // a budget of b bytes/s earns b thousandths of a byte every ms
+    int32_t cap = (int32_t) bus_budgets[slave] * BUS_BURST_MS;
+    bus_tokens[slave] += (int32_t) bus_budgets[slave] * (int32_t) elapsed;
+    if (bus_tokens[slave] > cap) {{
+      bus_tokens[slave] = cap;
+    }}
+  }}
+
+  // events outrank values, so every slave's events go first
+  for (uint8_t i = 0; i < sizeof(bus_poll_order); i++) {{
+    uint8_t slave = bus_poll_order[i];
+    while (slave < NUM_SLAVES && bus_event_count[slave]) {{
+      commBusSendEvent(slave);
+    }}
+  }}
+
+  // then a bounded number of values, carrying on round robin from where
+  // the last poll stopped
+  uint8_t sent = 0;
+  for (uint8_t n = 0; n < sizeof(bus_poll_order) && sent < BUS_VALUES_PER_POLL; n++) {{
+    uint8_t slave = bus_poll_order[bus_cursor];
+    bus_cursor = (bus_cursor + 1) % sizeof(bus_poll_order);
+    if (slave >= NUM_SLAVES || !bus_value_count[slave]) {{
+      continue;
+    }}
+    if (bus_budgets[slave] && bus_tokens[slave] < 1000L * (3 + bus_values[slave][0].size)) {{
+      continue;
+    }}
+    commBusSendValue(slave);
+    sent++;
+  }}
+}}
+"""
+
+def bus_scheduler_args(slaves, schedule):
+    if schedule is None:
+        schedule = load_bus_schedule(None, slaves)
+    index = list(slaves)
+    # arrays can't be empty, so always leave room for one slave
+    return dict(
+        queue=schedule.queue,
+        values_per_poll=schedule.values_per_poll,
+        burst_ms=schedule.burst_ms,
+        poll_size=max(len(schedule.poll_order), 1),
+        poll_order=', '.join(str(index.index(name)) for name in schedule.poll_order) or 'NO_SLAVE',
+        slaves_size=max(len(slaves), 1),
+        budgets=', '.join(str(schedule.budgets[name]) for name in slaves) or '0',
+    )
+
+# Value frames are sent by the manager, but reporting policies and the bus
+# scheduler send them too.
+OPCODE_VALUE = 2
+
+# Reporting policies, shared by master and sub. {report_enabled} is whether
+# reported value i of state is unmuted and {send} sends a frame upstream.
+# Writes only set a dirty bit, and commLoop() sends each changed value once
+# however many times it was written since the last loop.
+REPORT_POLICY_SOURCE = """static const uint8_t REPORT_ON_CHANGE = 1;
+static const uint8_t REPORT_WRITTEN = 1;
+static const uint8_t REPORT_SENT = 2;
+
+// reporting policy of every reported value, indexed like report_offsets
+static const uint8_t report_sizes[{num_reported}] = {{{report_sizes}}};
+static const uint8_t report_flags[{num_reported}] = {{{report_flags}}};
+static const uint16_t report_min_ms[{num_reported}] = {{{report_min_ms}}};
+static const uint16_t report_period_ms[{num_reported}] = {{{report_period_ms}}};
+
+// the last value written, the last value sent and when it was sent
+static uint8_t report_shadow[{num_reported}][4];
+static uint8_t report_sent[{num_reported}][4];
+static uint32_t report_sent_ms[{num_reported}];
+static uint8_t report_status[{num_reported}];
+
+// one bit per value of each state, set when it's written and cleared when
+// it's sent
+static uint8_t report_dirty[{num_states}][{dirty_bytes}];
+
+// values are only written by the current state, so this is the state
+// periodic values are resent for
+static uint8_t report_state = 0;
+
+static void commReportValue(uint8_t state, uint8_t value) {{
+  uint16_t i = report_offsets[state] + value;
+  uint8_t frame[7] = {{OPCODE_VALUE, state, value}};
+  memcpy(frame + 3, report_shadow[i], report_sizes[i]);
+  memcpy(report_sent[i], report_shadow[i], report_sizes[i]);
+  report_status[i] |= REPORT_SENT;
+  report_sent_ms[i] = millis();
+  {send}(frame, 3 + report_sizes[i]);
+}}
+
+// Always returns false, the value is sent from commLoop().
+bool commShouldReport(uint8_t state, uint8_t value, const uint8_t *data, uint8_t size) {{
+  uint16_t i = report_offsets[state] + value;
+  if (!({report_enabled})) {{
+    return false;
+  }}
+  memcpy(report_shadow[i], data, size);
+  report_status[i] |= REPORT_WRITTEN;
+  report_dirty[state][value >> 3] |= 1 << (value & 7);
+  report_state = state;
+  return false;
+}}
+
+void commLoop() {{
+  uint32_t now = millis();
+{loop_hooks}  for (uint8_t state = 0; state < {num_states}; state++) {{
+    uint16_t first = report_offsets[state];
+    uint8_t count = report_offsets[state + 1] - first;
+    for (uint8_t value = 0; value < count; value++) {{
+      uint16_t i = first + value;
+      uint8_t mask = 1 << (value & 7);
+      bool dirty = report_dirty[state][value >> 3] & mask;
+      if (!dirty && (state != report_state || !report_period_ms[i])) {{
+        continue;
+      }}
+      if (!({report_enabled})) {{
+        continue;
+      }}
+
+      uint32_t since = now - report_sent_ms[i];
+      if (dirty && since >= report_min_ms[i]) {{
+        report_dirty[state][value >> 3] &= ~mask;
+        bool changed = !(report_status[i] & REPORT_SENT) ||
+                       memcmp(report_shadow[i], report_sent[i], report_sizes[i]) != 0;
+        if (changed || !(report_flags[i] & REPORT_ON_CHANGE)) {{
+          commReportValue(state, value);
+        }}
+      }} else if (state == report_state && report_period_ms[i] &&
+                 (report_status[i] & REPORT_WRITTEN) && since >= report_period_ms[i]) {{
+        commReportValue(state, value);
+      }}
+    }}
+  }}
+}}
+"""
+
+def report_policy_args(reported, send, report_enabled, loop_hooks=''):
+    # Table contents for REPORT_POLICY_SOURCE, where |reported| is the values
+    # and policies reported from each state, in order.
+    offsets = [0]
+    sizes, flags, min_ms, period_ms = [], [], [], []
+    for (values, policies) in reported:
+        offsets.append(offsets[-1] + len(values))
+        for (name, ty) in values.items():
+            policy = policies.get(name, DEFAULT_POLICY)
+            sizes.append('sizeof({})'.format(ty))
+            flags.append('REPORT_ON_CHANGE' if policy.on_change else '0')
+            min_ms.append(str(int(round(1000.0 / policy.max_rate))) if policy.max_rate else '0')
+            period_ms.append(str(policy.period_ms))
+
+    # arrays can't be empty, so always leave room for one value
+    padding = ['0'] * (offsets[-1] == 0)
+    return dict(
+        num_states=len(reported),
+        num_reported=max(offsets[-1], 1),
+        report_offsets=', '.join(str(n) for n in offsets),
+        report_sizes=', '.join(sizes + padding),
+        report_flags=', '.join(flags + padding),
+        report_min_ms=', '.join(min_ms + padding),
+        report_period_ms=', '.join(period_ms + padding),
+        dirty_bytes=max((b - a + 7) // 8 for (a, b) in zip(offsets, offsets[1:]) + [(0, 1)]),
+        send=send,
+        report_enabled=report_enabled,
+        loop_hooks=loop_hooks,
+    )
+
+MASTER_SOURCE_EXTENSIONS = """static const uint8_t OPCODE_VALUE = {opcode_value};
+static const uint8_t OPCODE_DEBUG_SETTING = {opcode_debug_setting};
+static const uint8_t OPCODE_HEARTBEAT = {opcode_heartbeat};
+static const uint8_t OPCODE_ACK = {opcode_ack};
+static const uint8_t OPCODE_QUEUE_STATS = {opcode_queue_stats};
+static const uint8_t OPCODE_PROFILE = {opcode_profile};
+static const uint8_t QUEUE_STATS_RESET = {queue_stats_reset};
+static const uint8_t PROFILE_RESET = {profile_reset};
+static const uint8_t DEBUG_ALL_VALUES = {debug_all_values:#x};
+static const uint8_t FRAME_SYNC = {frame_sync:#x};
+static const uint8_t FRAME_MAX_LENGTH = {frame_max_length};
+
+// reporting level of every tablet value, starting at report_offsets[state]
+static const uint16_t report_offsets[{num_states} + 1] = {{{report_offsets}}};
+static uint8_t report_levels[{num_reported}] = {{{report_levels}}};
+static uint8_t state_levels[{num_states}] = {{{state_levels}}};
+
+uint8_t commReportLevel(uint8_t state) {{
+  return state_levels[state];
+}}
+
+{event_queue}{profile}
+{bus_scheduler}
+{report_policies}
+// Set once the console sends a valid framed frame, after which replies
+// are framed too.
+static bool framed = false;
+
+// The frame being handled, when it arrived framed.
+static const uint8_t *frame_data = 0;
+static uint8_t frame_left = 0;
+
+// Bytes read for a frame that turned out to be bad, from the next sync
+// byte on. They're searched for a good frame before reading any more.
+static uint8_t resync_buf[FRAME_MAX_LENGTH + 2];
+static uint8_t resync_len = 0;
+static uint8_t resync_pos = 0;
+
+static uint8_t commReadByte() {{
+  if (frame_data) {{
+    if (!frame_left) {{
+      return 0;
+    }}
+    frame_left--;
+    return *frame_data++;
+  }}
+  if (resync_pos < resync_len) {{
+    return resync_buf[resync_pos++];
+  }}
+  while (!Serial.available()) {{}}
+  return Serial.read();
+}}
+
+// Keeps the |n| bytes of a bad frame in |buf| from the first sync byte on,
+// ahead of any kept bytes that haven't been read yet. Those were read
+// after |buf|, and together they always fit.
+static void commResync(const uint8_t *buf, uint8_t n) {{
+  uint8_t from = 0;
+  while (from < n && buf[from] != FRAME_SYNC) {{
+    from++;
+  }}
+  uint8_t keep = n - from;
+  uint8_t left = resync_len - resync_pos;
+  memmove(resync_buf + keep, resync_buf + resync_pos, left);
+  memcpy(resync_buf, buf + from, keep);
+  resync_len = keep + left;
+  resync_pos = 0;
+}}
+
+static uint8_t crc8Update(uint8_t crc, uint8_t b) {{
+  crc ^= b;
+  for (uint8_t i = 0; i < 8; i++) {{
+    crc = crc & 0x80 ? (crc << 1) ^ {crc8_poly:#04x} : crc << 1;
+  }}
+  return crc;
+}}
+
+void commSend(const uint8_t *frame, uint8_t len) {{
+  if (!framed) {{
+    Serial.write(frame, len);
+    return;
+  }}
+  uint8_t crc = crc8Update(0, len);
+  for (uint8_t i = 0; i < len; i++) {{
+    crc = crc8Update(crc, frame[i]);
+  }}
+  Serial.write(FRAME_SYNC);
+  Serial.write(len);
+  Serial.write(frame, len);
+  Serial.write(crc);
+}}
+
+// Reads a frame wrapped as FRAME_SYNC, length, frame, CRC-8 of length and
+// frame, once the sync byte has been read. A length over FRAME_MAX_LENGTH
+// or a bad CRC means it wasn't really a frame, so the search for one
+// starts again from the next sync byte after this one.
+static void commFramedReceive() {{
+  // length, frame and CRC
+  static uint8_t buf[FRAME_MAX_LENGTH + 2];
+  while (true) {{
+    uint8_t n = 0;
+    uint8_t len = buf[n++] = commReadByte();
+    bool ok = 0 < len && len <= FRAME_MAX_LENGTH;
+    if (ok) {{
+      uint8_t crc = crc8Update(0, len);
+      for (uint8_t i = 0; i < len; i++) {{
+        buf[n] = commReadByte();
+        crc = crc8Update(crc, buf[n++]);
+      }}
+      buf[n] = commReadByte();
+      ok = buf[n++] == crc && buf[1] != FRAME_SYNC;
+    }}
+
+    if (ok) {{
+      framed = true;
+      frame_data = buf + 2;
+      frame_left = len - 1;
+      if (!commExtension(buf[1])) {{
+        manager.dispatchFrame(buf + 1, len);
+      }}
+      frame_data = 0;
+      frame_left = 0;
+    }} else {{
+      commResync(buf, n);
+    }}
+
+    // carry on with the next sync byte among the kept bytes, if any
+    while (resync_pos < resync_len && resync_buf[resync_pos] != FRAME_SYNC) {{
+      resync_pos++;
+    }}
+    if (resync_pos == resync_len) {{
+      resync_len = resync_pos = 0;
+      return;
+    }}
+    resync_pos++;
+  }}
+}}
+
+void commHeartbeatReply(uint8_t amib, uint8_t seq) {{
+  uint8_t reply[3] = {{OPCODE_HEARTBEAT, amib, seq}};
+  commSend(reply, sizeof(reply));
+}}
+
+bool commExtension(uint8_t opcode) {{
+  switch (opcode) {{
+  case OPCODE_DEBUG_SETTING: {{
+    uint8_t state = commReadByte();
+    uint8_t value = commReadByte();
+    uint8_t level = commReadByte();
+    bool applied = false;
+    if (state < {num_states}) {{
+      uint16_t first = report_offsets[state], end = report_offsets[state + 1];
+      if (value == DEBUG_ALL_VALUES) {{
+        state_levels[state] = level;
+        for (uint16_t i = first; i < end; i++) {{
+          report_levels[i] = level;
+        }}
+        manager.relayDebugSetting(state, level);
+        applied = true;
+      }} else if (first + value < end) {{
+        report_levels[first + value] = level;
+        applied = true;
+      }}
+    }}
+    // echo the setting so the console knows it took effect, which a
+    // setting for a state or value that doesn't exist didn't
+    if (applied) {{
+      uint8_t reply[4] = {{OPCODE_DEBUG_SETTING, state, value, level}};
+      commSend(reply, sizeof(reply));
+    }}
+    return true;
+  }}
+  case OPCODE_HEARTBEAT: {{
+    uint8_t amib = commReadByte();
+    uint8_t seq = commReadByte();
+    if (amib == 0) {{
+      commHeartbeatReply(0, seq);
+    }} else {{
+      // the slave echoes it back to us through commHeartbeatReply()
+      manager.relayHeartbeat(amib, seq);
+    }}
+    return true;
+  }}
+  case OPCODE_ACK: {{
+    // frames are handled in order, so echoing the sequence number tells the
+    // console that everything it sent before this has been processed
+    uint8_t reply[2] = {{OPCODE_ACK, commReadByte()}};
+    commSend(reply, sizeof(reply));
+    return true;
+  }}
+  case OPCODE_QUEUE_STATS: {{
+    uint8_t reply[6] = {{OPCODE_QUEUE_STATS}};
+    commEventQueueStats(reply + 1, commReadByte() & QUEUE_STATS_RESET);
+    commSend(reply, sizeof(reply));
+    return true;
+  }}
+  case OPCODE_PROFILE: {{
+    uint8_t flags = commReadByte();
+    uint16_t slot = commReadByte();
+    slot |= commReadByte() << 8;
+    uint8_t reply[15] = {{OPCODE_PROFILE}};
+    commProfileCounters(reply + 1, slot, flags & PROFILE_RESET);
+    commSend(reply, sizeof(reply));
+    return true;
+  }}
+  case FRAME_SYNC:
+    commFramedReceive();
+    return true;
+  default:
+    return false;
+  }}
+}}
+"""
+
 MASTER_SOURCE_CASE = """case {id}:
     events::{name}();
     break;"""
+MASTER_SOURCE_PROFILED_CASE = """case {id}: {{
+    uint32_t start = PROFILE_CLOCK();
+    events::{name}();
+    profileRecord({slot}, start);
+    break;
+  }}"""
+
+# Counters for generate_master(instrument=True), which go at the top of the
+# source so that state_infos can point at the wrappers.
+MASTER_PROFILE_SOURCE = """
+// Time spent in each state's entry points and event handlers, in
+// PROFILE_CLOCK() ticks. That's microseconds unless PROFILE_CLOCK is
+// defined on the compiler's command line, for example to read a cycle
+// counter.
+#ifndef PROFILE_CLOCK
+#define PROFILE_CLOCK() micros()
+#endif
+
+static const uint16_t PROFILE_SLOTS = {profile_slots};
+
+struct ProfileCounter {{
+  uint32_t count;
+  uint32_t total;
+  uint32_t max;
+}};
+
+static ProfileCounter profile_counters[PROFILE_SLOTS];
+
+// Adds the time since |start| to |slot|. Counts and totals stop at their
+// maximum instead of wrapping.
+static void profileRecord(uint16_t slot, uint32_t start) {{
+  uint32_t elapsed = PROFILE_CLOCK() - start;
+  ProfileCounter &counter = profile_counters[slot];
+  if (counter.count != 0xffffffff) {{
+    counter.count++;
+  }}
+  counter.total = counter.total > 0xffffffff - elapsed ? 0xffffffff : counter.total + elapsed;
+  if (elapsed > counter.max) {{
+    counter.max = elapsed;
+  }}
+}}
+
+static void putUint32(uint8_t *out, uint32_t n) {{
+  for (uint8_t i = 0; i < 4; i++) {{
+    out[i] = n >> (8 * i);
+  }}
+}}
+
+// Writes |slot| and its count, total and max to |out|, or slot 0xffff and
+// zeros for a slot that doesn't exist.
+static void commProfileCounters(uint8_t *out, uint16_t slot, bool reset) {{
+  if (slot >= PROFILE_SLOTS) {{
+    memset(out, 0, 14);
+    out[0] = out[1] = 0xff;
+    return;
+  }}
+  ProfileCounter &counter = profile_counters[slot];
+  out[0] = slot & 0xff;
+  out[1] = slot >> 8;
+  putUint32(out + 2, counter.count);
+  putUint32(out + 6, counter.total);
+  putUint32(out + 10, counter.max);
+  if (reset) {{
+    memset(&counter, 0, sizeof(counter));
+  }}
+}}
+
+{wrappers}"""
+MASTER_PROFILE_WRAPPERS = """namespace {state} {{
+{wrappers}
+}}
+"""
+MASTER_PROFILE_WRAPPER = """void {wrapper}() {{
+  if ({entry}) {{
+    uint32_t start = PROFILE_CLOCK();
+    {entry}();
+    profileRecord({slot}, start);
+  }}
+}}
+"""
+MASTER_PROFILE_EVENT_WRAPPER = """void profiledEvent(uint8_t ev) {{
+  uint32_t start = PROFILE_CLOCK();
+  event(ev);
+  profileRecord({slot}, start);
+}}
+"""
+MASTER_PROFILE_DISABLED_SOURCE = """
+// Built without gen.py --instrument, so there are no profiling counters.
+static void commProfileCounters(uint8_t *out, uint16_t slot, bool reset) {{
+  memset(out, 0, 14);
+  out[0] = out[1] = 0xff;
+}}
+"""
+MASTER_PROFILED_STATEINFO_TEMPLATE = "{{{state}::profiledSetup, {state}::profiledEnter, {state}::profiledExit, {state}::profiledLoop, {state}::profiledEvent}}"
+
+def profile_offsets(states):
+    # The first profiling slot of each state, and then the number of slots.
+    offsets = [0]
+    for devices in states.values():
+        offsets.append(offsets[-1] + len(PROFILE_ENTRIES) + len(devices['master'].events))
+    return offsets
+
+def profile_source(states):
+    offsets = profile_offsets(states)
+    wrappers = []
+    for (name, offset) in zip(states, offsets):
+        entries = [MASTER_PROFILE_WRAPPER.format(wrapper='profiled' + entry.capitalize(), entry=entry, slot=offset + i)
+                   for (i, entry) in enumerate(PROFILE_ENTRIES[:-1])]
+        entries.append(MASTER_PROFILE_EVENT_WRAPPER.format(slot=offset + len(PROFILE_ENTRIES) - 1))
+        wrappers.append(MASTER_PROFILE_WRAPPERS.format(state=name, wrappers='\n'.join(entries)))
+    return MASTER_PROFILE_SOURCE.format(profile_slots=offsets[-1], wrappers='\n'.join(wrappers))
 
 MASTER_SOURCE_REMOTE = """namespace {name} {{
 {values}
@@ -169,16 +1073,23 @@ namespace events {{
 }}"""
 MASTER_SOURCE_REMOTE_VALUE = "RemoteValue<{remote_id}, {type}> {name}({id});"
 MASTER_SOURCE_TABLET_EVENT = "void {name}() {{ manager.sendTabletEvent({id}); }}"
-MASTER_SOURCE_REMOTE_EVENT = "void {name}() {{ manager.sendSlaveEvent({slave_id}, {id}); }}"
+MASTER_SOURCE_REMOTE_EVENT = "void {name}() {{ commBusEvent({slave_id}, {state_id}, {id}); }}"
 MASTER_SOURCE_VALUE = "Value<{type}> {name};"
 
-def generate_master(master_name, states, build_id, slaves):
+def generate_master(master_name, states, build_id, slaves, schedule=None, event_queue=0, instrument=False):
+    # |slaves| maps each slave device in the .comm file to its bus address,
+    # see load_topology(), and |schedule| is from load_bus_schedule(), or
+    # None for the defaults. Tablet values use address 0. Events are queued
+    # for commLoop() if |event_queue| is the size of the queue. With
+    # |instrument|, every state entry point and event handler is timed, see
+    # MASTER_PROFILE_SOURCE.
+    addresses = dict(slaves, tablet=0)
     namespaces = ''.join(
         MASTER_NAMESPACE_TEMPLATE.format(
             name=name,
             values=''.join(MASTER_VALUE_TEMPLATE.format(name=name, type=ty) for (name, ty) in devices['master'].values.items()),
             events='\n'.join(MASTER_EVENT_TEMPLATE.format(name=name) for name in devices['master'].events),
-            remotes='\n'.join(MASTER_REMOTE.format(name=remote_name, values='\n'.join(MASTER_REMOTE_VALUE_TEMPLATE.format(slave_id=int(remote_name[4:]) if remote_name != 'tablet' else 0, type=ty, name=name) for (name, ty) in device.values.items()), events='\n'.join(MASTER_REMOTE_EVENT_TEMPLATE.format(name=name) for name in device.events)) for (remote_name, device) in devices.items() if remote_name != master_name)
+            remotes='\n'.join(MASTER_REMOTE.format(name=remote_name, values='\n'.join(MASTER_REMOTE_VALUE_TEMPLATE.format(slave_id=addresses[remote_name], type=ty, name=name) for (name, ty) in device.values.items()), events='\n'.join(MASTER_REMOTE_EVENT_TEMPLATE.format(name=name) for name in device.events)) for (remote_name, device) in devices.items() if remote_name != master_name)
         )
         for (name, devices)
         in states.items()
@@ -188,20 +1099,24 @@ def generate_master(master_name, states, build_id, slaves):
     header = MASTER_HEADER_TEMPLATE.format(states=states_str,
                                       num_states=len(states),
                                       num_values=num_values,
+                                      num_slaves=len(slaves),
                                       namespaces=namespaces)
 
 
+    offsets = profile_offsets(states)
     states_code = ''.join(
         MASTER_SOURCE_STATE.format(
             name=name,
             hardware_values='\n'.join(MASTER_SOURCE_VALUE.format(name=name, type=ty) for (name, ty) in devices['master'].values.items()),
-            cases='\n  '.join(MASTER_SOURCE_CASE.format(name=name, id=i) for (i, name) in enumerate(devices['master'].events)),
-            remotes='\n'.join(MASTER_SOURCE_REMOTE.format(name=remote_name, values='\n'.join(MASTER_SOURCE_REMOTE_VALUE.format(remote_id=int(remote_name[4:]) if remote_name != 'tablet' else 0, type=ty, name=name, id=i) for (i, (name, ty)) in enumerate(device.values.items())), events='\n'.join((MASTER_SOURCE_TABLET_EVENT if remote_name == 'tablet' else MASTER_SOURCE_REMOTE_EVENT).format(slave_id=remote_name[4:], id=i, name=name) for (i, name) in enumerate(device.events))) for (remote_name, device) in devices.items() if remote_name != master_name)
+            cases='\n  '.join((MASTER_SOURCE_PROFILED_CASE if instrument else MASTER_SOURCE_CASE).format(name=event, id=i, slot=offsets[state_i] + len(PROFILE_ENTRIES) + i)
+                               for (i, event) in enumerate(devices['master'].events)),
+            event_body=event_body(state_i, event_queue),
+            remotes='\n'.join(MASTER_SOURCE_REMOTE.format(name=remote_name, values='\n'.join(MASTER_SOURCE_REMOTE_VALUE.format(remote_id=addresses[remote_name], type=ty, name=name, id=i) for (i, (name, ty)) in enumerate(device.values.items())), events='\n'.join((MASTER_SOURCE_TABLET_EVENT if remote_name == 'tablet' else MASTER_SOURCE_REMOTE_EVENT).format(slave_id=addresses[remote_name], state_id=state_i, id=i, name=name) for (i, name) in enumerate(device.events))) for (remote_name, device) in devices.items() if remote_name != master_name)
         )
-        for (name, devices)
-        in states.items()
+        for (state_i, (name, devices))
+        in enumerate(states.items())
     )
-    state_infos = ',\n  '.join(MASTER_STATEINFO_TEMPLATE.format(state=state) for state in states)
+    state_infos = ',\n  '.join((MASTER_PROFILED_STATEINFO_TEMPLATE if instrument else MASTER_STATEINFO_TEMPLATE).format(state=state) for state in states)
     wire_values = ',\n  '.join(MASTER_WIREVALUE_TEMPLATE.format(
         state=state,
         state_id=state_i,
@@ -210,14 +1125,58 @@ def generate_master(master_name, states, build_id, slaves):
         size='sizeof({})'.format(ty),
     ) for (state_i, (state, devices)) in enumerate(states.items())
       for (value_i, (value, ty)) in enumerate(devices['master'].values.items()))
+    reported = [(devices['tablet'].values, devices['tablet'].policies) if 'tablet' in devices else ({}, {})
+                for devices in states.values()]
+    policy_args = report_policy_args(reported, 'commSend', 'report_levels[i] != 0', '  commBusPoll();\n  commDrainEvent();\n')
+    extension_args = dict(
+        opcode_value=OPCODE_VALUE,
+        opcode_debug_setting=OPCODE_DEBUG_SETTING,
+        opcode_heartbeat=OPCODE_HEARTBEAT,
+        opcode_ack=OPCODE_ACK,
+        opcode_queue_stats=OPCODE_QUEUE_STATS,
+        opcode_profile=OPCODE_PROFILE,
+        queue_stats_reset=QUEUE_STATS_RESET,
+        profile_reset=PROFILE_RESET,
+        debug_all_values=DEBUG_ALL_VALUES,
+        frame_sync=FRAME_SYNC,
+        frame_max_length=FRAME_MAX_LENGTH,
+        crc8_poly=CRC8_POLY,
+        num_states=len(states),
+        num_reported=policy_args['num_reported'],
+        report_offsets=policy_args['report_offsets'],
+        report_levels=', '.join(['1'] * policy_args['num_reported']),
+        state_levels=', '.join(['1'] * len(states)),
+        report_policies=REPORT_POLICY_SOURCE.format(**policy_args),
+        bus_scheduler=BUS_SCHEDULER_SOURCE.format(**bus_scheduler_args(slaves, schedule)),
+        event_queue=event_queue_source(states, event_queue, stats=True),
+        profile=MASTER_PROFILE_DISABLED_SOURCE.format() if not instrument else '',
+    )
+    if all(2 <= a <= 9 for a in slaves.values()):
+        legacy_manager = MASTER_LEGACY_MANAGER.format(
+            num_states=len(states),
+            num_values=num_values,
+            build_id=build_id ^ BUILD_ID_BASIC,
+            slave_mask=sum(1 << (a - 2) for a in slaves.values()),
+        )
+    else:
+        legacy_manager = MASTER_LEGACY_MANAGER_ERROR
     source = MASTER_SOURCE_TEMPLATE.format(
+        profile=profile_source(states) if instrument else '',
         build_id=build_id,
         num_states=len(states),
         num_values=num_values,
         state_infos=state_infos,
         wire_values=wire_values,
         states_code=states_code,
-        slaves=slaves
+        # arrays can't be empty, so always leave room for one slave
+        slaves_size=max(len(slaves), 1),
+        slave_addresses=', '.join(str(a) for a in slaves.values()) or '0',
+        max_address=max(slaves.values() or [0]),
+        slave_index=', '.join(str(slaves.values().index(a)) if a in slaves.values() else 'NO_SLAVE'
+                              for a in range(max(slaves.values() or [0]) + 1)),
+        extensions=MASTER_SOURCE_EXTENSIONS.format(**extension_args),
+        legacy_manager=legacy_manager,
+        legacy_extensions=MASTER_LEGACY_EXTENSIONS.format(),
     )
 
     return header, source
@@ -235,6 +1194,28 @@ enum State {{
 }};
 
 extern SlaveManager<State, {num_states}, {num_values}> manager;
+
+// Everything below needs a Manager library that calls these hooks and
+// defines MANAGER_COMM_HOOKS, otherwise states.cpp leaves them out.
+
+// Called by the manager for opcodes from the master it doesn't handle
+// itself. Returns false if the opcode isn't known here either.
+bool commExtension(uint8_t opcode);
+
+// Per-state reporting verbosity relayed from the console, 0 means muted.
+// The manager passes a value's bytes to commShouldReport() before sending
+// it to the master, which applies the verbosity and the value's reporting
+// policy.
+uint8_t commReportLevel(uint8_t state);
+bool commShouldReport(uint8_t state, uint8_t value, const uint8_t *data, uint8_t size);
+
+// Called by the manager from loop(). Sends values their reporting policy
+// held back and resends periodic ones.
+void commLoop();
+
+// With "eventQueue" set in hardware.json, each state's event() queues the
+// event here and commLoop() runs one queued event per loop.
+void commQueueEvent(uint8_t state, uint8_t ev);
 """
 
 SUB_NAMESPACE_TEMPLATE = """namespace {name} {{
@@ -282,13 +1263,50 @@ static const WireValue wire_values[{num_values}] = {{
 SlaveManager<State, {num_states}, {num_values}> manager({amib_number}, state_infos, wire_values);
 
 {states_code}
-
+#ifdef MANAGER_COMM_HOOKS
+{extensions}
+#endif
 SLAVERECV
 """
+SUB_SOURCE_EXTENSIONS = """static const uint8_t OPCODE_VALUE = {opcode_value};
+static const uint8_t OPCODE_DEBUG_SETTING = {opcode_debug_setting};
+static const uint8_t OPCODE_HEARTBEAT = {opcode_heartbeat};
+
+static uint8_t state_levels[{num_states}] = {{{state_levels}}};
+
+uint8_t commReportLevel(uint8_t state) {{
+  return state_levels[state];
+}}
+
+static const uint16_t report_offsets[{num_states} + 1] = {{{report_offsets}}};
+
+{event_queue}
+{report_policies}
+bool commExtension(uint8_t opcode) {{
+  switch (opcode) {{
+  case OPCODE_DEBUG_SETTING: {{
+    uint8_t state = manager.readByte();
+    uint8_t level = manager.readByte();
+    if (state < {num_states}) {{
+      state_levels[state] = level;
+    }}
+    return true;
+  }}
+  case OPCODE_HEARTBEAT: {{
+    // relayed by the master from the console, echo it straight back
+    uint8_t reply[3] = {{OPCODE_HEARTBEAT, {amib_number}, manager.readByte()}};
+    manager.sendRaw(reply, sizeof(reply));
+    return true;
+  }}
+  default:
+    return false;
+  }}
+}}
+"""
 SUB_SOURCE_STATE = """namespace {name} {{
 {hardware_values}
 
-void event(uint8_t ev) {{
+void handleEvent(uint8_t ev) {{
   switch (ev) {{
   {cases}
   default:
@@ -296,6 +1314,10 @@ void event(uint8_t ev) {{
   }}
 }}
 
+void event(uint8_t ev) {{
+  {event_body}
+}}
+
 namespace master {{
 {master_values}
 
@@ -312,7 +1334,7 @@ SUB_SOURCE_MASTER_VALUE = "RemoteValue<0, {type}> {name}({id});"
 SUB_SOURCE_MASTER_EVENT = "void {name}() {{ manager.sendEvent({id}); }}"
 SUB_SOURCE_VALUE = "Value<{type}> {name};"
 
-def generate_sub(dname, states):
+def generate_sub(dname, states, address, event_queue=0):
     namespaces = ''.join(
         SUB_NAMESPACE_TEMPLATE.format(
             name=name,
@@ -336,11 +1358,12 @@ def generate_sub(dname, states):
             name=name,
             hardware_values='\n'.join(SUB_SOURCE_VALUE.format(name=name, type=ty) for (name, ty) in devices[dname].values.items()),
             cases='\n  '.join(SUB_SOURCE_CASE.format(name=name, id=i) for (i, name) in enumerate(devices[dname].events)),
+            event_body=event_body(state_i, event_queue),
             master_values='\n'.join(SUB_SOURCE_MASTER_VALUE.format(type=ty, name=name, id=i) for (i, (name, ty)) in enumerate(devices['master'].values.items())),
             master_events='\n'.join(SUB_SOURCE_MASTER_EVENT.format(id=i, name=name) for (i, name) in enumerate(devices['master'].events))
         )
-        for (name, devices)
-        in states.items()
+        for (state_i, (name, devices))
+        in enumerate(states.items())
     )
     state_infos = ',\n  '.join(SUB_STATEINFO_TEMPLATE.format(state=state) for state in states)
     wire_values = ',\n  '.join(SUB_WIREVALUE_TEMPLATE.format(
@@ -351,24 +1374,541 @@ def generate_sub(dname, states):
         size='sizeof({})'.format(ty),
     ) for (state_i, (state, devices)) in enumerate(states.items())
       for (value_i, (value, ty)) in enumerate(devices[dname].values.items()))
+    # a sub reports the values it writes to the master
+    reported = [(devices['master'].values, devices['master'].policies) for devices in states.values()]
+    policy_args = report_policy_args(reported, 'manager.sendRaw', 'state_levels[state] != 0', '  commDrainEvent();\n')
 
     source = SUB_SOURCE_TEMPLATE.format(
-        amib_number=int(dname[4:]),
+        amib_number=address,
         num_states=len(states),
         num_values=num_values,
         state_infos=state_infos,
         wire_values=wire_values,
-        states_code=states_code
+        states_code=states_code,
+        extensions=SUB_SOURCE_EXTENSIONS.format(opcode_value=OPCODE_VALUE,
+                                                opcode_debug_setting=OPCODE_DEBUG_SETTING,
+                                                opcode_heartbeat=OPCODE_HEARTBEAT,
+                                                amib_number=address,
+                                                num_states=len(states),
+                                                state_levels=', '.join(['1'] * len(states)),
+                                                report_offsets=policy_args['report_offsets'],
+                                                event_queue=event_queue_source(states, event_queue),
+                                                report_policies=REPORT_POLICY_SOURCE.format(**policy_args))
     )
 
     return header, source
 
+# Host build of the master's generated code, written by gen.py --host to
+# <console>Host. HOST_MANAGER_HEADER stands in for the Manager library and
+# host_bench.cpp times event dispatch, wire value lookup and frame decoding.
+HOST_MANAGER_HEADER = """#pragma once
+
+// Host stand-in for the AMIB Manager library, written by gen.py --host so
+// that the generated states.cpp builds and runs on a PC. Frames are read
+// and dispatched through the generated tables the way the board does it,
+// and everything sent is counted and thrown away. Timings taken against
+// it are only good for comparing one build of the generated code with
+// another.
+
+#include <stdint.h>
+#include <stddef.h>
+#include <string.h>
+#include <time.h>
+
+// calls commExtension(), commLoop() and the other hooks states.cpp defines
+#define MANAGER_COMM_HOOKS 1
+
+inline uint32_t millis() {{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec * 1000u + ts.tv_nsec / 1000000;
+}}
+
+inline uint32_t micros() {{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec * 1000000u + ts.tv_nsec / 1000;
+}}
+
+// Reads come from a buffer given to feed(), writes are only counted.
+class HostSerial {{
+public:
+  HostSerial() : in(0), in_left(0), written(0) {{}}
+
+  void feed(const uint8_t *data, size_t len) {{
+    in = data;
+    in_left = len;
+  }}
+
+  int available() {{
+    return in_left > 0;
+  }}
+
+  int read() {{
+    if (!in_left) {{
+      return -1;
+    }}
+    in_left--;
+    return *in++;
+  }}
+
+  size_t write(uint8_t b) {{
+    written++;
+    return 1;
+  }}
+
+  size_t write(const uint8_t *data, size_t len) {{
+    written += len;
+    return len;
+  }}
+
+  const uint8_t *in;
+  size_t in_left;
+  size_t written;
+}};
+
+extern HostSerial Serial;
+
+template <typename T>
+class Value {{
+public:
+  Value() : value() {{}}
+
+  operator T() const {{
+    return value;
+  }}
+
+  Value &operator=(T v) {{
+    value = v;
+    return *this;
+  }}
+
+  T value;
+}};
+
+template <uint8_t ADDRESS, typename T>
+class RemoteValue {{
+public:
+  explicit RemoteValue(uint8_t id) : id(id), value() {{}}
+
+  operator T() const {{
+    return value;
+  }}
+
+  RemoteValue &operator=(T v) {{
+    value = v;
+    return *this;
+  }}
+
+  uint8_t id;
+  T value;
+}};
+
+struct StateInfo {{
+  void (*setup)();
+  void (*enter)();
+  void (*exit)();
+  void (*loop)();
+  void (*event)(uint8_t);
+}};
+
+struct WireValue {{
+  uint8_t state;
+  uint8_t value;
+  uint8_t size;
+  Value<void *> *data;
+}};
+
+// Defined in the generated states.cpp.
+bool commExtension(uint8_t opcode);
+void commSend(const uint8_t *frame, uint8_t len);
+void commLoop();
+
+template <typename S, int NUM_STATES, int NUM_VALUES>
+class MasterManager {{
+public:
+  MasterManager(uint32_t build_id, const StateInfo *states, const WireValue *values,
+                const uint8_t *slave_addresses, uint8_t num_slaves)
+    : build_id(build_id), states(states), values(values), slave_addresses(slave_addresses),
+      num_slaves(num_slaves), state(0), sent(0) {{
+    // the generated wire table is in state order and then value order, so
+    // each state's values are a run starting at first_value[state]
+    int i = 0;
+    for (int s = 0; s <= NUM_STATES; s++) {{
+      first_value[s] = i;
+      while (i < NUM_VALUES && values[i].state == s) {{
+        i++;
+      }}
+    }}
+  }}
+
+  int numStates() const {{
+    return NUM_STATES;
+  }}
+
+  int numValues() const {{
+    return NUM_VALUES;
+  }}
+
+  const WireValue &wireValue(int i) const {{
+    return values[i];
+  }}
+
+  // Finds a value's entry in the wire table. It's a couple of array reads
+  // so that lookups time the generated table and not a search in here.
+  const WireValue *findValue(uint8_t state, uint8_t value) const {{
+    if (state >= NUM_STATES || value >= first_value[state + 1] - first_value[state]) {{
+      return 0;
+    }}
+    return &values[first_value[state] + value];
+  }}
+
+  uint8_t readByte() {{
+    while (!Serial.available()) {{}}
+    return Serial.read();
+  }}
+
+  // Reads and handles one unframed frame from Serial, as loop() does.
+  void receive() {{
+    uint8_t frame[3 + sizeof(uint32_t)];
+    frame[0] = readByte();
+    switch (frame[0]) {{
+    case 0:
+      frame[1] = readByte();
+      dispatchFrame(frame, 2);
+      break;
+    case 1:
+      frame[1] = readByte();
+      frame[2] = readByte();
+      dispatchFrame(frame, 3);
+      break;
+    case 2: {{
+      frame[1] = readByte();
+      frame[2] = readByte();
+      const WireValue *wire = findValue(frame[1], frame[2]);
+      if (!wire) {{
+        return;
+      }}
+      for (uint8_t i = 0; i < wire->size; i++) {{
+        frame[3 + i] = readByte();
+      }}
+      dispatchFrame(frame, 3 + wire->size);
+      break;
+    }}
+    case 5:
+    case 6:
+      dispatchFrame(frame, 1);
+      break;
+    default:
+      commExtension(frame[0]);
+      break;
+    }}
+  }}
+
+  void dispatchFrame(const uint8_t *frame, uint8_t len) {{
+    switch (frame[0]) {{
+    case 0:
+      setState(frame[1]);
+      break;
+    case 1:
+      if (frame[1] < NUM_STATES) {{
+        states[frame[1]].event(frame[2]);
+      }}
+      break;
+    case 2: {{
+      const WireValue *wire = findValue(frame[1], frame[2]);
+      if (wire && len == 3 + wire->size) {{
+        memcpy(wire->data, frame + 3, wire->size);
+      }}
+      break;
+    }}
+    case 5: {{
+      uint8_t reply[5] = {{5}};
+      memcpy(reply + 1, &build_id, sizeof(build_id));
+      commSend(reply, sizeof(reply));
+      break;
+    }}
+    case 6: {{
+      uint8_t reply[2] = {{6, state}};
+      commSend(reply, sizeof(reply));
+      break;
+    }}
+    }}
+  }}
+
+  void setState(uint8_t next) {{
+    if (next >= NUM_STATES) {{
+      return;
+    }}
+    if (states[state].exit) {{
+      states[state].exit();
+    }}
+    state = next;
+    if (states[state].enter) {{
+      states[state].enter();
+    }}
+  }}
+
+  void loop() {{
+    if (states[state].loop) {{
+      states[state].loop();
+    }}
+    commLoop();
+  }}
+
+  void relayHeartbeat(uint8_t amib, uint8_t seq) {{
+    sent += 3;
+  }}
+
+  void relayDebugSetting(uint8_t state, uint8_t level) {{
+    sent += 3;
+  }}
+
+  void sendTabletEvent(uint8_t event) {{
+    sent += 3;
+  }}
+
+  void sendSlaveFrame(uint8_t address, const uint8_t *frame, uint8_t len) {{
+    sent += len;
+  }}
+
+  uint32_t build_id;
+  const StateInfo *states;
+  const WireValue *values;
+  const uint8_t *slave_addresses;
+  uint8_t num_slaves;
+  uint8_t state;
+  // bytes the board would have sent to slaves
+  size_t sent;
+  uint16_t first_value[NUM_STATES + 1];
+}};
+"""
+
+HOST_SCHEMA_SOURCE = """#include "states.h"
+
+// The master's events are written by hand for the board. Here they only
+// count calls, so that dispatching them can't be optimised away.
+volatile uint32_t host_event_calls = 0;
+
+{stubs}
+// number of master events in each state
+extern const uint8_t host_event_counts[{num_states}] = {{{event_counts}}};
+"""
+HOST_SCHEMA_STUBS = """namespace {state} {{
+namespace events {{
+{events}
+}}
+}}
+"""
+HOST_SCHEMA_STUB = "void {name}() {{ host_event_calls++; }}"
+
+HOST_BENCH_SOURCE = """// Microbenchmarks for the generated code, written by gen.py --host. Each
+// one runs for about the given number of seconds (default 0.2) and prints
+// its name, the operations run and nanoseconds per operation.
+//
+// Usage: ./{name}HostBench [seconds]
+#include <stdio.h>
+#include <stdlib.h>
+#include <chrono>
+#include <vector>
+
+#include "states.h"
+
+HostSerial Serial;
+
+// From host_schema.cpp.
+extern volatile uint32_t host_event_calls;
+extern const uint8_t host_event_counts[];
+
+static double seconds = 0.2;
+
+static double now() {{
+  return std::chrono::duration<double>(std::chrono::steady_clock::now().time_since_epoch()).count();
+}}
+
+// Calls |pass| until |seconds| have gone by. Each pass does |ops|
+// operations, and small passes are batched so reading the clock doesn't
+// show up in the result.
+template <typename F>
+static void bench(const char *name, size_t ops, F pass) {{
+  if (!ops) {{
+    printf("%-8s %12d %10s\\n", name, 0, "-");
+    return;
+  }}
+  size_t batch = ops < 1000 ? 1000 / ops : 1;
+  size_t done = 0;
+  double start = now(), elapsed;
+  do {{
+    for (size_t i = 0; i < batch; i++) {{
+      pass();
+    }}
+    done += ops * batch;
+    elapsed = now() - start;
+  }} while (elapsed < seconds);
+  printf("%-8s %12lu %10.2f\\n", name, (unsigned long) done, elapsed * 1e9 / done);
+  fflush(stdout);
+}}
+
+static uint8_t crc8(const uint8_t *data, size_t len) {{
+  uint8_t crc = 0;
+  for (size_t i = 0; i < len; i++) {{
+    crc ^= data[i];
+    for (uint8_t b = 0; b < 8; b++) {{
+      crc = crc & 0x80 ? (crc << 1) ^ {crc8_poly:#04x} : crc << 1;
+    }}
+  }}
+  return crc;
+}}
+
+static void append(std::vector<uint8_t> &stream, const std::vector<uint8_t> &frame, bool framed) {{
+  if (!framed) {{
+    stream.insert(stream.end(), frame.begin(), frame.end());
+    return;
+  }}
+  std::vector<uint8_t> checked(1, frame.size());
+  checked.insert(checked.end(), frame.begin(), frame.end());
+  stream.push_back({frame_sync:#x});
+  stream.insert(stream.end(), checked.begin(), checked.end());
+  stream.push_back(crc8(&checked[0], checked.size()));
+}}
+
+int main(int argc, char **argv) {{
+  if (argc > 1) {{
+    seconds = atof(argv[1]);
+  }}
+  srand(1);
+
+  // every value and event, in a shuffled order so the benchmarks don't
+  // just walk the tables
+  std::vector<std::vector<uint8_t> > value_frames, event_frames;
+  for (int i = 0; i < manager.numValues(); i++) {{
+    const WireValue &wire = manager.wireValue(i);
+    std::vector<uint8_t> frame;
+    frame.push_back(2);
+    frame.push_back(wire.state);
+    frame.push_back(wire.value);
+    for (uint8_t b = 0; b < wire.size; b++) {{
+      frame.push_back(b == 0 ? rand() & 1 : rand());
+    }}
+    value_frames.push_back(frame);
+  }}
+  for (int state = 0; state < manager.numStates(); state++) {{
+    for (int ev = 0; ev < host_event_counts[state]; ev++) {{
+      uint8_t frame[3] = {{1, (uint8_t) state, (uint8_t) ev}};
+      event_frames.push_back(std::vector<uint8_t>(frame, frame + 3));
+    }}
+  }}
+  for (size_t i = value_frames.size(); i > 1; i--) {{
+    std::swap(value_frames[i - 1], value_frames[rand() % i]);
+  }}
+  for (size_t i = event_frames.size(); i > 1; i--) {{
+    std::swap(event_frames[i - 1], event_frames[rand() % i]);
+  }}
+
+  printf("%d states, %d values, %lu events\\n", manager.numStates(), manager.numValues(), (unsigned long) event_frames.size());
+
+  std::vector<uint8_t> keys;
+  for (size_t i = 0; i < value_frames.size(); i++) {{
+    keys.push_back(value_frames[i][1]);
+    keys.push_back(value_frames[i][2]);
+  }}
+  volatile uint32_t sink = 0;
+  bench("lookup", value_frames.size(), [&]() {{
+    uint32_t sizes = 0;
+    for (size_t i = 0; i < keys.size(); i += 2) {{
+      sizes += manager.findValue(keys[i], keys[i + 1])->size;
+    }}
+    sink += sizes;
+  }});
+
+  // with "eventQueue" set, dispatching only queues the event, so the
+  // event is run by commLoop() straight after
+  bench("event", event_frames.size(), [&]() {{
+    for (size_t i = 0; i < event_frames.size(); i++) {{
+      manager.dispatchFrame(&event_frames[i][0], 3);
+      commLoop();
+    }}
+  }});
+
+  bench("loop", 1000, [&]() {{
+    for (int i = 0; i < 1000; i++) {{
+      commLoop();
+    }}
+  }});
+
+  // every frame once, raw as the console sends them and then framed
+  for (int framed = 0; framed < 2; framed++) {{
+    std::vector<uint8_t> stream;
+    for (size_t i = 0; i < value_frames.size(); i++) {{
+      append(stream, value_frames[i], framed);
+    }}
+    for (size_t i = 0; i < event_frames.size(); i++) {{
+      append(stream, event_frames[i], framed);
+    }}
+    size_t frames = value_frames.size() + event_frames.size();
+    bench(framed ? "framed" : "decode", frames, [&]() {{
+      Serial.feed(&stream[0], stream.size());
+      while (Serial.available()) {{
+        manager.receive();
+      }}
+    }});
+  }}
+
+  if (host_event_calls == 0 && !event_frames.empty()) {{
+    fprintf(stderr, "events weren't dispatched\\n");
+    return 1;
+  }}
+  return 0;
+}}
+"""
+
+HOST_CMAKE_TEMPLATE = """cmake_minimum_required(VERSION 3.6)
+project({name}Host)
+
+set(CMAKE_CXX_FLAGS "${{CMAKE_CXX_FLAGS}} -std=c++11")
+if(NOT CMAKE_BUILD_TYPE)
+    set(CMAKE_BUILD_TYPE Release)
+endif()
+
+set(SOURCE_FILES states.cpp host_schema.cpp host_bench.cpp)
+add_executable({name}HostBench ${{SOURCE_FILES}})
+target_include_directories({name}HostBench PRIVATE ${{CMAKE_CURRENT_SOURCE_DIR}})
+"""
+
+def generate_host(console_name, states, header, source):
+    # Files for a host build of the master's |header| and |source|, by name.
+    stubs = ''.join(
+        HOST_SCHEMA_STUBS.format(state=name, events='\n'.join(HOST_SCHEMA_STUB.format(name=name) for name in devices['master'].events))
+        for (name, devices) in states.items() if devices['master'].events
+    )
+    files = OrderedDict()
+    files['Manager.h'] = HOST_MANAGER_HEADER.format()
+    files['states.h'] = header
+    files['states.cpp'] = source
+    files['host_schema.cpp'] = HOST_SCHEMA_SOURCE.format(
+        stubs=stubs,
+        num_states=len(states),
+        event_counts=', '.join(str(len(devices['master'].events)) for devices in states.values()),
+    )
+    files['host_bench.cpp'] = HOST_BENCH_SOURCE.format(name=console_name, frame_sync=FRAME_SYNC, crc8_poly=CRC8_POLY)
+    files['CMakeLists.txt'] = HOST_CMAKE_TEMPLATE.format(name=console_name)
+    return files
+
 TABLET_SOURCE_TEMPLATE = """
+{codecs}
 {states}
 var STATES = {{
   {states_object}
 }};
-var manager = new Manager([{state_names}]);
+// VALUE_DECODERS[state id][value id] reads the value out of a value frame
+// and VALUE_FRAME_SIZES[state id][value id] is that frame's length
+var VALUE_DECODERS = [
+  {decoders}
+];
+var VALUE_FRAME_SIZES = [
+  {frame_sizes}
+];
+var manager = new Manager([{state_names}], VALUE_DECODERS, VALUE_FRAME_SIZES);
 """
 TABLET_STATE_TEMPLATE = """var {name} = {{
   id: {id},
@@ -393,11 +1933,60 @@ var STATE_{name} = {id};
 """
 TABLET_STATE_OBJECT = "{name}: {name}"
 
-TABLET_HARDWARE_VALUE = "{name}: new HardwareValue({state_id}, {id}, {type})"
+TABLET_HARDWARE_VALUE = "{name}: new HardwareValue({state_id}, {id}, {type}, encode_{state}_{name})"
 TABLET_HARDWARE_EVENT = "{name}: function {name}() {{ manager.sendEvent({id}, {state_id}); }}"
-TABLET_TABLET_VALUE = "{name}: new LocalValue({id}, {type})"
+TABLET_TABLET_VALUE = "{name}: new LocalValue({id}, {type}, decode_{state}_{name})"
 TABLET_TABLET_EVENT = "{name}: new LocalEvent({state_id}, {id})"
 
+# Value frames are the opcode, state id, value id and then the value,
+# little-endian like the AMIBs. The codecs read and write a DataView at
+# fixed offsets, so nothing is looked up by type per frame.
+TABLET_ENCODER_TEMPLATE = """// Writes a frame setting {state}.{name} to |value|, returning its length.
+function encode_{state}_{name}(view, offset, value) {{
+  view.setUint8(offset, {opcode});
+  view.setUint8(offset + 1, {state_id});
+  view.setUint8(offset + 2, {id});
+  {set};
+  return {length};
+}}
+"""
+TABLET_DECODER_TEMPLATE = """// Reads {state}.{name} from a value frame at |offset|.
+function decode_{state}_{name}(view, offset) {{
+  return {get};
+}}
+"""
+
+# DataView accessor suffix and size in bytes of each type. bool is sent as
+# one byte.
+JS_DATAVIEW_TYPES = {
+    "bool": ("Uint8", 1),
+    "uint8_t": ("Uint8", 1),
+    "int8_t": ("Int8", 1),
+    "uint16_t": ("Uint16", 2),
+    "int16_t": ("Int16", 2),
+    "uint32_t": ("Uint32", 4),
+    "int32_t": ("Int32", 4),
+}
+
+def js_value_size(ty):
+    return JS_DATAVIEW_TYPES[ty][1]
+
+def js_encoder(state, state_id, name, i, ty):
+    accessor, size = JS_DATAVIEW_TYPES[ty]
+    value = 'value ? 1 : 0' if ty == 'bool' else 'value'
+    little_endian = ', true' if size > 1 else ''
+    return TABLET_ENCODER_TEMPLATE.format(
+        state=state, name=name, state_id=state_id, id=i, opcode=OPCODE_VALUE, length=3 + size,
+        set='view.set%s(offset + 3, %s%s)' % (accessor, value, little_endian),
+    )
+
+def js_decoder(state, name, ty):
+    accessor, size = JS_DATAVIEW_TYPES[ty]
+    get = 'view.get%s(offset + 3%s)' % (accessor, ', true' if size > 1 else '')
+    if ty == 'bool':
+        get += ' !== 0'
+    return TABLET_DECODER_TEMPLATE.format(state=state, name=name, get=get)
+
 def c_to_js_type(ty):
     return "Manager.TYPE_" + {
         "bool": "BOOL",
@@ -411,12 +2000,22 @@ def c_to_js_type(ty):
 
 def generate_tablet(states, build_id):
     states_s = ""
+    codecs_s = ""
+    decoders = []
+    frame_sizes = []
     for state_id, (state, devices) in enumerate(states.items()):
-        hw_values, hw_events = devices['master']
-        t_values, t_events = devices['tablet']
+        hw_values, hw_events, _ = devices['master']
+        t_values, t_events, _ = devices['tablet']
+
+        for (i, (name, ty)) in enumerate(hw_values.items()):
+            codecs_s += js_encoder(state, state_id, name, i, ty)
+        for (name, ty) in t_values.items():
+            codecs_s += js_decoder(state, name, ty)
+        decoders.append('[%s]' % ', '.join('decode_%s_%s' % (state, name) for name in t_values))
+        frame_sizes.append('[%s]' % ', '.join(str(3 + js_value_size(ty)) for ty in t_values.values()))
 
         hw_values_s = ',\n      '.join(
-            TABLET_HARDWARE_VALUE.format(state_id=state_id, name=name, id=i, type=c_to_js_type(ty))
+            TABLET_HARDWARE_VALUE.format(state=state, state_id=state_id, name=name, id=i, type=c_to_js_type(ty))
             for (i, (name, ty))
             in enumerate(hw_values.items())
         )
@@ -427,7 +2026,7 @@ def generate_tablet(states, build_id):
         )
 
         t_values_s = ',\n      '.join(
-            TABLET_TABLET_VALUE.format(name=name, id=i, type=c_to_js_type(ty))
+            TABLET_TABLET_VALUE.format(state=state, name=name, id=i, type=c_to_js_type(ty))
             for (i, (name, ty))
             in enumerate(t_values.items())
         )
@@ -447,36 +2046,102 @@ def generate_tablet(states, build_id):
         )
 
     return TABLET_SOURCE_TEMPLATE.format(
+        codecs=codecs_s,
         states=states_s,
+        decoders=',\n  '.join(decoders),
+        frame_sizes=',\n  '.join(frame_sizes),
         state_names=', '.join(states),
         states_object=',\n  '.join(TABLET_STATE_OBJECT.format(name=state) for state in states)
     )
 
+# Binary telemetry log written by the console's "record" command and read
+# back by telemetry.py. The header holds the number of valid records, since
+# the file is preallocated past the end of the data. Each record is a
+# timestamp, state id, value id, value size and the raw value bytes, zero
+# padded to four bytes.
+TELEMETRY_MAGIC = 'AMIBTLM1'
+TELEMETRY_HEADER = '<8sII'
+TELEMETRY_RECORD = '<dBBBx4s'
+
+# Session file written by the console's "session" command and replayed by
+# replay.py. The header holds the build ID and the state when recording
+# started. Each record is a timestamp from the start of the session, the
+# direction and the frame length, followed by the frame itself.
+SESSION_MAGIC = 'AMIBSES1'
+SESSION_HEADER = '<8sIB'
+SESSION_RECORD = '<dBB'
+SESSION_OUT = 0
+SESSION_IN = 1
+
 DEBUG_SOURCE_TEMPLATE = r"""#!/usr/bin/env python2
 import re
 import sys
 import json
 import time
+import bisect
 import struct
-try:
-    import readline
-except ImportError:
-    import pyreadline as readline
+import argparse
 import threading
 from collections import OrderedDict, namedtuple
 import os
 
 import serial
 import serial.tools.list_ports
+try:
+    import numpy
+except ImportError:
+    # only needed for the stats command
+    numpy = None
 
 State = namedtuple('State', ('name', 'id', 'devices'))
-DeviceState = namedtuple('DeviceState', ('values', 'events'))
+DeviceState = namedtuple('DeviceState', ('values', 'events', 'policies'))
+ReportPolicy = namedtuple('ReportPolicy', ('on_change', 'max_rate', 'period_ms'))
 
 STATES = {states}
 
-if len(sys.argv) > 2:
-    print >>sys.stderr, "Usage: python gen.py [serialport]"
-    sys.exit(1)
+# Names sorted with their ids, by state id where they belong to a state, so
+# that looking up or completing a name doesn't scan them all.
+SORTED_STATES = {sorted_states}
+SORTED_MASTER_VALUES = {sorted_master_values}
+SORTED_MASTER_EVENTS = {sorted_master_events}
+SORTED_TABLET_VALUES = {sorted_tablet_values}
+
+# Finds names and the ranges of names starting with a prefix by bisecting
+# a sorted list of (name, item).
+class NameIndex(object):
+    def __init__(self, pairs):
+        self.names = [name for (name, _) in pairs]
+        self.items = dict(pairs)
+
+    def __contains__(self, name):
+        return name in self.items
+
+    def get(self, name, default=None):
+        return self.items.get(name, default)
+
+    def range(self, prefix):
+        lo = bisect.bisect_left(self.names, prefix)
+        hi = bisect.bisect_left(self.names, prefix + '\xff', lo)
+        return lo, hi
+
+    def matches(self, prefix):
+        lo, hi = self.range(prefix)
+        return self.names[lo:hi]
+
+    # The longest prefix shared by every name starting with |prefix|, or
+    # None if there are none. The names are sorted, so that's the prefix
+    # the first and last of them share.
+    def common_prefix(self, prefix):
+        lo, hi = self.range(prefix)
+        if lo == hi:
+            return None
+        return os.path.commonprefix([self.names[lo], self.names[hi - 1]])
+
+STATE_INDEX = NameIndex([(name, STATES[i]) for (name, i) in SORTED_STATES])
+MASTER_VALUE_INDEX = [NameIndex([(name, (i, state.devices['master'].values[name])) for (name, i) in names])
+                      for (state, names) in zip(STATES, SORTED_MASTER_VALUES)]
+MASTER_EVENT_INDEX = [NameIndex(names) for names in SORTED_MASTER_EVENTS]
+TABLET_VALUE_INDEX = [NameIndex(names) for names in SORTED_TABLET_VALUES]
 
 def comm_error():
     print >>sys.stderr, "Communications error, exiting..."
@@ -513,12 +2178,329 @@ def parse_val(ty, s):
     else:
         raise ValueError("unknown type %r" % ty)
 
-if len(sys.argv) == 2:
-    com_port = sys.argv[1]
-else:
+# time.monotonic() only exists on Python 3, so read the OS clock through
+# ctypes: CLOCK_MONOTONIC on Linux and the performance counter on Windows.
+# Anywhere else os.times() has the elapsed real time, which doesn't follow
+# the wall clock either but only ticks at 100Hz. The zero point is
+# arbitrary, so only differences between timestamps mean anything.
+def make_monotonic():
+    import ctypes
+    import ctypes.util
+    if sys.platform.startswith('linux'):
+        CLOCK_MONOTONIC = 1
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        timespec = ctypes.c_long * 2
+        def monotonic():
+            ts = timespec()
+            if libc.clock_gettime(CLOCK_MONOTONIC, ts) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts[0] + ts[1] * 1e-9
+        return monotonic
+    if sys.platform == 'win32':
+        kernel32 = ctypes.windll.kernel32
+        frequency = ctypes.c_int64()
+        kernel32.QueryPerformanceFrequency(ctypes.byref(frequency))
+        def monotonic():
+            counter = ctypes.c_int64()
+            kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+            return counter.value / float(frequency.value)
+        return monotonic
+    return lambda: os.times()[4]
+monotonic = make_monotonic()
+
+TELEMETRY_MAGIC  = {telemetry_magic!r}
+TELEMETRY_HEADER = {telemetry_header!r}
+TELEMETRY_RECORD = {telemetry_record!r}
+
+# Appends every received value to a fixed-record binary log (see
+# telemetry.py for the reader). Records are packed in memory and written
+# out in batches, and the file is grown in large preallocated chunks so
+# long soak runs don't pay for a resize on every write.
+class TelemetryRecorder(object):
+    def __init__(self, path, build_id, batch_size=256, prealloc=65536):
+        self.path       = path
+        self.build_id   = build_id
+        self.batch_size = batch_size
+        self.prealloc   = prealloc
+        self.lock       = threading.Lock()
+        self.pending    = []
+        self.count      = 0
+        self.capacity   = 0
+        self.f          = open(path, 'w+b')
+        self.header_size = struct.calcsize(TELEMETRY_HEADER)
+        self.record_size = struct.calcsize(TELEMETRY_RECORD)
+        self._write_header()
+        self._grow(self.prealloc)
+
+    def _write_header(self):
+        self.f.seek(0)
+        self.f.write(struct.pack(TELEMETRY_HEADER, TELEMETRY_MAGIC, self.build_id, self.count))
+
+    def _grow(self, records):
+        self.capacity += records
+        self.f.truncate(self.header_size + self.capacity * self.record_size)
+
+    def record(self, state_id, value_id, raw):
+        rec = struct.pack(TELEMETRY_RECORD, monotonic(), state_id, value_id, len(raw), raw)
+        self.lock.acquire()
+        try:
+            # values can still arrive while "record" is stopping
+            if self.f.closed:
+                return
+            self.pending.append(rec)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        while self.count + len(self.pending) > self.capacity:
+            self._grow(self.prealloc)
+        self.f.seek(self.header_size + self.count * self.record_size)
+        self.f.write(''.join(self.pending))
+        self.count += len(self.pending)
+        self.pending = []
+        self._write_header()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f.closed:
+                return
+            self._flush()
+            self.f.truncate(self.header_size + self.count * self.record_size)
+            self.f.close()
+        finally:
+            self.lock.release()
+
+recorder = None
+
+SESSION_MAGIC  = {session_magic!r}
+SESSION_HEADER = {session_header!r}
+SESSION_RECORD = {session_record!r}
+SESSION_OUT    = {session_out}
+SESSION_IN     = {session_in}
+
+# Records every command sent and every frame received, for replay.py.
+# Frames that arrive after close(), such as while the "session" command is
+# stopping a recording, are dropped.
+class SessionRecorder(object):
+    def __init__(self, path, build_id, state_id):
+        self.path   = path
+        self.lock   = threading.Lock()
+        self.count  = 0
+        self.closed = False
+        self.f      = open(path, 'wb')
+        self.f.write(struct.pack(SESSION_HEADER, SESSION_MAGIC, build_id, state_id))
+        self.start  = monotonic()
+
+    def record(self, direction, frame):
+        rec = struct.pack(SESSION_RECORD, monotonic() - self.start, direction, len(frame)) + frame
+        self.lock.acquire()
+        try:
+            if not self.closed:
+                self.f.write(rec)
+                self.count += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self.f.close()
+        finally:
+            self.lock.release()
+
+session = None
+
+TRACE_PID      = 1
+TRACE_STATE    = 1
+TRACE_COMMANDS = 2
+TRACE_BOARD    = 3
+
+# Writes a timeline of the session in the Chrome trace event format, for
+# chrome://tracing or ui.perfetto.dev. Each state is a span, commands and
+# tablet events are instants and received values are counters. Callers only
+# append to a list; a background thread formats and writes the events in
+# batches so tracing doesn't hold up the receive thread.
+class TraceWriter(object):
+    def __init__(self, path, build_id, interval=0.2, max_pending=100000):
+        self.path        = path
+        self.interval    = interval
+        self.max_pending = max_pending
+        self.lock        = threading.Lock()
+        self.pending     = []
+        self.count       = 0
+        self.dropped     = 0
+        self.span        = None
+        self.first       = True
+        self.f           = open(path, 'wb')
+        self.f.write('[\n')
+        self.start       = monotonic()
+        self.stopping    = threading.Event()
+
+        self._metadata('process_name', 0, 'master AMIB %08x' % build_id)
+        for (tid, name) in ((TRACE_STATE, 'state'), (TRACE_COMMANDS, 'commands'), (TRACE_BOARD, 'board')):
+            self._metadata('thread_name', tid, name)
+            self._metadata('thread_sort_index', tid, tid)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _metadata(self, name, tid, value):
+        key = 'sort_index' if name.endswith('sort_index') else 'name'
+        self._write_events([{{'name': name, 'ph': 'M', 'pid': TRACE_PID, 'tid': tid, 'args': {{key: value}}}}])
+
+    def _append(self, event):
+        if len(self.pending) >= self.max_pending:
+            self.dropped += 1
+        else:
+            self.pending.append(event)
+
+    # Ends the span of the previous state and starts one for |name|.
+    def state(self, name, cause):
+        now = monotonic()
+        self.lock.acquire()
+        try:
+            if self.span is not None:
+                self._append((now, 'E', TRACE_STATE, self.span, None))
+            self._append((now, 'B', TRACE_STATE, name, {{'cause': cause}}))
+            self.span = name
+        finally:
+            self.lock.release()
+
+    def instant(self, tid, name, args=None):
+        event = (monotonic(), 'i', tid, name, args)
+        self.lock.acquire()
+        self._append(event)
+        self.lock.release()
+
+    def counter(self, name, value):
+        event = (monotonic(), 'C', 0, name, value)
+        self.lock.acquire()
+        self._append(event)
+        self.lock.release()
+
+    def _format(self, event):
+        t, ph, tid, name, args = event
+        out = {{'name': name, 'ph': ph, 'ts': round((t - self.start) * 1e6, 1), 'pid': TRACE_PID, 'tid': tid}}
+        if ph == 'C':
+            # counters are named after STATE.value and chart one series
+            out['args'] = {{'value': int(args) if isinstance(args, bool) else args}}
+        elif args is not None:
+            out['args'] = args
+        if ph == 'i':
+            out['s'] = 't'
+        return out
+
+    def _write_events(self, events):
+        if not events:
+            return
+        lines = [json.dumps(event, separators=(',', ':')) for event in events]
+        self.f.write(('' if self.first else ',\n') + ',\n'.join(lines))
+        self.first = False
+        self.count += len(events)
+
+    def _flush(self):
+        self.lock.acquire()
+        events, self.pending = self.pending, []
+        self.lock.release()
+        self._write_events([self._format(event) for event in events])
+        self.f.flush()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.stopping.wait(self.interval)
+            self._flush()
+
+    def close(self):
+        self.lock.acquire()
+        if self.span is not None:
+            self._append((monotonic(), 'E', TRACE_STATE, self.span, None))
+            self.span = None
+        self.lock.release()
+        self.stopping.set()
+        self.thread.join()
+        self._flush()
+        self.f.write('\n]\n')
+        self.f.close()
+
+tracer = None
+
+# Fixed-size history of one received value, used by the stats command.
+# Pushing is the only per-sample work; all statistics are computed over the
+# whole buffer at once with NumPy.
+class ValueRing(object):
+    def __init__(self, capacity=4096):
+        self.lock     = threading.Lock()
+        self.times    = numpy.zeros(capacity)
+        self.values   = numpy.zeros(capacity)
+        self.capacity = capacity
+        self.next     = 0
+        self.total    = 0
+
+    def push(self, t, v):
+        self.lock.acquire()
+        self.times[self.next] = t
+        self.values[self.next] = v
+        self.next = (self.next + 1) % self.capacity
+        self.total += 1
+        self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            if self.total < self.capacity:
+                return self.times[:self.total].copy(), self.values[:self.total].copy()
+            return numpy.roll(self.times, -self.next), numpy.roll(self.values, -self.next)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        times, values = self.snapshot()
+        if len(values) == 0:
+            return None
+        gaps = numpy.diff(times)
+        span = times[-1] - times[0]
+        return {{
+            'count':  self.total,
+            'min':    values.min(),
+            'max':    values.max(),
+            'mean':   values.mean(),
+            'stddev': values.std(),
+            'rate':   (len(times) - 1) / span if span > 0 else 0.0,
+            'jitter': gaps.std() if len(gaps) else 0.0,
+        }}
+
+# (state id, value id) -> ValueRing, filled in by RecvHandler
+value_rings = {{}}
+
+STATS_HEADER = "%-20s %8s %12s %12s %12s %12s %9s %11s" % ('value', 'count', 'min', 'max', 'mean', 'stddev', 'rate(Hz)', 'jitter(ms)')
+
+def print_stats(names):
+    print STATS_HEADER
+    for (state_id, value_id), ring in sorted(value_rings.items()):
+        name = TABLET_VALUES[state_id][value_id][0]
+        if names and name not in names:
+            continue
+        st = ring.stats()
+        print "%-20s %8d %12g %12g %12g %12g %9.2f %11.3f" % (
+            name, st['count'], st['min'], st['max'], st['mean'],
+            st['stddev'], st['rate'], st['jitter'] * 1000)
+
+# Finds the serial port of the master AMIB listed in hardware.json.
+def find_port():
     try:
         hardware = json.load(open("hardware.json", 'rb'))
-        master = min((int(name[4:]), serial) for (name, serial) in hardware['AMIBs'].items())[1]
+        if 'master' in hardware:
+            master = hardware['AMIBs'][hardware['master']]
+        else:
+            master = min((int(name[4:]), serial) for (name, serial) in hardware['AMIBs'].items())[1]
         master_serial = master['serialNumber'].encode('utf-8')
     except (IOError, ValueError, IndexError, KeyError):
         print >>sys.stderr, "Non-existent or invalid hardware.json file"
@@ -526,31 +2508,78 @@ else:
 
     for port in serial.tools.list_ports.comports():
         if port.serial_number == master_serial:
-            com_port = port.device
-            break
+            return port.device
     else:
         print >>sys.stderr, "Master AMIB not connected"
         sys.exit(2)
 
-port = serial.Serial(com_port, 9600)
-
-time.sleep(1)
-
-port.write("\x05")
-if port.read(1) != '\x05':
-    comm_error()
-
-its_build_id, = struct.unpack("<I", port.read(4))
 my_build_id = {build_id:#08x}
-if its_build_id != my_build_id:
-    print >>sys.stderr, "Mismatching build IDs: expected %#08x but got %#08x, exiting" % (my_build_id, its_build_id)
-    sys.exit(3)
-
-port.write("\x06")
-if port.read(1) != '\x06':
-    comm_error()
 
-cur_state = STATES[ord(port.read(1))]
+# A master built without MANAGER_COMM_HOOKS reports my_build_id with this
+# bit flipped. It only handles states, values and events, so connect()
+# clears comm_hooks and the commands that need more refuse to run.
+BUILD_ID_BASIC = {build_id_basic:#x}
+comm_hooks     = True
+# the build ID the master reported, recorded with sessions
+board_build_id = None
+
+port      = None
+cur_state = None
+handler   = None
+
+# Opens the port, checks the build ID, fetches the current state and starts
+# the receive thread.
+def connect(com_port):
+    global port, cur_state, handler, comm_hooks, board_build_id, framed
+
+    # a URL like socket://localhost:5331 attaches through bridge.py
+    port = serial.serial_for_url(com_port, 9600)
+
+    time.sleep(1)
+
+    port.write("\x05")
+    if port.read(1) != '\x05':
+        comm_error()
+
+    its_build_id, = struct.unpack("<I", port.read(4))
+    if its_build_id not in (my_build_id, my_build_id ^ BUILD_ID_BASIC):
+        print >>sys.stderr, "Mismatching build IDs: expected %#08x but got %#08x, exiting" % (my_build_id, its_build_id)
+        sys.exit(3)
+    board_build_id = its_build_id
+    comm_hooks = its_build_id == my_build_id
+    if framed and not comm_hooks:
+        print >>sys.stderr, "The master was built without MANAGER_COMM_HOOKS, so frames are sent unframed"
+        framed = False
+
+    port.write("\x06")
+    if port.read(1) != '\x06':
+        comm_error()
+
+    cur_state = STATES[ord(port.read(1))]
+    if tracer is not None:
+        tracer.state(cur_state.name, 'sync')
+
+    if framed:
+        # the board only frames its replies once it has seen a framed
+        # frame, and a heartbeat does nothing else
+        write_frame(chr(OPCODE_HEARTBEAT) + '\x00\x00')
+
+    handler = RecvHandler(port, framed)
+    handler.thread = threading.Thread(target=handler.handle)
+    handler.thread.daemon = True
+    handler.thread.start()
+    display.start()
+
+# Stops the display and receive threads and closes the port.
+def disconnect():
+    display.stop()
+    # without this the receive thread can still be blocked in read() while
+    # the interpreter shuts down, which prints a confusing traceback
+    handler.closing = True
+    if hasattr(port, 'cancel_read'):
+        port.cancel_read()
+        handler.thread.join(1)
+    port.close()
 
 CMDS = [
     'event',
@@ -558,6 +2587,16 @@ CMDS = [
     'state',
     'value',
     'test',
+    'record',
+    'session',
+    'trace',
+    'stats',
+    'ack',
+    'ping',
+    'queue',
+    'profile',
+    'verbosity',
+    'display',
     'quit'
 ]
 
@@ -566,6 +2605,16 @@ HELP_TEXT = (
     "value [name] [value]: list values or change value\n"
     "event [name]: list events or send event\n"
     "test [name] [args]: run automated test\n"
+    "record [file]: start recording received values to file, or stop recording\n"
+    "session [file]: start recording a session for replay.py, or stop recording\n"
+    "trace [file]: start writing a Chrome/Perfetto timeline to file, or stop tracing\n"
+    "stats [names]: show statistics for received values\n"
+    "ack [on [window]|off]: show or change acknowledged sending\n"
+    "ping [count] [rate] [amib]: measure heartbeat round trips to the master or a slave\n"
+    "queue [reset]: show the master's deferred event queue, reset clears the high water mark\n"
+    "profile [reset]: show time spent in each state and event handler (gen.py --instrument), reset clears it\n"
+    "verbosity [state] [value] [level]: show or change firmware reporting, 0 mutes\n"
+    "display [fps]: show display counters or change the refresh rate, 0 hides values\n"
     "quit: quit"
 )
 
@@ -577,18 +2626,26 @@ verbose_tests = True
 # method.
 class AutomatedTest(object):
     def __init__(self, name):
-        self.name = name
+        self.name     = name
+        self.duration = None
+        self.error    = None
 
     # Call this to run the test. Wraps test_function() with some error
-    # and exception handling.
+    # and exception handling, and records how long it took and why it
+    # failed.
     def run_test(self, args):
+        start = time.time()
         try:
             self.test_function(args)
+            self.error = None
             print self.name + ' finished'
             return True
         except Exception as e:
+            self.error = str(e)
             print '%s failed: %s' % (self.name, e)
             return False
+        finally:
+            self.duration = time.time() - start
 
     # Test runner function. Override this from subclasses. |args| is a list
     # of any additional args the user passed in. If the test fails, this
@@ -600,6 +2657,9 @@ class AutomatedTest(object):
 #   1. Create a file named debug_tests.py.
 #   2. Create test classes in debug_tests.py that inherit from AutomatedTest.
 #   3. Add all test classes to a global list named TESTS.
+# Tests can use wait_for_value() and wait_for_event() (defined below) to
+# wait for the hardware to respond instead of sleeping. Names are either
+# "STATE.name" or a name in the current state.
 # Generally importing modules is much preferred to executing text like this,
 # but in this case we have some circular dependencies so importing won't work.
 # The best solution would be to break this file into parts so we can
@@ -619,64 +2679,304 @@ class AllTests(AutomatedTest):
 	    if test is self:
 	        continue
 	    if not test.run_test(args):
-	        return False
+	        raise Exception('%s failed' % test.name)
 
 if TESTS:
     TESTS.append(AllTests('all'))
 
+TEST_INDEX = NameIndex(sorted((t.name, t) for t in TESTS or []))
+CMD_INDEX = NameIndex(sorted((c, c) for c in CMDS))
+
 def common_prefix(possible, prefix):
-    so_far = None
-    for opt in possible:
-        if opt.startswith(prefix):
-            if so_far == None:
-                so_far = opt
-            else:
-                # guaranteed not to get StopIteration because all possibilities must be different
-                i = next(i for (i, (c1, c2)) in enumerate(zip(so_far, opt)) if c1 != c2)
-                so_far = so_far[:i]
-    return so_far
+    return NameIndex(sorted((opt, opt) for opt in possible)).common_prefix(prefix)
+
+# The index of names the last word of |words| completes from, or None.
+def completion_index(cmd, args):
+    if len(args) == 0:
+        return CMD_INDEX
+    elif cmd == 'state' and len(args) == 1:
+        return STATE_INDEX
+    elif cmd == 'value' and len(args) == 1:
+        return MASTER_VALUE_INDEX[cur_state.id]
+    elif cmd == 'event' and len(args) == 1:
+        return MASTER_EVENT_INDEX[cur_state.id]
+    elif cmd == 'test' and len(args) == 1:
+        return TEST_INDEX
+    elif cmd == 'verbosity' and len(args) == 1:
+        return STATE_INDEX
+    elif cmd == 'verbosity' and len(args) == 2 and args[0] in STATE_INDEX:
+        return TABLET_VALUE_INDEX[STATE_INDEX.get(args[0]).id]
+    return None
+
+# readline calls complete() with state 0, 1, 2... until it returns None.
+# The range of matches is found once, on state 0, and then walked.
+completion_range = (None, 0, 0)
 
 def complete(text, state):
+    global completion_range
     words = readline.get_line_buffer().split(' ')
     cmd, args = words[0], words[1:]
 
-    if len(args) == 0:
-        if state != 0:
-            return None
-        if cmd == '':
+    if state == 0:
+        if cmd == '' and not args:
             print '\n' + HELP_TEXT
             readline.redisplay()
+            return None
+        index = completion_index(cmd, args)
+        if index is None:
+            completion_range = (None, 0, 0)
         else:
-            for possible in CMDS:
-                if possible.startswith(cmd):
-                    return possible
-            else:
-                return None
-    else:
-        if cmd == 'state':
-            possibilities = [st.name for st in STATES]
-        elif cmd == 'value':
-            if len(args) == 1:
-                possibilities = cur_state.devices['master'].values
-            else:
-                return None
-        elif cmd == 'event':
-            possibilities = cur_state.devices['master'].events
-        elif cmd == 'test':
-            possibilities = [t.name for t in TESTS]
+            completion_range = (index,) + index.range(words[-1])
+
+    index, lo, hi = completion_range
+    if index is None or lo + state >= hi:
+        return None
+    return index.names[lo + state]
+
+# Only the interactive prompt uses readline; scripts and tests don't load it.
+readline = None
+
+def setup_readline():
+    global readline
+    try:
+        import readline
+    except ImportError:
+        import pyreadline as readline
+    readline.set_completer(complete)
+    readline.parse_and_bind('tab: complete')
+
+stdout_lock = threading.Lock()
+
+# For output outside a command, which would otherwise land in the middle of
+# a line the display thread is writing.
+def locked_print(text):
+    stdout_lock.acquire()
+    try:
+        print text
+    finally:
+        stdout_lock.release()
+
+# False when running a script, so received values don't redraw a prompt.
+interactive = True
+
+# Received values aren't printed by the receive thread, which would then
+# block on the terminal. Instead they go into a table of latest values that
+# a separate thread prints at a fixed rate, so a value that changes faster
+# than that is only shown once per refresh. The table holds at most
+# |max_values| names and |max_messages| pending messages (incoming events);
+# |overflowed| counts updates turned away because it was full, and
+# |coalesced| counts values replaced before they were ever shown.
+class Display(object):
+    def __init__(self, fps=10.0, max_values=256, max_messages=256):
+        self.lock         = threading.Lock()
+        self.fps          = fps
+        self.max_values   = max_values
+        self.max_messages = max_messages
+        self.latest       = OrderedDict()
+        self.messages     = []
+        self.coalesced    = 0
+        self.overflowed   = 0
+        self.thread       = None
+        self.stopping     = threading.Event()
+        # set by --quiet, nothing received is shown
+        self.muted        = False
+
+    def update(self, name, value):
+        if self.muted:
+            return
+        self.lock.acquire()
+        if name in self.latest:
+            self.coalesced += 1
+            self.latest[name] = value
+        elif len(self.latest) < self.max_values:
+            self.latest[name] = value
         else:
-            return None
+            self.overflowed += 1
+        self.lock.release()
 
-        remaining = [thing for thing in possibilities if thing.startswith(args[0])]
-        if state < len(remaining):
-            return remaining[state]
+    def message(self, text):
+        if self.muted:
+            return
+        self.lock.acquire()
+        if len(self.messages) < self.max_messages:
+            self.messages.append(text)
         else:
-            return None
+            self.overflowed += 1
+        self.lock.release()
+
+    def render(self):
+        self.lock.acquire()
+        latest, self.latest = self.latest, OrderedDict()
+        messages, self.messages = self.messages, []
+        self.lock.release()
+        if not latest and not messages:
+            return
 
-readline.set_completer(complete)
-readline.parse_and_bind('tab: complete')
+        lines = messages + ["%s = %s" % item for item in latest.items()]
+        stdout_lock.acquire()
+        sys.stdout.write("\r" + "\n".join(lines) + "\n")
+        if interactive:
+            sys.stdout.write(cur_state.name + "> " + readline.get_line_buffer())
+        sys.stdout.flush()
+        stdout_lock.release()
 
-stdout_lock = threading.Lock()
+    def run(self):
+        while not self.stopping.is_set():
+            if self.fps > 0:
+                self.render()
+                self.stopping.wait(1.0 / self.fps)
+            else:
+                self.stopping.wait(0.1)
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    # Stops the refresh thread and shows anything it hadn't got to yet.
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.render()
+
+display = Display()
+
+class WaitTimeout(Exception):
+    pass
+
+# Everything RecvHandler decodes is published here, so tests and scripts
+# can block until a value or event arrives instead of sleeping. Values and
+# events are known as "STATE.name", since states can share names. Every
+# value and event published gets the next sequence number, so waits can
+# ignore anything published before the call, or before |since| from mark().
+class Registry(object):
+    def __init__(self):
+        self.cond        = threading.Condition()
+        # latest (value, sequence number) of each value
+        self.values      = {{}}
+        # (count, sequence number of the latest) of each event
+        self.events      = {{}}
+        self.seq         = 0
+        self.subscribers = {{}}
+        # [name, predicate, matched, value] of each wait_for_value()
+        self.waiters     = []
+
+    # Calls |callback(name, value)| from the receive thread whenever
+    # |name| is received. Events are published with a value of None.
+    def subscribe(self, name, callback):
+        self.cond.acquire()
+        self.subscribers.setdefault(name, []).append(callback)
+        self.cond.release()
+
+    def unsubscribe(self, name, callback):
+        self.cond.acquire()
+        self.subscribers[name].remove(callback)
+        self.cond.release()
+
+    # Sequence number of the latest value or event, for |since|.
+    def mark(self):
+        return self.seq
+
+    def publish_value(self, name, value):
+        self.cond.acquire()
+        self.seq += 1
+        self.values[name] = (value, self.seq)
+        # checked here rather than by the waiter, so a match isn't missed
+        # when another value replaces it before the waiter wakes up
+        for waiter in self.waiters:
+            if waiter[0] == name and not waiter[2]:
+                try:
+                    matched = waiter[1](value)
+                except Exception:
+                    # the waiter times out instead
+                    matched = False
+                if matched:
+                    waiter[2:] = [True, value]
+        callbacks = list(self.subscribers.get(name, ()))
+        self.cond.notify_all()
+        self.cond.release()
+        for callback in callbacks:
+            callback(name, value)
+
+    def publish_event(self, name):
+        self.cond.acquire()
+        self.seq += 1
+        self.events[name] = (self.event_count(name) + 1, self.seq)
+        callbacks = list(self.subscribers.get(name, ()))
+        self.cond.notify_all()
+        self.cond.release()
+        for callback in callbacks:
+            callback(name, None)
+
+    def event_count(self, name):
+        return self.events.get(name, (0, 0))[0]
+
+    def last_value(self, name):
+        return self.values.get(name, (None, 0))[0]
+
+    # Waits until a value of |name| satisfies |predicate|, which can be a
+    # function or a value to compare against, and returns that value. Any
+    # value received during the wait counts. With |since|, so does the
+    # latest one received before the call if it came after |since|.
+    def wait_for_value(self, name, predicate, timeout, since=None):
+        if not callable(predicate):
+            expected = predicate
+            predicate = lambda v: v == expected
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            if since is None:
+                since = self.seq
+            value, seq = self.values.get(name, (None, 0))
+            if seq > since and predicate(value):
+                return value
+            waiter = [name, predicate, False, None]
+            self.waiters.append(waiter)
+            try:
+                while not waiter[2]:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise WaitTimeout('timed out waiting for %s, last value was %r' % (name, self.last_value(name)))
+                    self.cond.wait(remaining)
+                return waiter[3]
+            finally:
+                self.waiters.remove(waiter)
+        finally:
+            self.cond.release()
+
+    # Waits for event |name| to arrive after the call, or after |since|.
+    def wait_for_event(self, name, timeout, since=None):
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            if since is None:
+                since = self.seq
+            while self.events.get(name, (0, 0))[1] <= since:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WaitTimeout('timed out waiting for event %s' % name)
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+registry = Registry()
+
+# Registry name of value or event |name|, which can be "STATE.name" or
+# just a name in the current state.
+def qualify(name):
+    return name if '.' in name else cur_state.name + '.' + name
+
+# Shortcuts for tests, which raise WaitTimeout and so fail the test when
+# the value or event doesn't arrive in time.
+def wait_for_value(name, predicate, timeout=1.0, since=None):
+    return registry.wait_for_value(qualify(name), predicate, timeout, since)
+
+def wait_for_event(name, timeout=1.0, since=None):
+    registry.wait_for_event(qualify(name), timeout, since)
 
 COMM_INITIAL                   = 0
 COMM_WAITING_FOR_CHANGE_STATE  = 1
@@ -687,90 +2987,564 @@ COMM_WAITING_FOR_VALUE_ID      = 5
 COMM_WAITING_FOR_VALUE_VALUE   = 6
 COMM_WAITING_FOR_DEBUG_SETTING = 7
 COMM_WAITING_FOR_HEARTBEAT_ID  = 8
+COMM_WAITING_FOR_ACK_SEQ       = 9
+COMM_WAITING_FOR_QUEUE_STATS   = 10
+COMM_WAITING_FOR_PROFILE       = 11
+
+OPCODE_DEBUG_SETTING = {opcode_debug_setting}
+OPCODE_HEARTBEAT     = {opcode_heartbeat}
+OPCODE_ACK           = {opcode_ack}
+OPCODE_QUEUE_STATS   = {opcode_queue_stats}
+OPCODE_PROFILE       = {opcode_profile}
+QUEUE_STATS_RESET    = {queue_stats_reset}
+PROFILE_RESET        = {profile_reset}
+PROFILE_NO_SLOT      = {profile_no_slot:#x}
+PROFILE_ENTRIES      = {profile_entries}
+DEBUG_ALL_VALUES     = {debug_all_values:#x}
+FRAME_SYNC           = chr({frame_sync:#x})
+FRAME_MAX_LENGTH     = {frame_max_length}
+
+def _crc8_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ {crc8_poly:#x}) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+        table.append(crc)
+    return table
+CRC8_TABLE = _crc8_table()
+
+def crc8(s):
+    crc = 0
+    for c in s:
+        crc = CRC8_TABLE[crc ^ ord(c)]
+    return crc
+
+# Set by --framed, wraps every frame with a sync byte, length and CRC.
+framed = False
+
+def write_frame(frame):
+    if framed:
+        frame = FRAME_SYNC + chr(len(frame)) + frame + chr(crc8(chr(len(frame)) + frame))
+    port.write(frame)
+
+# Reporting levels the master has confirmed, by (state id, value id).
+debug_settings = {{}}
+
+def set_verbosity(state_name, value_name, level):
+    state = STATE_INDEX.get(state_name)
+    if state is None:
+        raise ValueError('No state named %r' % state_name)
+    if value_name is None:
+        value_id = DEBUG_ALL_VALUES
+    else:
+        value_id = TABLET_VALUE_INDEX[state.id].get(value_name)
+        if value_id is None:
+            raise ValueError('No such value %r' % value_name)
+    frame = chr(OPCODE_DEBUG_SETTING) + chr(state.id) + chr(value_id) + chr(level)
+    if session is not None:
+        session.record(SESSION_OUT, frame)
+    write_frame(frame)
+
+# Sliding window of sequence-numbered commands waiting to be acknowledged.
+# Each command is followed by an ack request, which the master echoes once
+# it has processed everything before it. At most |size| commands are in
+# flight at once, so the AMIB's receive buffer can't be overrun. When the
+# oldest command times out, the value writes in flight are resent in order.
+# Commands carry no sequence number, so the master can't tell a resend from
+# a new command; events and state changes would run twice if only their ack
+# was lost, so they're reported and given up on instead of resent.
+class AckWindow(object):
+    # value writes set the value outright, so sending one twice is harmless
+    RESENDABLE = ('\x02',)
+
+    def __init__(self, size=8, timeout=0.5, retries=3):
+        if size < 1:
+            raise ValueError('window must be at least 1')
+        self.size     = size
+        self.timeout  = timeout
+        self.retries  = retries
+        self.cond     = threading.Condition()
+        self.inflight = OrderedDict()
+        self.next_seq = 0
+        self.resent   = 0
+        self.failed   = 0
+
+    def send(self, frame):
+        self.cond.acquire()
+        try:
+            while len(self.inflight) >= self.size:
+                self._wait()
+            seq = self.next_seq
+            self.next_seq = (self.next_seq + 1) % 256
+            self.inflight[seq] = [frame, time.time(), 0]
+            write_frame(frame)
+            write_frame(chr(OPCODE_ACK) + chr(seq))
+        finally:
+            self.cond.release()
+
+    def ack(self, seq):
+        self.cond.acquire()
+        try:
+            # acks are cumulative, anything sent before |seq| is done too
+            if seq in self.inflight:
+                while self.inflight.popitem(last=False)[0] != seq:
+                    pass
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    # Waits for an ack, resending or giving up on timed out commands. Must
+    # be called with the condition held.
+    def _wait(self):
+        oldest = next(iter(self.inflight.values()))
+        remaining = oldest[1] + self.timeout - time.time()
+        if remaining > 0:
+            self.cond.wait(remaining)
+            return
+
+        if oldest[0][0] not in self.RESENDABLE:
+            seq, _ = self.inflight.popitem(last=False)
+            self.failed += 1
+            print >>sys.stderr, "command %d wasn't acknowledged and may not have run, not resending it" % seq
+            return
+        if oldest[2] >= self.retries:
+            seq, _ = self.inflight.popitem(last=False)
+            self.failed += 1
+            print >>sys.stderr, "command %d was never acknowledged, giving up on it" % seq
+            return
 
+        now = time.time()
+        for seq, entry in self.inflight.items():
+            if entry[0][0] not in self.RESENDABLE:
+                continue
+            entry[1] = now
+            entry[2] += 1
+            self.resent += 1
+            write_frame(entry[0])
+            write_frame(chr(OPCODE_ACK) + chr(seq))
+
+    # Waits until every command has been acknowledged or given up on.
+    def drain(self):
+        self.cond.acquire()
+        try:
+            while self.inflight:
+                self._wait()
+        finally:
+            self.cond.release()
+
+# Set by the ack command or --ack, None means fire and forget.
+acks = None
+
+# Round trip times of heartbeats sent by the ping command. Heartbeats go to
+# the master, or through it to a slave AMIB, and are echoed straight back.
+class Heartbeats(object):
+    def __init__(self):
+        self.cond    = threading.Condition()
+        self.pending = {{}}
+        self.rtts    = []
+
+    # Sequence numbers are a byte, so at most 256 pings are in flight. One
+    # that's reused waits for the earlier ping's reply, or for it to time
+    # out and count as lost, rather than take its place.
+    def send(self, amib, seq, timeout=1.0):
+        self.cond.acquire()
+        deadline = time.time() + timeout
+        while (amib, seq) in self.pending and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        self.pending[amib, seq] = time.time()
+        self.cond.release()
+        write_frame(chr(OPCODE_HEARTBEAT) + chr(amib) + chr(seq))
+
+    def reply(self, amib, seq):
+        now = time.time()
+        self.cond.acquire()
+        sent = self.pending.pop((amib, seq), None)
+        if sent is not None:
+            self.rtts.append(now - sent)
+            self.cond.notify_all()
+        self.cond.release()
+
+    def ping(self, count, rate, amib, timeout=1.0):
+        self.rtts = []
+        self.pending = {{}}
+        start = time.time()
+        for i in range(count):
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.send(amib, i % 256, timeout)
+
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        while self.pending and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        self.cond.release()
+        return sorted(self.rtts)
+
+heartbeats = Heartbeats()
+
+# The master's deferred event queue, as (queued, high water mark, size,
+# overflows). A size of 0 means events aren't deferred.
+class QueueStats(object):
+    def __init__(self):
+        self.cond  = threading.Condition()
+        self.stats = None
+
+    def query(self, reset=False, timeout=1.0):
+        self.cond.acquire()
+        self.stats = None
+        self.cond.release()
+        frame = chr(OPCODE_QUEUE_STATS) + chr(QUEUE_STATS_RESET if reset else 0)
+        if session is not None:
+            session.record(SESSION_OUT, frame)
+        write_frame(frame)
+
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        while self.stats is None and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        stats = self.stats
+        self.cond.release()
+        return stats
+
+    def reply(self, buf):
+        self.cond.acquire()
+        self.stats = (buf[1], buf[2], buf[3], buf[4] | buf[5] << 8)
+        self.cond.notify_all()
+        self.cond.release()
+
+queue_stats = QueueStats()
+
+# Name of each of the master's profiling slots, in order.
+PROFILE_SLOTS = [name for state in STATES
+                 for name in ['%s.%s' % (state.name, entry) for entry in PROFILE_ENTRIES] +
+                             ['%s.events.%s' % (state.name, ev) for ev in state.devices['master'].events]]
+
+# Profiling counters from a master built with gen.py --instrument, as
+# (count, total, max) in microseconds by slot. Slots are read one frame at
+# a time with at most |window| requests in flight, so the master's receive
+# buffer can't overflow while it's busy sending replies.
+class Profiler(object):
+    def __init__(self, window=4):
+        self.cond     = threading.Condition()
+        self.window   = window
+        self.counters = {{}}
+        self.pending  = set()
+        self.missing  = False
+
+    # Returns the counters read, or None if the master has none.
+    def query(self, reset=False, timeout=1.0):
+        self.cond.acquire()
+        self.counters = {{}}
+        self.pending = set()
+        self.missing = False
+        try:
+            for slot in range(len(PROFILE_SLOTS)):
+                deadline = time.time() + timeout
+                while len(self.pending) >= self.window and not self.missing and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                if len(self.pending) >= self.window or self.missing:
+                    break
+                self.pending.add(slot)
+                frame = chr(OPCODE_PROFILE) + chr(PROFILE_RESET if reset else 0) + struct.pack('<H', slot)
+                if session is not None:
+                    session.record(SESSION_OUT, frame)
+                write_frame(frame)
+
+            deadline = time.time() + timeout
+            while self.pending and not self.missing and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return None if self.missing else self.counters
+        finally:
+            self.cond.release()
+
+    def reply(self, buf):
+        slot = buf[1] | buf[2] << 8
+        self.cond.acquire()
+        if slot == PROFILE_NO_SLOT:
+            self.missing = True
+        else:
+            self.counters[slot] = struct.unpack('<III', ''.join(chr(n) for n in buf[3:15]))
+            self.pending.discard(slot)
+        self.cond.notify_all()
+        self.cond.release()
+
+profiler = Profiler()
+
+def print_profile(counters):
+    print '%-40s %10s %12s %10s %10s' % ('', 'count', 'total(ms)', 'mean(us)', 'max(us)')
+    rows = sorted(((total, slot, count, max_us) for (slot, (count, total, max_us)) in counters.items() if count),
+                  reverse=True)
+    for (total, slot, count, max_us) in rows:
+        print '%-40s %10d %12.1f %10.1f %10d' % (PROFILE_SLOTS[slot], count, total / 1000.0, float(total) / count, max_us)
+    if len(counters) < len(PROFILE_SLOTS):
+        print 'No reply for %d of %d slots' % (len(PROFILE_SLOTS) - len(counters), len(PROFILE_SLOTS))
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+def print_ping(count, rtts, buckets=10, width=40):
+    print '%d sent, %d received, %.1f%% loss' % (count, len(rtts), 100.0 * (count - len(rtts)) / count)
+    if not rtts:
+        return
+    print 'rtt min %.2f ms, p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms' % tuple(
+        x * 1000 for x in (rtts[0], percentile(rtts, 50), percentile(rtts, 90), percentile(rtts, 99), rtts[-1]))
+
+    lo, hi = rtts[0], rtts[-1]
+    step = (hi - lo) / buckets or 1e-6
+    counts = [0] * buckets
+    for rtt in rtts:
+        counts[min(buckets - 1, int((rtt - lo) / step))] += 1
+    for i, n in enumerate(counts):
+        print '%8.2f ms %6d %s' % ((lo + i * step) * 1000, n, '#' * (n * width // max(counts)))
+
+# (name, type, struct format, size) of every tablet value by state id and
+# value id, so decoding a frame doesn't have to search for them.
+TABLET_VALUES = [[(name, ty, ty_to_struct(ty), struct.calcsize(ty_to_struct(ty)))
+                  for (name, ty) in state.devices['tablet'].values.items()]
+                 for state in STATES]
+
+# Type of each tablet value by "STATE.name".
+TABLET_VALUE_TYPES = {{}}
+for state, state_values in zip(STATES, TABLET_VALUES):
+    for (name, ty, _, _) in state_values:
+        TABLET_VALUE_TYPES[state.name + '.' + name] = ty
+
+def tablet_value(state_id, value_id):
+    if state_id < len(TABLET_VALUES) and value_id < len(TABLET_VALUES[state_id]):
+        return TABLET_VALUES[state_id][value_id]
+    return None
+
+# Decodes frames from the master. Frames are either raw, where the length
+# is implied by the opcode and value type, or, with framed=True, wrapped as
+# FRAME_SYNC, length, frame, CRC-8 of length and frame. In framed mode a
+# corrupt frame only costs the bytes up to the next sync byte.
 class RecvHandler(object):
-    def __init__(self, port):
+    def __init__(self, port, framed=False):
         self.state         = COMM_INITIAL
         self.port          = port
+        self.framed        = framed
         self.buf           = []
+        self.pending       = ''
         self.pending_value = None
+        self.frames        = 0
+        self.bad_frames    = 0
+        self.closing       = False
 
-    def handle(self):
+    def read(self):
         try:
-            s = self.port.read(1)
+            return self.port.read(self.port.in_waiting or 1)
         except serial.SerialException:
-            return
+            return ''
+        except Exception:
+            # bridge sockets can't cancel a read, so closing one from under
+            # this thread fails in whatever way the socket happens to
+            if self.closing:
+                return ''
+            raise
 
+    def handle(self):
+        s = self.read()
         while s != '':
-            b = ord(s)
-            self.buf.append(b)
-            if self.state == COMM_INITIAL:
-                if b == 2:
-                    self.state = COMM_WAITING_FOR_VALUE_STATE
-                else:
-                    # ??
-                    self.state = COMM_INITIAL
-                    self.buf = []
-            elif self.state == COMM_WAITING_FOR_VALUE_STATE:
-                self.state = COMM_WAITING_FOR_VALUE_ID
-            elif self.state == COMM_WAITING_FOR_VALUE_ID:
-                state = STATES[self.buf[1]]
-                self.pending_value = next((name, ty) for (i, (name, ty)) in enumerate(state.devices['tablet'].values.items()) if i == self.buf[2])
+            if self.framed:
+                self.feed_framed(s)
+            else:
+                for c in s:
+                    self.feed(ord(c))
+            s = self.read()
+
+    def reset(self):
+        self.state = COMM_INITIAL
+        self.buf = []
+
+    def complete(self):
+        self.dispatch(self.buf)
+        self.reset()
+
+    def feed(self, b):
+        self.buf.append(b)
+        if self.state == COMM_INITIAL:
+            if b == 2:
+                self.state = COMM_WAITING_FOR_VALUE_STATE
+            elif b == 1:
+                self.state = COMM_WAITING_FOR_EVENT_STATE
+            elif b == OPCODE_ACK:
+                self.state = COMM_WAITING_FOR_ACK_SEQ
+            elif b == OPCODE_HEARTBEAT:
+                self.state = COMM_WAITING_FOR_HEARTBEAT_ID
+            elif b == OPCODE_DEBUG_SETTING:
+                self.state = COMM_WAITING_FOR_DEBUG_SETTING
+            elif b == OPCODE_QUEUE_STATS:
+                self.state = COMM_WAITING_FOR_QUEUE_STATS
+            elif b == OPCODE_PROFILE:
+                self.state = COMM_WAITING_FOR_PROFILE
+            else:
+                # ??
+                self.reset()
+        elif self.state == COMM_WAITING_FOR_DEBUG_SETTING:
+            if len(self.buf) == 4:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_EVENT_STATE:
+            self.state = COMM_WAITING_FOR_EVENT_EVENT
+        elif self.state == COMM_WAITING_FOR_EVENT_EVENT:
+            self.complete()
+        elif self.state == COMM_WAITING_FOR_HEARTBEAT_ID:
+            if len(self.buf) == 3:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_ACK_SEQ:
+            self.complete()
+        elif self.state == COMM_WAITING_FOR_QUEUE_STATS:
+            if len(self.buf) == 6:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_PROFILE:
+            if len(self.buf) == 15:
+                self.complete()
+        elif self.state == COMM_WAITING_FOR_VALUE_STATE:
+            self.state = COMM_WAITING_FOR_VALUE_ID
+        elif self.state == COMM_WAITING_FOR_VALUE_ID:
+            self.pending_value = tablet_value(self.buf[1], b)
+            if self.pending_value is None:
+                self.bad_frames += 1
+                self.reset()
+            else:
                 self.state = COMM_WAITING_FOR_VALUE_VALUE
-            elif self.state == COMM_WAITING_FOR_VALUE_VALUE:
-                name, ty = self.pending_value
-                sty = ty_to_struct(ty)
-                if struct.calcsize(sty) == len(self.buf) - 3:
-                    stdout_lock.acquire()
-                    print "\r%s = %s" % (name, struct.unpack(sty, ''.join(chr(n) for n in self.buf[3:]))[0])
-                    print cur_state.name + "> " + readline.get_line_buffer(),
-                    sys.stdout.flush()
-                    stdout_lock.release()
-                    self.state = COMM_INITIAL
-                    self.buf = []
+        elif self.state == COMM_WAITING_FOR_VALUE_VALUE:
+            if self.pending_value[3] == len(self.buf) - 3:
+                self.complete()
+        else:
+            raise ValueError("???")
+
+    def feed_framed(self, s):
+        data = self.pending + s
+        pos = 0
+        while True:
+            start = data.find(FRAME_SYNC, pos)
+            if start < 0:
+                pos = len(data)
+                break
+            if start + 2 > len(data):
+                pos = start
+                break
+            length = ord(data[start + 1])
+            end = start + 2 + length + 1
+            if length > FRAME_MAX_LENGTH:
+                # can't be a real frame, don't wait for the rest of it
+                end = start + 2
+            elif end > len(data):
+                pos = start
+                break
+            if 0 < length <= FRAME_MAX_LENGTH and ord(data[end - 1]) == crc8(data[start + 1:end - 1]):
+                self.dispatch([ord(c) for c in data[start + 2:end - 1]])
+                pos = end
             else:
-                raise ValueError("???")
-
-            try:
-                s = self.port.read(1)
-            except serial.SerialException:
+                # not a frame after all, try the next sync byte
+                self.bad_frames += 1
+                pos = start + 1
+        self.pending = data[pos:]
+
+    # Handles one complete frame, as a list of byte values.
+    def dispatch(self, buf):
+        if session is not None:
+            session.record(SESSION_IN, ''.join(chr(n) for n in buf))
+        op = buf[0]
+        if op == 2 and len(buf) >= 3:
+            value = tablet_value(buf[1], buf[2])
+            if value is None or value[3] != len(buf) - 3:
+                self.bad_frames += 1
                 return
-
-handler = RecvHandler(port)
-t = threading.Thread(target=handler.handle)
-t.daemon = True
-t.start()
+            name, ty, sty, size = value
+            raw = ''.join(chr(n) for n in buf[3:])
+            value, = struct.unpack(sty, raw)
+            self.frames += 1
+            if recorder is not None:
+                recorder.record(buf[1], buf[2], raw)
+            if numpy is not None:
+                key = (buf[1], buf[2])
+                ring = value_rings.get(key)
+                if ring is None:
+                    ring = value_rings[key] = ValueRing()
+                ring.push(monotonic(), value)
+            if tracer is not None:
+                tracer.counter(STATES[buf[1]].name + '.' + name, value)
+            registry.publish_value(STATES[buf[1]].name + '.' + name, value)
+            display.update(name, value)
+        elif op == 1 and len(buf) == 3:
+            if buf[1] >= len(STATES) or buf[2] >= len(STATES[buf[1]].devices['tablet'].events):
+                self.bad_frames += 1
+                return
+            name = STATES[buf[1]].devices['tablet'].events[buf[2]]
+            if tracer is not None:
+                tracer.instant(TRACE_BOARD, 'event ' + name, {{'state': STATES[buf[1]].name}})
+            registry.publish_event(STATES[buf[1]].name + '.' + name)
+            display.message("event %s" % name)
+        elif op == OPCODE_DEBUG_SETTING and len(buf) == 4:
+            if buf[1] >= len(STATES) or (buf[2] != DEBUG_ALL_VALUES and buf[2] >= len(TABLET_VALUES[buf[1]])):
+                self.bad_frames += 1
+                return
+            debug_settings[buf[1], buf[2]] = buf[3]
+        elif op == OPCODE_HEARTBEAT and len(buf) == 3:
+            heartbeats.reply(buf[1], buf[2])
+        elif op == OPCODE_ACK and len(buf) == 2:
+            if acks is not None:
+                acks.ack(buf[1])
+        elif op == OPCODE_QUEUE_STATS and len(buf) == 6:
+            queue_stats.reply(buf)
+        elif op == OPCODE_PROFILE and len(buf) == 15:
+            profiler.reply(buf)
+        else:
+            self.bad_frames += 1
 
 # Functions to send values over serial. Used below and by tests.
+def send(frame):
+    if session is not None:
+        session.record(SESSION_OUT, frame)
+    if acks is not None:
+        acks.send(frame)
+    else:
+        write_frame(frame)
+
 def set_state(name):
     global cur_state
-    cur_state = next(state for state in STATES if state.name == name)
-    port.write('\x00' + chr(cur_state.id))
+    state = STATE_INDEX.get(name)
+    if state is None:
+        raise ValueError('No state named %r' % name)
+    cur_state = state
+    send('\x00' + chr(cur_state.id))
+    if tracer is not None:
+        tracer.state(cur_state.name, 'set_state')
 
 def set_value(value_name, value):
-    for id, (name, ty) in enumerate(cur_state.devices['master'].values.items()):
-        if name == value_name:
-            break
-    else:
+    found = MASTER_VALUE_INDEX[cur_state.id].get(value_name)
+    if found is None:
         raise ValueError('No such value % r' % value_name)
 
+    id, ty = found
     value = parse_val(ty, value)
-    port.write('\x02' + chr(cur_state.id) + chr(id) + value)
+    send('\x02' + chr(cur_state.id) + chr(id) + value)
+    if tracer is not None:
+        tracer.instant(TRACE_COMMANDS, 'value ' + value_name, {{'state': cur_state.name, 'value': struct.unpack(ty_to_struct(ty), value)[0]}})
 
 def set_event(name):
-    id = cur_state.devices['master'].events.index(name)
-    port.write('\x01' + chr(cur_state.id) + chr(id))
-
-print 'try "help" for help'
-while True:
-    s = raw_input(cur_state.name + "> ")
-    words = s.split(' ')
-    cmd, args = words[0], words[1:]
-
-    stdout_lock.acquire()
-    if cmd == '':
-        stdout_lock.release()
-        continue
+    id = MASTER_EVENT_INDEX[cur_state.id].get(name)
+    if id is None:
+        raise ValueError('No such event %r' % name)
+    send('\x01' + chr(cur_state.id) + chr(id))
+    if tracer is not None:
+        tracer.instant(TRACE_COMMANDS, 'event ' + name, {{'state': cur_state.name}})
+
+# Commands that only work with a master built with MANAGER_COMM_HOOKS, along
+# with "ack on".
+HOOK_COMMANDS = ('ping', 'queue', 'profile', 'verbosity')
+
+# Runs one console command. Returns False if the console should exit.
+def run_command(cmd, args):
+    global recorder, acks, session, tracer
+
+    if not comm_hooks and (cmd in HOOK_COMMANDS or (cmd == 'ack' and args[:1] == ['on'])):
+        print "%s needs a master built with MANAGER_COMM_HOOKS" % cmd
+    elif cmd == '':
+        pass
     elif cmd == 'help':
         print HELP_TEXT
     elif cmd == 'state':
@@ -779,8 +3553,8 @@ while True:
         else:
             try:
 	        set_state(args[0])
-            except StopIteration:
-                print "no state named %r" % args[0]
+            except ValueError as e:
+                print e
     elif cmd == 'value':
         if len(args) == 0:
             for name, ty in cur_state.devices['master'].values.items():
@@ -790,8 +3564,6 @@ while True:
 	        set_value(args[0], args[1])
             except ValueError as e:
                 print e
-                stdout_lock.release()
-                continue
         else:
             print "Usage: value [name] [value]"
     elif cmd == 'event':
@@ -800,22 +3572,15 @@ while True:
         elif len(args) == 1:
 	    try:
 	        set_event(args[0])
-            except ValueError:
-                print "No such value % r" % args[0]
+            except ValueError as e:
+                print e
         else:
             print "Usage: event [name]"
     elif cmd == 'test':
         if not TESTS:
 	    print 'No tests have been defined for this console.'
 	else:
-            test = None
-	    # Find the requested test by name. Could potentially put these in
-	    # dict instead to make lookup easier, but this is simple enough.
-	    if args:
-	        for t in TESTS:
-	            if t.name == args[0]:
-	                test = t
-		        break
+            test = TEST_INDEX.get(args[0]) if args else None
             if test:
                 test.run_test(args[1:])
 	    else:
@@ -823,29 +3588,370 @@ while True:
 		    print 'No test named "%s".' % args[0],
 	        print 'Options are:'
 	        print '\n'.join(['  ' + t.name for t in TESTS])
+    elif cmd == 'record':
+        if len(args) == 0:
+            if recorder is None:
+                print 'Not recording.'
+            else:
+                old, recorder = recorder, None
+                old.close()
+                print 'Recorded %d values to %s' % (old.count, old.path)
+        elif len(args) == 1:
+            if recorder is not None:
+                print 'Already recording to %s' % recorder.path
+            else:
+                try:
+                    recorder = TelemetryRecorder(args[0], my_build_id)
+                except IOError as e:
+                    print e
+        else:
+            print "Usage: record [file]"
+    elif cmd == 'session':
+        if len(args) == 0:
+            if session is None:
+                print 'Not recording a session.'
+            else:
+                old, session = session, None
+                old.close()
+                print 'Recorded %d frames to %s' % (old.count, old.path)
+        elif len(args) == 1:
+            if session is not None:
+                print 'Already recording a session to %s' % session.path
+            else:
+                try:
+                    session = SessionRecorder(args[0], board_build_id, cur_state.id)
+                except IOError as e:
+                    print e
+        else:
+            print "Usage: session [file]"
+    elif cmd == 'trace':
+        if len(args) == 0:
+            if tracer is None:
+                print 'Not tracing.'
+            else:
+                old, tracer = tracer, None
+                old.close()
+                print 'Wrote %d trace events to %s' % (old.count, old.path)
+                if old.dropped:
+                    print '%d events dropped' % old.dropped
+        elif len(args) == 1:
+            if tracer is not None:
+                print 'Already tracing to %s' % tracer.path
+            else:
+                try:
+                    tracer = TraceWriter(args[0], my_build_id)
+                    tracer.state(cur_state.name, 'trace')
+                except IOError as e:
+                    print e
+        else:
+            print "Usage: trace [file]"
+    elif cmd == 'stats':
+        if numpy is None:
+            print 'stats requires numpy'
+        else:
+            print_stats(filter(None, args))
+    elif cmd == 'ack':
+        if len(args) == 0:
+            if acks is None:
+                print 'Acknowledgements are off.'
+            else:
+                print 'window %d, %d in flight, %d resent, %d failed' % (acks.size, len(acks.inflight), acks.resent, acks.failed)
+        elif args[0] == 'on' and len(args) <= 2:
+            try:
+                window = AckWindow(int(args[1]) if len(args) == 2 else 8)
+            except ValueError:
+                print "Usage: ack [on [window]|off], window at least 1"
+                return True
+            if acks is not None:
+                acks.drain()
+            acks = window
+        elif args[0] == 'off' and len(args) == 1:
+            if acks is not None:
+                acks.drain()
+            acks = None
+        else:
+            print "Usage: ack [on [window]|off]"
+    elif cmd == 'ping':
+        try:
+            count = int(args[0]) if len(args) > 0 else 10
+            rate = float(args[1]) if len(args) > 1 else 10.0
+            amib = int(args[2]) if len(args) > 2 else 0
+            if count <= 0 or rate <= 0 or not 0 <= amib <= 0xff:
+                raise ValueError()
+        except ValueError:
+            print "Usage: ping [count] [rate] [amib], count and rate above 0"
+        else:
+            print_ping(count, heartbeats.ping(count, rate, amib))
+    elif cmd == 'queue':
+        if args not in ([], ['reset']):
+            print "Usage: queue [reset]"
+        else:
+            stats = queue_stats.query(args == ['reset'])
+            if stats is None:
+                print "No reply from the master"
+            elif stats[2] == 0:
+                print "Events aren't deferred, set eventQueue in hardware.json to queue them"
+            else:
+                print "%d of %d queued, high water mark %d, %d dropped" % (stats[0], stats[2], stats[1], stats[3])
+    elif cmd == 'profile':
+        if args not in ([], ['reset']):
+            print "Usage: profile [reset]"
+        else:
+            counters = profiler.query(args == ['reset'])
+            if counters is None:
+                print "The master wasn't built with gen.py --instrument"
+            elif not counters:
+                print "No reply from the master"
+            else:
+                print_profile(counters)
+    elif cmd == 'verbosity':
+        if len(args) == 0:
+            for (state_id, value_id), level in sorted(debug_settings.items()):
+                state = STATES[state_id]
+                if value_id == DEBUG_ALL_VALUES:
+                    print "%s: %d" % (state.name, level)
+                else:
+                    print "%s.%s: %d" % (state.name, list(state.devices['tablet'].values)[value_id], level)
+        elif len(args) in (2, 3):
+            try:
+                set_verbosity(args[0], args[1] if len(args) == 3 else None, int(args[-1]))
+            except ValueError as e:
+                print e
+        else:
+            print "Usage: verbosity [state] [value] [level]"
+    elif cmd == 'display':
+        if len(args) == 0:
+            print "%g fps, %d coalesced, %d overflowed" % (display.fps, display.coalesced, display.overflowed)
+        elif len(args) == 1:
+            try:
+                display.fps = float(args[0])
+            except ValueError:
+                print "Usage: display [fps]"
+        else:
+            print "Usage: display [fps]"
     elif cmd in ('q', 'quit'):
-        stdout_lock.release()
-        break
+        return False
     else:
         print "no such command %r" % cmd
-    stdout_lock.release()
+    return True
+
+# Waits until the value called |name| is received as |expected|, after
+# |since| from registry.mark().
+def expect_value(name, expected, timeout, since=None):
+    name = qualify(name)
+    ty = TABLET_VALUE_TYPES.get(name)
+    if ty is None:
+        raise ValueError('No such value %r' % name)
 
-port.close()
+    expected, = struct.unpack(ty_to_struct(ty), parse_val(ty, expected))
+    try:
+        registry.wait_for_value(name, expected, timeout, since)
+        return True
+    except WaitTimeout:
+        return False
+
+# Runs console commands from a file one after another, without a prompt.
+# Besides the normal commands, scripts can use:
+#   wait [seconds]: sleep
+#   expect [name] [value] [timeout]: wait until a value is received, fail
+#                                    the script if it doesn't arrive
+# An expect matches the latest value received since the command before it
+# was sent, or any value received while it waits.
+# Lines starting with # are ignored. Returns True if every expect passed.
+def run_script(f):
+    latencies = []
+    ok = True
+    mark = registry.mark()
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        cmd, args = words[0], words[1:]
+
+        start = time.time()
+        if cmd == 'wait':
+            try:
+                time.sleep(float(args[0]))
+            except (IndexError, ValueError) as e:
+                locked_print('line %d: bad wait: %s' % (lineno, e))
+                ok = False
+                break
+        elif cmd == 'expect':
+            try:
+                timeout = float(args[2]) if len(args) > 2 else 1.0
+                passed = expect_value(args[0], args[1], timeout, mark)
+            except (IndexError, ValueError) as e:
+                locked_print('line %d: bad expect: %s' % (lineno, e))
+                passed = False
+            if not passed:
+                locked_print('line %d: expect %s failed, last value was %r' % (lineno, ' '.join(args), registry.last_value(qualify(args[0])) if args else None))
+                ok = False
+                break
+        else:
+            mark = registry.mark()
+            stdout_lock.acquire()
+            try:
+                if not run_command(cmd, args):
+                    break
+            finally:
+                stdout_lock.release()
+        latencies.append((time.time() - start, lineno, line))
+
+    total = sum(l for (l, _, _) in latencies)
+    stdout_lock.acquire()
+    try:
+        for latency, lineno, line in latencies:
+            print '%4d %10.3f ms  %s' % (lineno, latency * 1000, line)
+        if latencies:
+            print '%d commands in %.3f s (%.1f commands/s)' % (len(latencies), total, len(latencies) / total if total else 0)
+    finally:
+        stdout_lock.release()
+    return ok
+
+def window_size(s):
+    try:
+        size = int(s)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise argparse.ArgumentTypeError("window must be a whole number, at least 1")
+    return size
+
+def main():
+    global interactive, acks, framed, session, tracer
+
+    parser = argparse.ArgumentParser(description="Debug console")
+    parser.add_argument('port', nargs='?', help="serial port of the master AMIB or a bridge.py URL such as socket://localhost:5331, found from hardware.json by default")
+    parser.add_argument('-s', '--script', help="run commands from a script file (- for stdin) instead of prompting")
+    parser.add_argument('-a', '--ack', type=window_size, metavar='WINDOW', help="wait for acknowledgements, with at most WINDOW commands in flight")
+    parser.add_argument('-f', '--framed', action='store_true', help="wrap frames with a sync byte, length and CRC")
+    parser.add_argument('-q', '--quiet', action='store_true', help="don't show values and events as they arrive")
+    parser.add_argument('-t', '--test', nargs='+', metavar=('NAME', 'ARGS'), help="run one automated test and exit with its result")
+    parser.add_argument('--list-tests', action='store_true', help="print the names of the automated tests and exit")
+    parser.add_argument('--session', metavar='FILE', help="record the session to FILE for replay.py")
+    parser.add_argument('--trace', metavar='FILE', help="write a Chrome/Perfetto timeline of the session to FILE")
+    args = parser.parse_args()
+
+    if args.list_tests:
+        for test in TESTS or []:
+            print test.name
+        return
+
+    framed = args.framed
+    display.muted = args.quiet
+    if args.trace:
+        # started before connecting so the initial state is traced
+        tracer = TraceWriter(args.trace, my_build_id)
+    # decided before connecting, so the display never draws a prompt for a
+    # script or test
+    interactive = args.test is None and args.script is None and sys.stdin.isatty()
+    if interactive:
+        setup_readline()
+    connect(args.port or find_port())
+    if args.ack is not None:
+        if comm_hooks:
+            acks = AckWindow(args.ack)
+        else:
+            print >>sys.stderr, "The master was built without MANAGER_COMM_HOOKS, so commands aren't acknowledged"
+    if args.session:
+        session = SessionRecorder(args.session, board_build_id, cur_state.id)
+
+    ok = True
+    if args.test is not None:
+        test = TEST_INDEX.get(args.test[0])
+        if test is None:
+            print >>sys.stderr, 'No test named "%s".' % args.test[0]
+            ok = False
+        else:
+            ok = test.run_test(args.test[1:])
+    elif not interactive:
+        if args.script in (None, '-'):
+            ok = run_script(sys.stdin)
+        else:
+            ok = run_script(open(args.script))
+    else:
+        print 'try "help" for help'
+        while True:
+            s = raw_input(cur_state.name + "> ")
+            words = s.split(' ')
+            cmd, args = words[0], words[1:]
+
+            stdout_lock.acquire()
+            try:
+                if not run_command(cmd, args):
+                    break
+            finally:
+                stdout_lock.release()
+
+    if acks is not None:
+        acks.drain()
+    # stops the receive thread, so nothing is recorded to a closed file
+    disconnect()
+    if recorder is not None:
+        recorder.close()
+    if session is not None:
+        session.close()
+    if tracer is not None:
+        tracer.close()
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
 """
 
 State = namedtuple('State', ('name', 'id', 'devices'))
 
+def sorted_names(names):
+    # (name, index) for each of |names|, sorted by name.
+    return sorted((name, i) for (i, name) in enumerate(names))
+
 def generate_debug(states, build_id):
     new_states = []
     for i, (name, state) in enumerate(states.items()):
         new_states.append(State(name, i, dict(state)))
-    return DEBUG_SOURCE_TEMPLATE.format(states=new_states, build_id=build_id)
+    tablet = [state.devices['tablet'].values if 'tablet' in state.devices else {} for state in new_states]
+    return DEBUG_SOURCE_TEMPLATE.format(states=new_states, build_id=build_id,
+                                        sorted_states=sorted_names(state.name for state in new_states),
+                                        sorted_master_values=[sorted_names(state.devices['master'].values) for state in new_states],
+                                        sorted_master_events=[sorted_names(state.devices['master'].events) for state in new_states],
+                                        sorted_tablet_values=[sorted_names(values) for values in tablet],
+                                        opcode_debug_setting=OPCODE_DEBUG_SETTING,
+                                        opcode_heartbeat=OPCODE_HEARTBEAT,
+                                        opcode_ack=OPCODE_ACK,
+                                        opcode_queue_stats=OPCODE_QUEUE_STATS,
+                                        opcode_profile=OPCODE_PROFILE,
+                                        build_id_basic=BUILD_ID_BASIC,
+                                        queue_stats_reset=QUEUE_STATS_RESET,
+                                        profile_reset=PROFILE_RESET,
+                                        profile_no_slot=PROFILE_NO_SLOT,
+                                        profile_entries=PROFILE_ENTRIES,
+                                        debug_all_values=DEBUG_ALL_VALUES,
+                                        frame_sync=FRAME_SYNC,
+                                        frame_max_length=FRAME_MAX_LENGTH,
+                                        crc8_poly=CRC8_POLY,
+                                        telemetry_magic=TELEMETRY_MAGIC,
+                                        telemetry_header=TELEMETRY_HEADER,
+                                        telemetry_record=TELEMETRY_RECORD,
+                                        session_magic=SESSION_MAGIC,
+                                        session_header=SESSION_HEADER,
+                                        session_record=SESSION_RECORD,
+                                        session_out=SESSION_OUT,
+                                        session_in=SESSION_IN)
 
 if __name__ == '__main__':
     import os
     import sys
     import json
 
+    host_build = '--host' in sys.argv
+    if host_build:
+        sys.argv.remove('--host')
+    instrument = '--instrument' in sys.argv
+    if instrument:
+        sys.argv.remove('--instrument')
+
     weird_mode = False
     if len(sys.argv) >= 4:
         if sys.argv[1] == '-w':
@@ -854,9 +3960,10 @@ if __name__ == '__main__':
 
     if len(sys.argv) > 3:
         print >>sys.stderr, "Error: too many arguments"
-        print >>sys.stderr, "Usage: %s Consolenn /path/to/consolenn.comm" % sys.argv[0]
+        print >>sys.stderr, "Usage: %s [--host] [--instrument] Consolenn /path/to/consolenn.comm" % sys.argv[0]
         sys.exit(1)
 
+    hardware = None
     if len(sys.argv) == 3:
         console_name, comm_file = sys.argv[1:]
     elif len(sys.argv) == 2:
@@ -874,17 +3981,21 @@ if __name__ == '__main__':
     device_names, states = parse(comm_file)
     device_names |= {'tablet', 'master'}
     dirname = os.path.dirname(comm_file)
+    if hardware is None:
+        # the topology is optional when the console is named on the command line
+        try:
+            hardware = json.load(open(os.path.join(dirname, "hardware.json"), 'rb'))
+        except IOError:
+            pass
 
-    # this line is an abomination
-    hashable_states = tuple((name, frozenset((devname, (frozenset(values.items()), tuple(events))) for (devname, (values, events)) in devices.items())) for (name, devices) in states.items())
-    build_id = hash(hashable_states) & (2**32 - 1)
+    build_id = compute_build_id(states)
     print "Build ID: %08x" % build_id
 
     if weird_mode:
         js = generate_tablet(states, build_id)
         open(os.path.join(dirname, "states.js"), 'wb').write(js)
 
-        header, source = generate_master('master', states, build_id, 0)
+        header, source = generate_master('master', states, build_id, OrderedDict())
         open(os.path.join(dirname, "states.h"), 'wb').write(header)
         open(os.path.join(dirname, "states.cpp"), 'wb').write(source)
 
@@ -893,33 +4004,32 @@ if __name__ == '__main__':
 
         sys.exit(0)
 
-    slaves = 0
-    master_name = None
-    if device_names == {'master', 'tablet'}:
-        master_name = 'AMIB1'
-        slaves |= 0
-    if 'amib2' in device_names:
-        master_name = 'AMIB1'
-        slaves |= 1
-    if 'amib3' in device_names:
-        if master_name is None:
-            master_name = 'AMIB2'
-        slaves |= 2
-    if 'amib4' in device_names:
-        if master_name is None:
-            master_name = 'AMIB3'
-        slaves |= 4
+    try:
+        master_name, slaves = load_topology(hardware, device_names)
+        schedule = load_bus_schedule(hardware, slaves)
+        event_queue = hardware.get('eventQueue', 0) if hardware else 0
+        if not isinstance(event_queue, int) or not 0 <= event_queue <= 0xff:
+            raise ValueError("eventQueue is %r, it must be between 0 and 255" % event_queue)
+    except ValueError as e:
+        print >>sys.stderr, "Invalid topology: %s" % e
+        sys.exit(1)
 
     for name in device_names:
         if name == 'tablet':
             js = generate_tablet(states, build_id)
             open(os.path.join(dirname, "states.js"), 'wb').write(js)
         elif name == 'master':
-            header, source = generate_master('master', states, build_id, slaves)
+            header, source = generate_master('master', states, build_id, slaves, schedule, event_queue, instrument)
             open(os.path.join(dirname, console_name + master_name, "states.h"), 'wb').write(header)
             open(os.path.join(dirname, console_name + master_name, "states.cpp"), 'wb').write(source)
+            if host_build:
+                host_dir = os.path.join(dirname, console_name + "Host")
+                if not os.path.isdir(host_dir):
+                    os.mkdir(host_dir)
+                for (filename, contents) in generate_host(console_name, states, header, source).items():
+                    open(os.path.join(host_dir, filename), 'wb').write(contents)
         else:
-            header, source = generate_sub(name, states)
+            header, source = generate_sub(name, states, slaves[name], event_queue)
             name = 'AMIB' + name[4:]
             open(os.path.join(dirname, console_name + name, "states.h"), 'wb').write(header)
             open(os.path.join(dirname, console_name + name, "states.cpp"), 'wb').write(source)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python2
+# Benchmarks the generated master code on this machine. Generates a
+# synthetic schema for each size, builds it with the host target gen.py
+# --host writes (a mock Manager.h and host_bench.cpp) and prints the cost
+# of wire value lookup, event dispatch, commLoop() and frame decoding.
+#
+# Usage: python hostbench.py [--size STATESxVALUESxEVENTS ...] [--queue N] [-o results.json] [--compare baseline.json]
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import gen
+import bench
+
+DEFAULT_SIZES = ['4x4x4', '32x32x16', '200x64x32']
+
+def parse_size(s):
+    try:
+        sizes = tuple(int(n) for n in s.split('x'))
+    except ValueError:
+        sizes = ()
+    if len(sizes) != 3 or not all(1 <= n <= 0xff for n in sizes):
+        raise argparse.ArgumentTypeError("size must look like STATESxVALUESxEVENTS, each 1 to 255")
+    return sizes
+
+def synthetic_comm(num_states, num_values, num_events):
+    # Every state gets the same master values and events, the values
+    # cycling through the value types.
+    comm = []
+    for state in range(num_states):
+        comm.append("class S%d:\n    def master():\n        def events():\n" % state)
+        comm.extend("            e%d\n" % i for i in range(num_events))
+        comm.append("        def values():\n")
+        comm.extend("            v%d = %s\n" % (i, bench.TYPES[i % len(bench.TYPES)]) for i in range(num_values))
+    return ''.join(comm)
+
+def build(workdir, size, event_queue):
+    comm = os.path.join(workdir, 'Synthetic.comm')
+    open(comm, 'wb').write(synthetic_comm(*size))
+    _, states = gen.parse(comm)
+    build_id = gen.compute_build_id(states)
+    header, source = gen.generate_master('master', states, build_id, gen.OrderedDict(), event_queue=event_queue)
+
+    source_dir = os.path.join(workdir, 'SyntheticHost')
+    os.mkdir(source_dir)
+    for (filename, contents) in gen.generate_host('Synthetic', states, header, source).items():
+        open(os.path.join(source_dir, filename), 'wb').write(contents)
+
+    build_dir = os.path.join(workdir, 'build')
+    devnull = open(os.devnull, 'w')
+    subprocess.check_call(['cmake', '-S', source_dir, '-B', build_dir, '-DCMAKE_BUILD_TYPE=Release'], stdout=devnull)
+    subprocess.check_call(['cmake', '--build', build_dir], stdout=devnull)
+    return os.path.join(build_dir, 'SyntheticHostBench')
+
+def run(size, event_queue, seconds):
+    workdir = tempfile.mkdtemp()
+    try:
+        out = subprocess.check_output([build(workdir, size, event_queue), str(seconds)])
+    finally:
+        shutil.rmtree(workdir)
+
+    results = []
+    # the first line describes the schema
+    for line in out.splitlines()[1:]:
+        name, ops, ns = line.split()
+        results.append({
+            'size': 'x'.join(str(n) for n in size),
+            'queue': event_queue,
+            'bench': name,
+            'ops': int(ops),
+            'ns_per_op': float(ns) if ns != '-' else None,
+        })
+    return results
+
+def key(r):
+    return (r['size'], r['queue'], r['bench'])
+
+def describe(r):
+    return '%-12s %5d %-8s' % (r['size'], r['queue'], r['bench'])
+
+def print_result(r):
+    ns = '%10.2f' % r['ns_per_op'] if r['ns_per_op'] is not None else '%10s' % '-'
+    print '%s %12d %s' % (describe(r), r['ops'], ns)
+    sys.stdout.flush()
+
+def compare(results, baseline, threshold):
+    # Prints the change in time per operation against an earlier run and
+    # returns the number of benchmarks that got slower than |threshold|.
+    old = dict((key(r), r) for r in baseline)
+    regressions = 0
+    for r in results:
+        before = old.get(key(r))
+        if before is None or not before['ns_per_op'] or r['ns_per_op'] is None:
+            continue
+        change = (r['ns_per_op'] - before['ns_per_op']) / before['ns_per_op']
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print '%s %+7.1f%%%s' % (describe(r), change * 100, flag)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the generated master code on a host build")
+    parser.add_argument('--size', type=parse_size, action='append', help="schema sizes as STATESxVALUESxEVENTS (default %s)" % ', '.join(DEFAULT_SIZES))
+    parser.add_argument('--queue', type=int, action='append', help="eventQueue sizes to build with, 0 for synchronous events (default 0)")
+    parser.add_argument('--seconds', type=float, default=0.2, help="seconds to run each benchmark for (default 0.2)")
+    parser.add_argument('-o', '--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="compare against results from an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown counted as a regression (default 0.1)")
+    args = parser.parse_args()
+
+    sizes = args.size or [parse_size(s) for s in DEFAULT_SIZES]
+    queues = args.queue or [0]
+
+    results = []
+    print '%-12s %5s %-8s %12s %10s' % ('size', 'queue', 'bench', 'ops', 'ns/op')
+    for size in sizes:
+        for event_queue in queues:
+            for r in run(size, event_queue, args.seconds):
+                results.append(r)
+                print_result(r)
+
+    if args.output:
+        json.dump({'time': time.time(), 'results': results}, open(args.output, 'wb'), indent=2)
+
+    if args.compare:
+        print
+        if compare(results, json.load(open(args.compare, 'rb'))['results'], args.threshold):
+            sys.exit(1)
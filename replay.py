@@ -0,0 +1,207 @@
+#!/usr/bin/env python2
+# Replays a session recorded by the console's "session" command. The
+# commands that were sent are sent again, to a simulated AMIB or a real
+# one, at the recorded pace, N times faster or as fast as possible. The
+# frames received are then compared with the ones in the recording.
+#
+# Usage: python replay.py session.bin consolenn.comm [--port /dev/ttyACM0] [--speed N | --max]
+import sys
+import time
+import struct
+import difflib
+import argparse
+import threading
+
+import serial
+
+import gen
+import sim
+import bridge
+
+# Link-level replies, which depend on the console and not on the board.
+IGNORED_OPCODES = (gen.OPCODE_HEARTBEAT, gen.OPCODE_ACK)
+
+class Session(object):
+    def __init__(self, path):
+        data = open(path, 'rb').read()
+        header_size = struct.calcsize(gen.SESSION_HEADER)
+        record_size = struct.calcsize(gen.SESSION_RECORD)
+        magic, self.build_id, self.state_id = struct.unpack_from(gen.SESSION_HEADER, data)
+        if magic != gen.SESSION_MAGIC:
+            raise ValueError("%s is not a session" % path)
+
+        self.records = []
+        pos = header_size
+        # a console that didn't exit cleanly can leave a partial record
+        while pos + record_size <= len(data):
+            timestamp, direction, length = struct.unpack_from(gen.SESSION_RECORD, data, pos)
+            pos += record_size
+            if pos + length > len(data):
+                break
+            self.records.append((timestamp, direction, data[pos:pos + length]))
+            pos += length
+
+    def frames(self, direction):
+        return [(timestamp, frame) for (timestamp, d, frame) in self.records if d == direction]
+
+    def duration(self):
+        return self.records[-1][0] if self.records else 0.0
+
+class Replayer(object):
+    def __init__(self, port, states, framed=False):
+        self.port     = port
+        self.framed   = framed
+        self.sizes    = bridge.value_sizes(states, 'tablet')
+        self.splitter = bridge.FramedSplitter() if framed else bridge.FrameSplitter(bridge.FROM_BOARD_LENGTHS, self.sizes)
+        self.received = []
+        self.closing  = False
+        self.thread   = None
+
+    def handshake(self):
+        self.port.write('\x05')
+        build_id, = struct.unpack('<I', self.reply('\x05', 'build ID')[1:])
+        self.port.write('\x06')
+        self.reply('\x06', 'state')
+        return build_id
+
+    # Returns the next frame starting with |opcode|. A board that's already
+    # running can send values before it answers, so other frames are
+    # skipped. Bytes are read one at a time so nothing after the reply is
+    # taken from the port.
+    def reply(self, opcode, what):
+        splitter = bridge.FrameSplitter(bridge.FROM_BOARD_LENGTHS, self.sizes)
+        while True:
+            s = self.port.read(1)
+            if not s:
+                raise IOError("board didn't answer the %s handshake" % what)
+            for frame in splitter.feed(s):
+                if frame[0] == opcode:
+                    return frame
+
+    def write(self, frame):
+        self.port.write(sim.frame(frame) if self.framed else frame)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        while True:
+            try:
+                s = self.port.read(self.port.in_waiting or 1)
+            except Exception:
+                if self.closing:
+                    return
+                raise
+            if not s:
+                return
+            self.received.extend(self.splitter.feed(s))
+
+    # Sends |frames|, a list of (timestamp, frame), |speed| times faster
+    # than they were recorded, or as fast as possible if |speed| is None.
+    def send(self, frames, speed):
+        start = time.time()
+        first = frames[0][0] if frames else 0.0
+        for timestamp, frame in frames:
+            if speed is not None:
+                delay = start + (timestamp - first) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.write(frame)
+        return time.time() - start
+
+    def close(self):
+        self.closing = True
+        if hasattr(self.port, 'cancel_read'):
+            self.port.cancel_read()
+            self.thread.join(1)
+        self.port.close()
+
+def describe(states, frame):
+    # Names the state, value or event in |frame| where possible.
+    op = ord(frame[0])
+    items = list(states.items())
+    try:
+        if op == gen.OPCODE_VALUE:
+            state, devices = items[ord(frame[1])]
+            name, ty = list(devices['tablet'].values.items())[ord(frame[2])]
+            value, = struct.unpack(sim.STRUCT_TYPES[ty], frame[3:])
+            return 'value %s.%s = %s' % (state, name, value)
+        elif op == 1:
+            state, devices = items[ord(frame[1])]
+            return 'event %s.%s' % (state, devices['tablet'].events[ord(frame[2])])
+    except (IndexError, KeyError, struct.error):
+        pass
+    return ' '.join('%02x' % ord(c) for c in frame)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a recorded console session and compare what comes back")
+    parser.add_argument('session', help="session file recorded by the console")
+    parser.add_argument('comm', help="the .comm file the console was generated from")
+    parser.add_argument('--port', help="replay against this port instead of a simulated AMIB")
+    parser.add_argument('--rate', type=sim.parse_rate, action='append', default=[], help="have the simulated AMIB emit a tablet value, as STATE.value=HZ")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay this many times faster than recorded (default 1)")
+    parser.add_argument('--max', action='store_true', help="replay as fast as possible")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds to wait for replies after the last command (default 1)")
+    parser.add_argument('-f', '--framed', action='store_true', help="wrap frames with a sync byte, length and CRC")
+    parser.add_argument('--force', action='store_true', help="replay even if the build IDs don't match")
+    parser.add_argument('-n', '--max-diff', type=int, default=50, help="differences to print (default 50)")
+    args = parser.parse_args()
+
+    session = Session(args.session)
+    _, states = gen.parse(args.comm)
+    # what a master built without MANAGER_COMM_HOOKS reports, worked out
+    # before the simulator adds empty devices to |states|
+    basic_build_id = gen.compute_build_id(states) ^ gen.BUILD_ID_BASIC
+    if args.port:
+        port = serial.serial_for_url(args.port, 9600)
+        amib = None
+        # opening the port resets the board
+        time.sleep(1)
+    else:
+        # a session recorded from a master without MANAGER_COMM_HOOKS is
+        # replayed against a simulated one
+        amib, path = sim.start(states, session.build_id, args.rate, hooks=session.build_id != basic_build_id)
+        port = serial.serial_for_url(path, 9600)
+
+    replayer = Replayer(port, states, args.framed)
+    build_id = replayer.handshake()
+    error = None
+    if build_id != session.build_id and not args.force:
+        error = "Mismatching build IDs: session has %#08x but the board has %#08x" % (session.build_id, build_id)
+    elif args.framed and build_id == basic_build_id:
+        error = "The board was built without MANAGER_COMM_HOOKS, so it can't be framed"
+    if error is not None:
+        # the simulator's threads would otherwise still be running as the
+        # interpreter shuts down
+        if amib is not None:
+            amib.stop()
+        print >>sys.stderr, error
+        sys.exit(3)
+
+    replayer.start()
+
+    sent = session.frames(gen.SESSION_OUT)
+    # start from the state the session was recorded in
+    replayer.write('\x00' + chr(session.state_id))
+    elapsed = replayer.send(sent, None if args.max else args.speed)
+    time.sleep(args.settle)
+    # the simulator's threads write to the port, so they stop first
+    if amib is not None:
+        amib.stop()
+    replayer.close()
+
+    print "Sent %d commands in %.2fs, recorded over %.2fs (%.1fx)" % (
+        len(sent), elapsed, session.duration(), session.duration() / elapsed if elapsed else float('inf'))
+
+    expected = [describe(states, frame) for (_, frame) in session.frames(gen.SESSION_IN) if ord(frame[0]) not in IGNORED_OPCODES]
+    actual = [describe(states, frame) for frame in replayer.received if ord(frame[0]) not in IGNORED_OPCODES]
+    diff = [line for line in difflib.unified_diff(expected, actual, 'recorded', 'replayed', n=0, lineterm='')
+            if line[:1] in '+-' and line[:3] not in ('---', '+++')]
+    print "Received %d frames, %d recorded, %d differences" % (len(actual), len(expected), len(diff))
+    for line in diff[:args.max_diff]:
+        print line
+    if len(diff) > args.max_diff:
+        print "... %d more" % (len(diff) - args.max_diff)
+    sys.exit(1 if diff else 0)
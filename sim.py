@@ -0,0 +1,373 @@
+#!/usr/bin/env python2
+# Simulated master AMIB. Speaks the console protocol on a pseudo-terminal
+# using the states parsed from a .comm file, so the generated debug console
+# can be run and load tested without any boards attached.
+#
+# Usage: python sim.py [/path/to/consolenn.comm] [--rate STATE.value=HZ ...]
+# then run the console on the printed port: python debug.py /dev/pts/N
+import os
+import sys
+import pty
+import tty
+import json
+import time
+import errno
+import select
+import struct
+import termios
+import argparse
+import threading
+
+import gen
+
+STRUCT_TYPES = {
+    'bool': '<?',
+    'uint8_t': '<B',
+    'int8_t': '<b',
+    'uint16_t': '<H',
+    'int16_t': '<h',
+    'uint32_t': '<I',
+    'int32_t': '<i',
+}
+
+def crc8(s):
+    crc = 0
+    for c in s:
+        crc ^= ord(c)
+        for _ in range(8):
+            crc = ((crc << 1) ^ gen.CRC8_POLY) & 0xff if crc & 0x80 else (crc << 1) & 0xff
+    return crc
+
+def frame(s):
+    return chr(gen.FRAME_SYNC) + chr(len(s)) + s + chr(crc8(chr(len(s)) + s))
+
+# Raised by read() when the console closes the port.
+class Detached(Exception):
+    pass
+
+class SimulatedAMIB(object):
+    def __init__(self, states, build_id, fd, path=None, baud=None, verbose=False, hooks=True):
+        self.states     = list(states.items())
+        self.build_id   = build_id
+        # False simulates a master built without MANAGER_COMM_HOOKS, which
+        # only knows the original opcodes
+        self.hooks      = hooks
+        self.fd         = fd
+        self.path       = path
+        self.baud       = baud
+        self.verbose    = verbose
+        self.cur_state  = 0
+        self.write_lock = threading.Lock()
+        self.running    = True
+        # set by stop(), wakes the threads from their sleeps
+        self.stopping   = threading.Event()
+        self.threads    = []
+        # set while a console has the port open, nothing is sent otherwise
+        self.attached   = False
+        self.read_debt  = 0.0
+        self.write_debt = 0.0
+        # switched on by the first valid framed frame from the console
+        self.framed     = False
+        self.frame      = None
+        # set when an unknown value was dropped unframed, so the bytes
+        # after it are its payload and not opcodes
+        self.garbage    = False
+
+        # simulated Value storage, by state id and value id
+        self.values = [[0] * len(devices['master'].values) for (_, devices) in self.states]
+        self.events = []
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.levels = {}
+
+    def log(self, msg):
+        if self.verbose:
+            print >>sys.stderr, msg
+
+    def read(self, n):
+        if self.frame is not None:
+            if len(self.frame) < n:
+                raise ValueError("frame too short")
+            s, self.frame = self.frame[:n], self.frame[n:]
+            return s
+
+        s = ''
+        while len(s) < n:
+            # wait a little at a time, so stop() doesn't wait for input
+            if not select.select([self.fd], [], [], 0.1)[0]:
+                if not self.running:
+                    raise EOFError()
+                continue
+            try:
+                chunk = os.read(self.fd, n - len(s))
+            except OSError as e:
+                # reading the master end fails with EIO while nothing has
+                # the other end open
+                if e.errno == errno.EIO and self.running:
+                    self.detach()
+                    raise Detached()
+                chunk = ''
+            if not chunk:
+                raise EOFError()
+            self.attached = True
+            s += chunk
+        if self.baud:
+            self.read_debt = self.throttle(self.read_debt, n)
+        return s
+
+    # Sleeps off the time |n| bytes take on the wire at the simulated baud
+    # rate. Short sleeps are inaccurate, so the time is only paid once at
+    # least a millisecond is owed.
+    def throttle(self, debt, n):
+        # 8N1 is ten bits on the wire per byte
+        debt += n * 10.0 / self.baud
+        if debt >= 0.001:
+            start = time.time()
+            time.sleep(debt)
+            debt -= time.time() - start
+        return debt
+
+    # Stops sending until a console opens the port again, and throws away
+    # anything sent that the last console didn't read, which would
+    # otherwise be the first thing the next one reads.
+    def detach(self):
+        self.write_lock.acquire()
+        try:
+            if not self.attached:
+                return
+            self.attached = False
+            self.framed = False
+            if self.path is not None:
+                fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY)
+                termios.tcflush(fd, termios.TCIFLUSH)
+                os.close(fd)
+            self.log("console detached")
+        finally:
+            self.write_lock.release()
+
+    # Returns whether |s| was sent, which it isn't while detached.
+    def write(self, s):
+        if self.framed:
+            s = frame(s)
+        self.write_lock.acquire()
+        try:
+            if not self.attached:
+                return False
+            os.write(self.fd, s)
+            self.frames_sent += 1
+            if self.baud:
+                self.write_debt = self.throttle(self.write_debt, len(s))
+            return True
+        finally:
+            self.write_lock.release()
+
+    def master_values(self, state_id):
+        return list(self.states[state_id][1]['master'].values.items())
+
+    def tablet_values(self, state_id):
+        devices = self.states[state_id][1]
+        return list(devices['tablet'].values.items()) if 'tablet' in devices else []
+
+    def handle(self, opcode):
+        if opcode == 0:
+            state_id = ord(self.read(1))
+            if state_id >= len(self.states):
+                self.log("dropped state change to unknown state %d" % state_id)
+                return
+            self.cur_state = state_id
+            self.log("state -> %s" % self.states[self.cur_state][0])
+        elif opcode == 1:
+            state_id, event_id = struct.unpack('BB', self.read(2))
+            if state_id >= len(self.states) or event_id >= len(self.states[state_id][1]['master'].events):
+                self.log("dropped unknown event %d.%d" % (state_id, event_id))
+                return
+            name = self.states[state_id][1]['master'].events[event_id]
+            self.events.append((time.time(), state_id, event_id))
+            self.log("event %s.%s" % (self.states[state_id][0], name))
+        elif opcode == 2:
+            state_id, value_id = struct.unpack('BB', self.read(2))
+            if state_id >= len(self.states) or value_id >= len(self.master_values(state_id)):
+                # the value's size isn't known, so unframed its payload
+                # can't be skipped and is read as opcodes. The board does
+                # the same, so this is garbage either way.
+                self.log("dropped unknown value %d.%d" % (state_id, value_id))
+                self.garbage = self.frame is None
+                return
+            name, ty = self.master_values(state_id)[value_id]
+            sty = STRUCT_TYPES[ty]
+            self.values[state_id][value_id], = struct.unpack(sty, self.read(struct.calcsize(sty)))
+            self.log("value %s.%s = %s" % (self.states[state_id][0], name, self.values[state_id][value_id]))
+        elif opcode == gen.OPCODE_DEBUG_SETTING and self.hooks:
+            setting = self.read(3)
+            state_id, value_id, level = struct.unpack('BBB', setting)
+            # like the board, only a setting that was applied is echoed
+            if state_id >= len(self.states) or \
+               (value_id != gen.DEBUG_ALL_VALUES and value_id >= len(self.tablet_values(state_id))):
+                self.log("dropped debug setting for unknown value %d.%d" % (state_id, value_id))
+                return
+            self.levels[state_id, value_id] = level
+            self.write(chr(opcode) + setting)
+        elif opcode == gen.OPCODE_HEARTBEAT and self.hooks:
+            self.write(chr(opcode) + self.read(2))
+        elif opcode == 5:
+            self.write('\x05' + struct.pack('<I', self.build_id))
+        elif opcode == 6:
+            self.write('\x06' + chr(self.cur_state))
+        elif opcode == gen.OPCODE_ACK and self.hooks:
+            self.write(chr(opcode) + self.read(1))
+        elif opcode == gen.OPCODE_QUEUE_STATS and self.hooks:
+            # events are handled as they arrive, so nothing is ever queued
+            # and a reset has nothing to clear
+            flags = ord(self.read(1))
+            if flags & gen.QUEUE_STATS_RESET:
+                self.log("queue stats reset")
+            self.write(chr(opcode) + '\x00' * 5)
+        elif opcode == gen.OPCODE_PROFILE and self.hooks:
+            # not instrumented, so every slot is missing
+            self.read(3)
+            self.write(chr(opcode) + struct.pack('<H', gen.PROFILE_NO_SLOT) + '\x00' * 12)
+        elif opcode == gen.FRAME_SYNC and self.frame is None and self.hooks:
+            length = ord(self.read(1))
+            payload = self.read(length)
+            if ord(self.read(1)) != crc8(chr(length) + payload) or not payload:
+                self.log("dropped corrupt frame")
+                return
+            self.framed = True
+            self.frame = payload[1:]
+            try:
+                self.handle(ord(payload[0]))
+            except (ValueError, IndexError):
+                self.log("dropped malformed frame")
+            finally:
+                self.frame = None
+            return
+        elif self.garbage:
+            self.log("skipped garbage byte %#04x after an unknown value" % opcode)
+            return
+        else:
+            self.log("unknown opcode %d" % opcode)
+            return
+        self.garbage = False
+        self.frames_received += 1
+
+    def serve(self):
+        try:
+            while self.running:
+                try:
+                    self.handle(ord(self.read(1)))
+                except Detached:
+                    # wait for the next console
+                    self.stopping.wait(0.05)
+        except EOFError:
+            pass
+
+    def muted(self, state_id, value_id):
+        return self.levels.get((state_id, gen.DEBUG_ALL_VALUES), 1) == 0 or \
+               self.levels.get((state_id, value_id), 1) == 0
+
+    # Sends tablet value |name| of |state| |rate| times a second while that
+    # state is current and a console is attached, counting up from zero.
+    # A rate of 0 sends as fast as possible.
+    def emit(self, state, name, rate):
+        state_id = next(i for (i, (s, _)) in enumerate(self.states) if s == state)
+        value_id, ty = next((i, ty) for (i, (n, ty)) in enumerate(self.tablet_values(state_id)) if n == name)
+        sty = STRUCT_TYPES[ty]
+        mask = (1 << (8 * struct.calcsize(sty))) - 1
+        counter = 0
+        next_time = time.time()
+        while self.running:
+            sent = False
+            if self.cur_state == state_id and not self.muted(state_id, value_id):
+                if ty == 'bool':
+                    value = counter % 2 == 1
+                else:
+                    value, = struct.unpack(sty, struct.pack(STRUCT_TYPES[ty].upper(), counter & mask))
+                if self.write('\x02' + chr(state_id) + chr(value_id) + struct.pack(sty, value)):
+                    counter += 1
+                    sent = True
+            if rate:
+                next_time += 1.0 / rate
+                delay = next_time - time.time()
+                if delay > 0:
+                    self.stopping.wait(delay)
+            elif not sent:
+                # detached, muted or in another state, so don't spin
+                self.stopping.wait(0.01)
+
+    # Stops the threads start() started and closes the pty. Nothing else
+    # closes it, so no thread can write to a pty a later simulator reuses
+    # the descriptor of.
+    def stop(self):
+        self.running = False
+        self.stopping.set()
+        for t in self.threads:
+            t.join()
+        os.close(self.fd)
+
+def open_pty():
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    # only the master end stays open, so the simulator can tell when a
+    # console disconnects and it outlives consoles that come and go
+    os.close(slave)
+    return master, path
+
+def start(states, build_id, rates=(), baud=None, verbose=False, hooks=True):
+    # Starts a simulator on a new pty in background threads and returns it
+    # along with the port the console should open. |rates| is a list of
+    # (state, value, hz) tablet values to emit.
+    master, path = open_pty()
+    sim = SimulatedAMIB(states, build_id, master, path, baud=baud, verbose=verbose, hooks=hooks)
+    threads = [threading.Thread(target=sim.serve)]
+    threads += [threading.Thread(target=sim.emit, args=rate) for rate in rates]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    sim.threads = threads
+    return sim, path
+
+def parse_rate(s):
+    try:
+        name, hz = s.split('=')
+        state, value = name.split('.')
+        return state, value, float(hz)
+    except ValueError:
+        raise argparse.ArgumentTypeError("rate must look like STATE.value=HZ")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulate a master AMIB on a pseudo-terminal")
+    parser.add_argument('comm', nargs='?', help="the .comm file, found from hardware.json by default")
+    parser.add_argument('--build-id', type=lambda s: int(s, 16), help="build ID to report, in hex (defaults to the one gen.py computes)")
+    parser.add_argument('--rate', type=parse_rate, action='append', default=[], help="emit a tablet value, as STATE.value=HZ (0 for as fast as possible)")
+    parser.add_argument('--baud', type=int, help="throttle input and output to this baud rate")
+    parser.add_argument('--basic', action='store_true', help="simulate a master built without MANAGER_COMM_HOOKS")
+    parser.add_argument('-v', '--verbose', action='store_true', help="print every frame received")
+    args = parser.parse_args()
+
+    comm_file = args.comm
+    if comm_file is None:
+        try:
+            comm_file = json.load(open("hardware.json", 'rb'))['name'] + ".comm"
+        except (IOError, ValueError, KeyError):
+            print >>sys.stderr, "Must either have valid hardware.json or give a .comm file"
+            sys.exit(1)
+
+    _, states = gen.parse(comm_file)
+    build_id = args.build_id if args.build_id is not None else gen.compute_build_id(states)
+    if args.basic:
+        build_id ^= gen.BUILD_ID_BASIC
+    for state, value, _ in args.rate:
+        if state not in states or value not in states[state]['tablet'].values:
+            print >>sys.stderr, "No tablet value %s.%s" % (state, value)
+            sys.exit(1)
+
+    sim, path = start(states, build_id, args.rate, args.baud, args.verbose, not args.basic)
+    print "Build ID: %08x" % build_id
+    print "Simulated AMIB on %s" % path
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -1,4 +1,21 @@
 
+// Writes a frame setting MOTIONMACHINE.stepperPosition to |value|, returning its length.
+function encode_MOTIONMACHINE_stepperPosition(view, offset, value) {
+  view.setUint8(offset, 2);
+  view.setUint8(offset + 1, 1);
+  view.setUint8(offset + 2, 0);
+  view.setUint32(offset + 3, value, true);
+  return 7;
+}
+// Writes a frame setting ARM.rotations to |value|, returning its length.
+function encode_ARM_rotations(view, offset, value) {
+  view.setUint8(offset, 2);
+  view.setUint8(offset + 1, 2);
+  view.setUint8(offset + 2, 0);
+  view.setUint32(offset + 3, value, true);
+  return 7;
+}
+
 var IDLE = {
   id: 0,
   master: {
@@ -23,7 +40,7 @@ var MOTIONMACHINE = {
   id: 1,
   master: {
     values: {
-      stepperPosition: new HardwareValue(1, 0, Manager.TYPE_UINT32)
+      stepperPosition: new HardwareValue(1, 0, Manager.TYPE_UINT32, encode_MOTIONMACHINE_stepperPosition)
     },
     events: {
       moveLiftUp: function moveLiftUp() { manager.sendEvent(0, 1); },
@@ -47,7 +64,7 @@ var ARM = {
   id: 2,
   master: {
     values: {
-      rotations: new HardwareValue(2, 0, Manager.TYPE_UINT32)
+      rotations: new HardwareValue(2, 0, Manager.TYPE_UINT32, encode_ARM_rotations)
     },
     events: {
       moveFromTallToShort: function moveFromTallToShort() { manager.sendEvent(0, 2); },
@@ -76,4 +93,16 @@ var STATES = {
   MOTIONMACHINE: MOTIONMACHINE,
   ARM: ARM
 };
-var manager = new Manager([IDLE, MOTIONMACHINE, ARM]);
+// VALUE_DECODERS[state id][value id] reads the value out of a value frame
+// and VALUE_FRAME_SIZES[state id][value id] is that frame's length
+var VALUE_DECODERS = [
+  [],
+  [],
+  []
+];
+var VALUE_FRAME_SIZES = [
+  [],
+  [],
+  []
+];
+var manager = new Manager([IDLE, MOTIONMACHINE, ARM], VALUE_DECODERS, VALUE_FRAME_SIZES);
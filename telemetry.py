@@ -0,0 +1,155 @@
+#!/usr/bin/env python2
+# Reader for the binary telemetry logs written by the console's "record"
+# command. The log is memory-mapped and exposed as a NumPy structured array,
+# so millions of samples can be analyzed without parsing any text.
+#
+# Usage: python telemetry.py log.bin [/path/to/consolenn.comm] [--csv out.csv] [--parquet out.parquet]
+import os
+import sys
+import mmap
+import struct
+import argparse
+
+import numpy as np
+
+import gen
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('state', 'u1'),
+    ('value', 'u1'),
+    ('size', 'u1'),
+    ('pad', 'u1'),
+    ('raw', 'u1', (4,)),
+])
+assert RECORD_DTYPE.itemsize == struct.calcsize(gen.TELEMETRY_RECORD)
+
+NUMPY_TYPES = {
+    'bool': '?',
+    'uint8_t': '<u1',
+    'int8_t': '<i1',
+    'uint16_t': '<u2',
+    'int16_t': '<i2',
+    'uint32_t': '<u4',
+    'int32_t': '<i4',
+}
+
+class TelemetryLog(object):
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        self.map = None
+        size = os.fstat(self.f.fileno()).st_size
+        header_size = struct.calcsize(gen.TELEMETRY_HEADER)
+        if size == 0:
+            # the console died before its header reached the disk, and an
+            # empty file can't be mapped
+            self.build_id = None
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+            return
+        if size < header_size:
+            raise ValueError("%s is not a telemetry log" % path)
+
+        self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.build_id, count = struct.unpack_from(gen.TELEMETRY_HEADER, self.map)
+        if magic != gen.TELEMETRY_MAGIC:
+            raise ValueError("%s is not a telemetry log" % path)
+
+        # a log from a console that didn't exit cleanly still has its
+        # preallocated tail, so trust the header rather than the file size,
+        # as long as the records it counts are really there
+        count = min(count, (size - header_size) // RECORD_DTYPE.itemsize)
+        self.records = np.frombuffer(self.map, dtype=RECORD_DTYPE, count=count, offset=header_size)
+
+    def __len__(self):
+        return len(self.records)
+
+    def select(self, state_id, value_id):
+        return self.records[(self.records['state'] == state_id) & (self.records['value'] == value_id)]
+
+    def decode(self, state_id, value_id, ty):
+        recs = self.select(state_id, value_id)
+        dtype = np.dtype(NUMPY_TYPES[ty])
+        values = recs['raw'][:, :dtype.itemsize].copy().view(dtype).reshape(-1)
+        return recs['timestamp'], values
+
+    def series(self, states):
+        # Yields (state, value name, timestamps, values) for every value that
+        # was recorded, using the parsed .comm file to name and type them.
+        for state_id, (state, devices) in enumerate(states.items()):
+            for value_id, (name, ty) in enumerate(devices['tablet'].values.items()):
+                timestamps, values = self.decode(state_id, value_id, ty)
+                if len(timestamps):
+                    yield state, name, timestamps, values
+
+    def close(self):
+        self.records = None
+        if self.map is not None:
+            self.map.close()
+        self.f.close()
+
+def columns(log, states):
+    # Flattens the log into time-ordered columns for export.
+    parts = list(log.series(states))
+    if not parts:
+        return [], [], [], []
+    timestamps = np.concatenate([p[2] for p in parts])
+    values = np.concatenate([p[3].astype('<i8') for p in parts])
+    state_names = np.concatenate([np.repeat(p[0], len(p[2])) for p in parts])
+    value_names = np.concatenate([np.repeat(p[1], len(p[2])) for p in parts])
+    order = np.argsort(timestamps, kind='mergesort')
+    return timestamps[order], state_names[order], value_names[order], values[order]
+
+def export_csv(log, states, path):
+    timestamps, state_names, value_names, values = columns(log, states)
+    table = np.rec.fromarrays([timestamps, state_names, value_names, values],
+                              names='timestamp,state,value,data')
+    np.savetxt(path, table, fmt='%.6f,%s,%s,%d', header='timestamp,state,value,data', comments='')
+
+def export_parquet(log, states, path):
+    import pyarrow
+    import pyarrow.parquet
+
+    timestamps, state_names, value_names, values = columns(log, states)
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array(timestamps), pyarrow.array(state_names), pyarrow.array(value_names), pyarrow.array(values)],
+        ['timestamp', 'state', 'value', 'data'])
+    pyarrow.parquet.write_table(table, path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Read a telemetry log recorded by the debug console")
+    parser.add_argument('log')
+    parser.add_argument('comm', nargs='?', help="the .comm file the console was generated from")
+    parser.add_argument('--csv', help="export the decoded values as CSV")
+    parser.add_argument('--parquet', help="export the decoded values as Parquet (requires pyarrow)")
+    args = parser.parse_args()
+
+    log = TelemetryLog(args.log)
+    if log.build_id is None:
+        print "Build ID: unknown"
+    else:
+        print "Build ID: %08x" % log.build_id
+    print "Records: %d" % len(log)
+    if len(log):
+        print "Duration: %.3fs" % (log.records['timestamp'][-1] - log.records['timestamp'][0])
+
+    if args.comm is None:
+        if args.csv or args.parquet:
+            print >>sys.stderr, "Need the .comm file to decode values"
+            sys.exit(1)
+        sys.exit(0)
+
+    _, states = gen.parse(args.comm)
+    if log.build_id is not None and gen.compute_build_id(states) != log.build_id:
+        print >>sys.stderr, "Warning: log was recorded with a different build of %s" % args.comm
+
+    for state, name, timestamps, values in log.series(states):
+        print "%s.%s: %d samples, min %d, max %d" % (state, name, len(values), values.min(), values.max())
+
+    if args.csv:
+        export_csv(log, states, args.csv)
+    if args.parquet:
+        try:
+            export_parquet(log, states, args.parquet)
+        except ImportError:
+            print >>sys.stderr, "Parquet export requires pyarrow"
+            sys.exit(1)
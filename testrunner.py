@@ -0,0 +1,199 @@
+#!/usr/bin/env python2
+# Runs the console's automated tests (see debug_tests.py) in parallel. Each
+# test gets its own console process, talking either to one of the given
+# serial ports or to a fresh simulated AMIB, and is killed if it runs past
+# its timeout. Results can be written as JUnit XML or JSON.
+#
+# Usage: python testrunner.py --ports /dev/ttyACM0,/dev/ttyACM1 [tests...]
+#        python testrunner.py --simulate FirstProject.comm -j 4 --junit results.xml
+#
+# Simulators emit every tablet value at DEFAULT_RATE Hz unless --rate picks
+# which values to emit and how fast.
+import os
+import sys
+import json
+import time
+import Queue
+import argparse
+import threading
+import subprocess
+import xml.etree.ElementTree as ET
+
+import gen
+import sim
+
+DEFAULT_RATE = 10.0
+
+class TestResult(object):
+    def __init__(self, name, status, duration, output):
+        self.name     = name
+        self.status   = status
+        self.duration = duration
+        self.output   = output
+
+    def to_json(self):
+        return {'name': self.name, 'status': self.status, 'duration': self.duration, 'output': self.output}
+
+class Runner(object):
+    def __init__(self, console, timeout, args=(), ports=None, states=None, build_id=None, rates=()):
+        self.console  = console
+        self.timeout  = timeout
+        self.args     = list(args)
+        self.ports    = Queue.Queue()
+        self.states   = states
+        self.build_id = build_id
+        self.rates    = list(rates)
+        for port in ports or []:
+            self.ports.put(port)
+
+    def list_tests(self):
+        out = subprocess.check_output([sys.executable, self.console, '--list-tests'])
+        return [name for name in out.split() if name != 'all']
+
+    # Gets a port for one test, either a free board or a new simulator.
+    def acquire(self):
+        if self.states is not None:
+            amib, path = sim.start(self.states, self.build_id, self.rates)
+            return amib, path
+        return None, self.ports.get()
+
+    def release(self, amib, port):
+        if amib is not None:
+            amib.stop()
+        else:
+            self.ports.put(port)
+
+    def run_one(self, name):
+        amib, port = self.acquire()
+        try:
+            start = time.time()
+            # only the test's own output is kept, not every value received
+            proc = subprocess.Popen([sys.executable, self.console, port, '-q', '-t', name] + self.args,
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            timed_out = []
+            def kill():
+                timed_out.append(True)
+                proc.kill()
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+            output, _ = proc.communicate()
+            timer.cancel()
+            duration = time.time() - start
+        finally:
+            self.release(amib, port)
+
+        if timed_out:
+            status = 'timeout'
+        elif proc.returncode == 0:
+            status = 'passed'
+        else:
+            status = 'failed'
+        return TestResult(name, status, duration, output)
+
+    def run(self, names, jobs, report=None):
+        todo = Queue.Queue()
+        for name in names:
+            todo.put(name)
+        results = []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    name = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                result = self.run_one(name)
+                lock.acquire()
+                results.append(result)
+                if report is not None:
+                    report(result)
+                lock.release()
+
+        workers = [threading.Thread(target=worker) for _ in range(jobs)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            # join() with a timeout so Ctrl-C still works
+            while w.is_alive():
+                w.join(1)
+
+        order = dict((name, i) for (i, name) in enumerate(names))
+        return sorted(results, key=lambda r: order[r.name])
+
+def junit_xml(results, suite_name, elapsed):
+    suite = ET.Element('testsuite', {
+        'name': suite_name,
+        'tests': str(len(results)),
+        'failures': str(sum(1 for r in results if r.status == 'failed')),
+        'errors': str(sum(1 for r in results if r.status == 'timeout')),
+        'time': '%.3f' % elapsed,
+    })
+    for r in results:
+        case = ET.SubElement(suite, 'testcase', {'classname': suite_name, 'name': r.name, 'time': '%.3f' % r.duration})
+        if r.status == 'failed':
+            ET.SubElement(case, 'failure', {'message': 'test failed'}).text = r.output
+        elif r.status == 'timeout':
+            ET.SubElement(case, 'error', {'message': 'test timed out'}).text = r.output
+        ET.SubElement(case, 'system-out').text = r.output
+    return ET.tostring(suite)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the console's automated tests in parallel")
+    parser.add_argument('tests', nargs='*', help="tests to run (default all)")
+    parser.add_argument('--console', default='debug.py', help="the generated console (default debug.py)")
+    parser.add_argument('--ports', help="comma separated serial ports, one test runs on each at a time")
+    parser.add_argument('--simulate', metavar='COMM', help="run each test against its own simulated AMIB for this .comm file")
+    parser.add_argument('--build-id', type=lambda s: int(s, 16), help="build ID for the simulators, in hex (defaults to the one gen.py computes)")
+    parser.add_argument('--rate', type=sim.parse_rate, action='append', help="have the simulators emit a tablet value, as STATE.value=HZ (default every value at %g Hz)" % DEFAULT_RATE)
+    parser.add_argument('-j', '--jobs', type=int, help="tests to run at once (default one per port, or 4 when simulating)")
+    parser.add_argument('--timeout', type=float, default=60.0, help="seconds before a test is killed (default 60)")
+    parser.add_argument('--test-args', default='', help="extra arguments passed to every test")
+    parser.add_argument('--junit', help="write JUnit XML results to this file")
+    parser.add_argument('--json', help="write JSON results to this file")
+    args = parser.parse_args()
+
+    if (args.ports is None) == (args.simulate is None):
+        print >>sys.stderr, "Give exactly one of --ports or --simulate"
+        sys.exit(1)
+
+    if args.simulate:
+        _, states = gen.parse(args.simulate)
+        build_id = args.build_id if args.build_id is not None else gen.compute_build_id(states)
+        rates = args.rate
+        if rates is None:
+            rates = [(state, value, DEFAULT_RATE) for state in states for value in states[state]['tablet'].values]
+        for state, value, _ in rates:
+            if state not in states or value not in states[state]['tablet'].values:
+                print >>sys.stderr, "No tablet value %s.%s" % (state, value)
+                sys.exit(1)
+        runner = Runner(args.console, args.timeout, args.test_args.split(), states=states, build_id=build_id, rates=rates)
+        jobs = args.jobs or 4
+    else:
+        ports = args.ports.split(',')
+        runner = Runner(args.console, args.timeout, args.test_args.split(), ports=ports)
+        jobs = min(args.jobs or len(ports), len(ports))
+
+    names = args.tests or runner.list_tests()
+    if not names:
+        print >>sys.stderr, "No tests to run"
+        sys.exit(1)
+
+    def report(r):
+        print '%-30s %-8s %8.2fs' % (r.name, r.status, r.duration)
+        sys.stdout.flush()
+
+    start = time.time()
+    results = runner.run(names, jobs, report)
+    elapsed = time.time() - start
+
+    passed = sum(1 for r in results if r.status == 'passed')
+    print '%d of %d tests passed in %.2fs' % (passed, len(results), elapsed)
+
+    if args.junit:
+        open(args.junit, 'wb').write(junit_xml(results, os.path.splitext(os.path.basename(args.console))[0], elapsed))
+    if args.json:
+        json.dump({'elapsed': elapsed, 'results': [r.to_json() for r in results]}, open(args.json, 'wb'), indent=2)
+
+    sys.exit(0 if passed == len(results) else 1)